@@ -0,0 +1,162 @@
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+import autogen
+from oa_diagnosis.agents import (
+    create_assessment_agent,
+    create_structuralist_agent,
+    create_physiologist_agent,
+    create_lead_consultant_agent,
+    create_therapy_group_manager
+)
+from oa_diagnosis.agents.speaker_selection import WorkflowSpeakerSelector
+from oa_diagnosis.agents.llm_cache import get_llm_cache, use_llm_cache
+from oa_diagnosis.agents.local_llm import register_local_clients
+from oa_diagnosis.agents.termination import WorkflowTermination
+from oa_diagnosis.tools.oai_data_loader import load_patient_data
+from oa_diagnosis.tools.imaging_analysis import analyze_imaging
+from oa_diagnosis.tools.clinical_analysis import analyze_contraindications, get_treatment_guidelines
+from oa_diagnosis.tools.similarity_search import find_similar_cases
+from oa_diagnosis.tools.linear_probe import predict_from_embedding
+
+# Agent sets in use at once (sessions beyond this wait for one to be returned)
+AGENT_POOL_SIZE = 4
+
+# Seconds a session waits for a free agent set before giving up
+AGENT_CHECKOUT_TIMEOUT = 300
+
+# Tools executed by the user proxy, by registered name
+DIAGNOSIS_TOOLS: Dict[str, Callable] = {
+    "load_patient_data": load_patient_data,
+    "analyze_imaging": analyze_imaging,
+    "analyze_contraindications": analyze_contraindications,
+    "get_treatment_guidelines": get_treatment_guidelines,
+    "find_similar_cases": find_similar_cases,
+    "predict_from_embedding": predict_from_embedding,
+}
+
+
+class AgentSet:
+    """
+    One diagnosis team: the user proxy (tool executor), the four specialist
+    agents, their GroupChat and the Lead Consultant managing it. 'tools'
+    overrides entries of DIAGNOSIS_TOOLS (e.g. a display wrapper).
+    """
+
+    def __init__(self, user_proxy: autogen.ConversableAgent, tools: Optional[Dict[str, Callable]] = None):
+        self.user_proxy = user_proxy
+        self.assessment_agent = create_assessment_agent()
+        self.structuralist_agent = create_structuralist_agent()
+        self.physiologist_agent = create_physiologist_agent()
+        self.therapy_manager = create_therapy_group_manager()
+
+        for name, function in dict(DIAGNOSIS_TOOLS, **(tools or {})).items():
+            user_proxy.register_for_execution(name=name)(function)
+
+        # Speakers follow the workflow rules; the LLM picks only when the state is ambiguous
+        self.speaker_selector = WorkflowSpeakerSelector()
+        self.groupchat = autogen.GroupChat(
+            agents=[user_proxy, self.assessment_agent, self.structuralist_agent, self.physiologist_agent, self.therapy_manager],
+            messages=[],
+            max_round=30,
+            speaker_selection_method=self.speaker_selector
+        )
+        # The chat ends as soon as the phenotype or the therapy plan is delivered
+        self.termination = WorkflowTermination()
+        self.lead_consultant = create_lead_consultant_agent(self.groupchat, is_termination_msg=self.termination)
+        register_local_clients(self.groupchat.agents + [self.lead_consultant], self.groupchat)
+        # Pass to initiate_chat as 'cache' too: it overrides client_cache for the chat
+        self.llm_cache = get_llm_cache()
+        use_llm_cache(self.groupchat.agents + [self.lead_consultant], self.llm_cache)
+        self.sessions = 0
+
+    def reset(self):
+        """Clear every agent's history and counters, the group chat and the selector, for the next session."""
+        for agent in self.groupchat.agents + [self.lead_consultant]:
+            agent.reset()
+        self.groupchat.reset()
+        self.speaker_selector.reset()
+        self.termination.reset()
+
+
+class AgentPool:
+    """
+    Pre-built agent sets shared by sessions. checkout() hands out an idle
+    set (building one only while fewer than 'size' exist), and returns it
+    reset when the session ends; at most 'size' sets are in use at once.
+    A set whose reset fails is dropped and rebuilt on demand.
+    """
+
+    def __init__(self, build: Callable[[], AgentSet], size: int = AGENT_POOL_SIZE):
+        self.build = build
+        self.size = size
+        self.built = 0
+        self.checkouts = 0
+        self._idle: "queue.LifoQueue[AgentSet]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # Sets warm() is building right now; checkout waits for one of them
+        # rather than build another
+        self._warming = 0
+
+    def warm(self, count: int = 1):
+        """
+        Build up to 'count' sets ahead of the first sessions. Safe to run on
+        a background thread while sessions check sets out: each set is
+        counted before it is built, so warming never exceeds 'count'.
+        """
+        while True:
+            with self._lock:
+                if self.built >= min(count, self.size):
+                    return
+                self.built += 1
+                self._warming += 1
+            try:
+                agent_set = self.build()
+            except Exception:
+                with self._lock:
+                    self.built -= 1
+                    self._warming -= 1
+                raise
+            self._idle.put(agent_set)
+            with self._lock:
+                self._warming -= 1
+
+    def _acquire(self) -> AgentSet:
+        while True:
+            try:
+                return self._idle.get(timeout=0.1) if self._warming else self._idle.get_nowait()
+            except queue.Empty:
+                if not self._warming:
+                    break
+        agent_set = self.build()
+        with self._lock:
+            self.built += 1
+        return agent_set
+
+    def _release(self, agent_set: AgentSet):
+        try:
+            agent_set.reset()
+        except Exception:
+            with self._lock:
+                self.built -= 1
+            return
+        self._idle.put(agent_set)
+
+    @contextmanager
+    def checkout(self, timeout: Optional[float] = AGENT_CHECKOUT_TIMEOUT) -> Iterator[AgentSet]:
+        """Agent set for one session; raises TimeoutError if none is free within 'timeout' seconds."""
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"All {self.size} agent sets are in use")
+        try:
+            agent_set = self._acquire()
+            with self._lock:
+                self.checkouts += 1
+            agent_set.sessions += 1
+            try:
+                yield agent_set
+            finally:
+                self._release(agent_set)
+        finally:
+            self._slots.release()
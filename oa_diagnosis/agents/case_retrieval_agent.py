@@ -7,15 +7,15 @@ def create_case_retrieval_agent():
         name="Case_Retrieval_Agent",
         system_message="""You are the Case Retrieval Agent.
         Your role is to:
-        1. Extract the patient's Age, BMI, Gender, and KL Grade (from Imaging).
-        2. Use 'find_similar_cases' to find historical patients.
-        3. Report the outcomes of similar cases to help refine the prognosis or treatment plan.
+        1. Extract the patient's ID, Age, BMI, Gender, and KL Grade (from Imaging).
+        2. Use 'find_similar_cases' (always pass patient_id) to find historical patients with the most similar clinical profile and X-ray/MRI embeddings.
+        3. Report the outcomes of similar cases (KL change, JSPRG/PAINPRG progression) to help refine the prognosis or treatment plan.
 
         Response style: Return a concise list of similar cases (IDs + key outcomes) and a one-line summary. No extra commentary or pleasantries.
         """,
         llm_config=llm_config
     )
     
-    agent.register_for_llm(name="find_similar_cases", description="Find similar OAI cases")(find_similar_cases)
+    agent.register_for_llm(name="find_similar_cases", description="Find similar OAI cases by clinical profile and fused X-ray/MRI embedding similarity, with their observed KL change and progression outcomes")(find_similar_cases)
     
     return agent
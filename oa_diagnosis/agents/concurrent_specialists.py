@@ -0,0 +1,126 @@
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from autogen import ConversableAgent, GroupChat
+from oa_diagnosis.agents.speaker_selection import (
+    PHYSIOLOGIST, STRUCTURALIST, assess_conflict, lead_verdict, post_message, transcript
+)
+from oa_diagnosis.agents.termination import parse_phenotype
+
+# "concurrent": the Structuralist and Physiologist read the case at the same
+# time and the Lead Consultant judges their merged findings; "groupchat":
+# they take serial GroupChat turns (speaker_selection.py)
+SPECIALIST_EXECUTION = "concurrent"
+
+# Tool-call round trips a specialist may make before it must answer
+MAX_TOOL_ROUNDS = 3
+
+
+def _as_message(reply: Any) -> Dict[str, Any]:
+    return reply if isinstance(reply, dict) else {"content": reply}
+
+
+def run_specialist(agent: ConversableAgent, message: str, tool_executor: ConversableAgent,
+                   history: Sequence[Dict[str, Any]] = (),
+                   max_tool_rounds: int = MAX_TOOL_ROUNDS) -> Dict[str, Any]:
+    """
+    One specialist's turn outside the GroupChat: its LLM reply to 'message'
+    (after 'history', e.g. earlier stages), with any tool calls executed by
+    tool_executor (the agent the tools are registered on) and fed back until
+    it answers in text.
+    """
+    start = time.perf_counter()
+    messages: List[Dict[str, Any]] = list(history) + [{"role": "user", "content": message}]
+    content = None
+    for _ in range(max_tool_rounds + 1):
+        final, reply = agent.generate_oai_reply(messages=messages)
+        if not final or reply is None:
+            break
+        reply = _as_message(reply)
+        if not reply.get("tool_calls"):
+            content = reply.get("content")
+            break
+        messages.append(dict(reply, role="assistant"))
+        _, response = tool_executor.generate_tool_calls_reply(messages=[reply])
+        messages.extend(response.get("tool_responses", []) if response else [])
+    return {"name": agent.name, "content": content or "", "seconds": round(time.perf_counter() - start, 3)}
+
+
+def run_specialists_concurrently(agents: Sequence[ConversableAgent], message: str,
+                                 tool_executor: ConversableAgent,
+                                 history: Sequence[Dict[str, Any]] = (),
+                                 max_tool_rounds: int = MAX_TOOL_ROUNDS) -> List[Dict[str, Any]]:
+    """Independent specialist turns in parallel threads; results in the order of 'agents'."""
+    # Each thread runs in a copy of the caller's context, so tools that use
+    # context variables (e.g. Chainlit's session for image display) still work
+    with ThreadPoolExecutor(max_workers=max(1, len(agents))) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, run_specialist, agent, message, tool_executor, history, max_tool_rounds)
+            for agent in agents
+        ]
+        return [future.result() for future in futures]
+
+
+def merge_findings(results: Sequence[Dict[str, Any]]) -> str:
+    """Specialist outputs as one message for the Lead Consultant."""
+    return "SPECIALIST FINDINGS (gathered concurrently):\n" + "\n\n".join(
+        f"{r['name']}: {r['content'] or '(no findings)'}" for r in results
+    )
+
+
+def concurrent_consultation(lead_consultant: ConversableAgent, groupchat: GroupChat, message: str,
+                            tool_executor: ConversableAgent, clear_history: bool = True,
+                            termination: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                            max_tool_rounds: int = MAX_TOOL_ROUNDS) -> Dict[str, Any]:
+    """
+    A diagnosis stage with the Structuralist and Physiologist run
+    concurrently: both answer 'message' in parallel, their findings are
+    posted to the group chat, a debate round (Physiologist presents,
+    Structuralist rebuts) follows only if they conflict, and the Lead
+    Consultant gives its verdict on the merged transcript. Wall-clock is
+    about the slower specialist rather than the sum of both. clear_history
+    starts the stage on an empty chat, as initiate_chat(clear_history=True)
+    does; otherwise earlier stages are the specialists' history.
+    'termination' is applied to the verdict (see lead_verdict).
+    """
+    start = time.perf_counter()
+    if clear_history:
+        groupchat.reset()
+        for agent in groupchat.agents + [lead_consultant]:
+            agent.clear_history()
+    specialists = [groupchat.agent_by_name(name) for name in (STRUCTURALIST, PHYSIOLOGIST)]
+    history = transcript(groupchat)
+    post_message(groupchat, lead_consultant, {"role": "user", "content": message}, tool_executor)
+
+    findings = run_specialists_concurrently(specialists, message, tool_executor, history, max_tool_rounds)
+    for agent, result in zip(specialists, findings):
+        post_message(groupchat, lead_consultant, {"role": "user", "content": result["content"]}, agent)
+
+    conflict = assess_conflict(findings[0]["content"], findings[1]["content"])
+    debate: List[Dict[str, Any]] = []
+    if conflict:
+        # One sequential round, as in the GroupChat workflow: Physiologist presents, Structuralist rebuts
+        structuralist, physiologist = specialists
+        merged = merge_findings(findings)
+        presented = run_specialist(
+            physiologist, f"{message}\n\n{merged}\n\nThe findings conflict. {PHYSIOLOGIST}: present your case.",
+            tool_executor, history, max_tool_rounds,
+        )
+        rebutted = run_specialist(
+            structuralist, f"{message}\n\n{merged}\n\n{PHYSIOLOGIST}: {presented['content']}\n\n{STRUCTURALIST}: rebut.",
+            tool_executor, history, max_tool_rounds,
+        )
+        for agent, result in ((physiologist, presented), (structuralist, rebutted)):
+            post_message(groupchat, lead_consultant, {"role": "user", "content": result["content"]}, agent)
+        debate = [presented, rebutted]
+
+    verdict = lead_verdict(lead_consultant, groupchat, termination)
+    return {
+        "findings": findings,
+        "conflict": conflict,
+        "debate": debate,
+        "verdict": verdict,
+        "phenotype": parse_phenotype(verdict or ""),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
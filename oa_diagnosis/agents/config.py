@@ -9,8 +9,18 @@ config_list = [
     }
 ]
 
+# "openai", or "local" for scripted in-process replies with no network
+# (agents/local_llm.py; used by scripts/benchmark_workflow.py)
+LLM_BACKEND = os.environ.get("OA_LLM_BACKEND", "openai")
+
+if LLM_BACKEND == "local":
+    from oa_diagnosis.agents.local_llm import local_config_list
+    config_list = local_config_list()
+
 llm_config = {
     "config_list": config_list,
     "temperature": 0.2,
     "timeout": 120,
+    # autogen's legacy DiskCache is replaced by llm_cache.py (client_cache / initiate_chat(cache=...))
+    "cache_seed": None,
 }
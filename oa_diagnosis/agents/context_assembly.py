@@ -0,0 +1,184 @@
+import json
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from oa_diagnosis.agents.config import llm_config
+from oa_diagnosis.tools.oai_data_loader import load_patient_data
+from oa_diagnosis.tools.imaging_analysis import analyze_imaging_batch
+from oa_diagnosis.tools.similarity_search import find_similar_cases
+from oa_diagnosis.tools.linear_probe import predict_from_embedding
+
+# Similar cases included in the assembled context
+CONTEXT_SIMILAR_CASES = 3
+
+# Fields of an analyze_imaging result kept in the case summary
+IMAGING_SUMMARY_FIELDS = ("kl_grade", "resnet_prediction", "kl_model", "kl_grade_estimate", "kl_estimate_source",
+                          "progression_estimate")
+
+
+_token_counter = None
+
+def _count_tokens(text: str) -> int:
+    # autogen's tiktoken-based count when the encoding can be loaded (tried
+    # once), else ~4 characters per token
+    global _token_counter
+    if _token_counter is None:
+        try:
+            from autogen.token_count_utils import count_token
+            model = llm_config["config_list"][0]["model"]
+            count_token("", model)
+            _token_counter = lambda t: count_token(t, model)
+        except Exception:
+            _token_counter = lambda t: max(1, len(t) // 4)
+    return _token_counter(text)
+
+
+def _redundant_previews(image_ids: Sequence[str]) -> List[str]:
+    """JPG previews of studies whose DICOM archive is also listed (same folder, same basename)."""
+    archives = {
+        (posixpath.dirname(i), posixpath.basename(i)[:-len(".tar.gz")])
+        for i in image_ids if i.endswith(".tar.gz")
+    }
+    redundant = []
+    for image_id in image_ids:
+        if image_id.lower().endswith((".jpg", ".jpeg", ".png")):
+            folder, name = posixpath.dirname(image_id), posixpath.basename(image_id)
+            if any(folder == f and name.startswith(base) for f, base in archives):
+                redundant.append(image_id)
+    return redundant
+
+
+def assemble_case_context(patient_id: str, image_ids: Optional[Sequence[str]] = None,
+                          include_similar: bool = True, workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Run the Stage 1 data tools in Python before the chat starts: patient data
+    first (it lists the images), then imaging analysis, similar-case retrieval
+    and the embedding probe in parallel. 'image_ids' restricts the images
+    analyzed (e.g. a focused subset); by default every listed image except
+    previews of studies whose archive is listed too. Returns the raw tool
+    outputs.
+    """
+    patient = load_patient_data(patient_id)
+    context: Dict[str, Any] = {"patient_id": str(patient_id), "patient": patient, "imaging": {}}
+    if not isinstance(patient, dict) or "error" in patient:
+        return context
+
+    if image_ids is None:
+        listed = patient.get("imaging_ids", [])
+        skipped = set(_redundant_previews(listed))
+        image_ids = [i for i in listed if i not in skipped]
+    image_ids = list(image_ids)
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        imaging = pool.submit(analyze_imaging_batch, image_ids, workers) if image_ids else None
+        similar = pool.submit(
+            find_similar_cases, patient.get("age"), patient.get("bmi"), patient.get("gender"),
+            None, patient_id=str(patient_id), top_k=CONTEXT_SIMILAR_CASES,
+        ) if include_similar else None
+        probe = pool.submit(predict_from_embedding, str(patient_id))
+
+        if imaging is not None:
+            context["imaging"] = dict(zip(image_ids, imaging.result()))
+        if similar is not None:
+            context["similar_cases"] = similar.result()
+        context["embedding_estimate"] = probe.result()
+    return context
+
+
+def summarize_case(context: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact, structured case summary of assembled tool outputs (what the agents need, once)."""
+    patient = context.get("patient") or {}
+    if "error" in patient:
+        return {"patient_id": context.get("patient_id"), "error": patient["error"]}
+
+    summary: Dict[str, Any] = {
+        "patient_id": patient.get("id", context.get("patient_id")),
+        "demographics": {k: patient.get(k) for k in ("age", "gender", "bmi")},
+        "history": patient.get("history"),
+        "symptoms": patient.get("symptoms"),
+        "medications": patient.get("medications") or [],
+        "biomarkers": patient.get("biomarkers") or {},
+    }
+
+    images, skipped, failed = [], [], []
+    for image_id, result in context.get("imaging", {}).items():
+        if not isinstance(result, dict) or "error" in result:
+            failed.append(image_id)
+        elif str(result.get("status", "")).startswith("Skipped"):
+            skipped.append(f"{image_id} ({result.get('body_part')})")
+        else:
+            metadata = result.get("metadata", {})
+            entry = {"image_id": image_id, "modality": metadata.get("Modality"), "date": metadata.get("Date")}
+            entry.update({k: result[k] for k in IMAGING_SUMMARY_FIELDS if k in result})
+            images.append(entry)
+    summary["imaging"] = images
+    if skipped:
+        summary["imaging_skipped_non_knee"] = skipped
+    if failed:
+        summary["imaging_failed"] = failed
+
+    estimate = context.get("embedding_estimate")
+    if isinstance(estimate, dict) and "error" not in estimate:
+        summary["embedding_estimate"] = {k: estimate.get(k) for k in ("kl_grade", "progression")}
+
+    similar = context.get("similar_cases")
+    if isinstance(similar, list):
+        summary["similar_cases"] = [
+            {k: case.get(k) for k in ("case_id", "similarity_score", "baseline_kl", "latest_kl", "kl_change", "outcome")}
+            for case in similar if isinstance(case, dict) and "error" not in case
+        ]
+    return summary
+
+
+def format_case_context(summary: Dict[str, Any]) -> str:
+    """Summary as a compact JSON block for the initial chat message."""
+    return "PRE-ASSEMBLED CASE DATA (tools already run; do not call them again for this data):\n" + \
+        json.dumps(summary, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+def prestage_stats(context: Dict[str, Any], summary_text: str) -> Dict[str, int]:
+    """Tool calls the pre-stage ran in Python and the tokens of the summary it injects."""
+    outputs = [context.get("patient")] + list(context.get("imaging", {}).values())
+    outputs += [context[k] for k in ("similar_cases", "embedding_estimate") if k in context]
+    return {"tool_calls_prerun": len(outputs), "summary_tokens": _count_tokens(summary_text)}
+
+
+def measure_context_savings(run_session: Callable[[bool], Any]) -> Dict[str, Dict[str, int]]:
+    """
+    LLM calls and tokens the pre-stage removes, counted rather than
+    estimated: run_session(preassemble) runs one whole session with, then
+    without, the pre-stage on the local scripted backend, and the
+    LocalScriptedClient counters of the two runs are compared. Needs an
+    LLM cache that is off, or every reply of the second run is a hit, and
+    the same specialist execution for both runs: without the pre-stage the
+    app always uses the group chat, so run_session should pin
+    SPECIALIST_EXECUTION = "groupchat".
+    """
+    from oa_diagnosis.agents.local_llm import LocalScriptedClient
+    runs: Dict[str, Dict[str, int]] = {}
+    for label, preassemble in (("with_prestage", True), ("without_prestage", False)):
+        LocalScriptedClient.reset_counters()
+        run_session(preassemble)
+        runs[label] = LocalScriptedClient.counters()
+    runs["removed"] = {k: runs["without_prestage"][k] - runs["with_prestage"][k] for k in runs["with_prestage"]}
+    return runs
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Assemble the Stage 1 case context and report its size. The LLM calls and tokens it removes "
+                    "are measured by scripts/benchmark_workflow.py --compare-preassembly."
+    )
+    parser.add_argument("patient_ids", nargs="+")
+    parser.add_argument("--no-similar", action="store_true", help="Skip similar-case retrieval")
+    args = parser.parse_args()
+
+    for pid in args.patient_ids:
+        start = time.time()
+        context = assemble_case_context(pid, include_similar=not args.no_similar)
+        text = format_case_context(summarize_case(context))
+        stats = prestage_stats(context, text)
+        print(f"{pid}: assembled in {time.time() - start:.2f}s; " + ", ".join(f"{k}={v}" for k, v in stats.items()))
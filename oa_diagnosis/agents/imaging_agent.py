@@ -1,6 +1,7 @@
 from autogen import AssistantAgent
 from oa_diagnosis.agents.config import llm_config
 from oa_diagnosis.tools.imaging_analysis import analyze_imaging
+from oa_diagnosis.tools.linear_probe import predict_from_embedding
 
 def create_structuralist_agent():
     # Update config with temperature 0.3
@@ -15,6 +16,7 @@ def create_structuralist_agent():
         Logic:
         - Primary Stage: Analyze baseline KL grade, JSW, osteophytes.
         - Follow-up Stage: Compare serial imaging for JSN >= 0.7mm.
+        - Screening: 'predict_from_embedding' gives a fast KL / progression-group estimate from the patient's X-ray embedding; use it when images are unavailable or to cross-check, and label it as an estimate.
 
         Constraint: Must yield if biomarker evidence is overwhelming during debate.
 
@@ -24,5 +26,6 @@ def create_structuralist_agent():
     )
     
     agent.register_for_llm(name="analyze_imaging", description="Analyze MRI/X-Ray image")(analyze_imaging)
+    agent.register_for_llm(name="predict_from_embedding", description="Fast KL grade and progression-group estimate from the patient's precomputed X-ray embedding (no image decoding)")(predict_from_embedding)
     
     return agent
@@ -0,0 +1,214 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import argparse
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+from oa_diagnosis.tools.oai_data_loader import DATA_FILE_PATH
+
+# "read_write": serve hits and store new responses; "replay": serve hits and
+# fail on a miss (deterministic re-runs, no LLM calls); "off": no caching
+LLM_CACHE_MODE = "read_write"
+
+# Responses older than this are treated as misses and purged
+LLM_CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+# Entries kept; least recently used ones are evicted past this
+LLM_CACHE_MAX_ENTRIES = 20000
+
+LLM_CACHE_MODES = ("read_write", "replay", "off")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response BLOB NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+def default_cache_path() -> str:
+    return os.path.join(os.path.dirname(DATA_FILE_PATH), "cache", "llm_responses.sqlite")
+
+
+def request_key(key: str) -> str:
+    """
+    Hash of an autogen request key. autogen derives the key from the request
+    parameters (model, temperature, messages, tool schemas, ...; credentials
+    and endpoints excluded), so identical prompts share an entry.
+    """
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class LLMCacheMiss(LookupError):
+    """Raised in replay mode when a request has no cached response."""
+
+
+class SQLiteLLMCache:
+    """
+    Disk-backed LLM response cache implementing autogen's cache protocol
+    (get / set / close, used as a context manager by OpenAIWrapper.create).
+    Set it as an agent's client_cache, or pass it as 'cache' to initiate_chat.
+    One SQLite file, shared by every process on the host.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, mode: str = LLM_CACHE_MODE,
+                 ttl: Optional[float] = LLM_CACHE_TTL_SECONDS, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode {mode!r}; expected one of {LLM_CACHE_MODES}")
+        self.db_path = db_path or default_cache_path()
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+        self._entries = self._count()
+
+    def _count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        digest, now = request_key(key), time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (digest,)).fetchone()
+            if row is not None and self._expired(row[1], now):
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (digest,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._conn.execute("UPDATE responses SET accessed = ?, hits = hits + 1 WHERE key = ?", (now, digest))
+                self._conn.commit()
+        if row is None:
+            if self.mode == "replay":
+                raise LLMCacheMiss(f"No cached LLM response for request {digest[:12]} (replay mode)")
+            return default
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        if self.mode != "read_write":
+            return
+        digest, now = request_key(key), time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            # Overwriting a key (e.g. an expired entry re-fetched) does not add an entry
+            new = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (digest,)).fetchone() is None
+            self._conn.execute(
+                "INSERT INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET response = excluded.response, created = excluded.created, accessed = excluded.accessed",
+                (digest, blob, now, now),
+            )
+            self._conn.commit()
+            self.writes += 1
+            self._entries += new
+            over_budget = self._entries > self.max_entries
+        if over_budget:
+            self.evict()
+
+    def evict(self) -> int:
+        """Purge expired entries, then the least recently used ones past max_entries. Returns entries removed."""
+        with self._lock:
+            removed = 0
+            if self.ttl is not None:
+                removed += self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)).rowcount
+            total = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if total > self.max_entries:
+                removed += self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                    (total - self.max_entries,),
+                ).rowcount
+            self._conn.commit()
+            self.evictions += removed
+        self._entries = self._count()
+        return removed
+
+    def clear(self):
+        """Drop every cached response."""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._entries = 0
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "entries": self._count(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 4) if requests else None,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # OpenAIWrapper.create enters and exits the cache around every request;
+    # the connection stays open for the life of the process
+    def __enter__(self) -> "SQLiteLLMCache":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        return None
+
+
+def use_llm_cache(agents: Iterable[Any], cache: Optional[SQLiteLLMCache]):
+    """Route the agents' direct LLM calls (generate_oai_reply outside initiate_chat) through the cache."""
+    for agent in agents:
+        agent.client_cache = cache
+
+
+_caches: Dict[Tuple[str, str, int], SQLiteLLMCache] = {}
+_caches_lock = threading.Lock()
+
+def get_llm_cache(db_path: Optional[str] = None, mode: Optional[str] = None) -> Optional[SQLiteLLMCache]:
+    """Return the shared LLM response cache (in LLM_CACHE_MODE by default), or None when caching is off."""
+    mode = mode or LLM_CACHE_MODE
+    if mode == "off":
+        return None
+    db_path = db_path or default_cache_path()
+    with _caches_lock:
+        # Keyed by PID too: a SQLite connection must not be reused in a forked process
+        key = (db_path, mode, os.getpid())
+        cache = _caches.get(key)
+        if cache is None:
+            cache = SQLiteLLMCache(db_path, mode=mode)
+            _caches[key] = cache
+        return cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or maintain the LLM response cache.")
+    parser.add_argument("--db", default=None, help=f"Cache file (default: {default_cache_path()})")
+    parser.add_argument("--evict", action="store_true", help="Purge expired and least recently used entries")
+    parser.add_argument("--clear", action="store_true", help="Drop every cached response")
+    args = parser.parse_args()
+
+    cache = SQLiteLLMCache(args.db)
+    if args.clear:
+        cache.clear()
+    elif args.evict:
+        print(f"Evicted {cache.evict()} entries")
+    print(cache.stats())
@@ -0,0 +1,223 @@
+import re
+import json
+import time
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from openai.types.chat import ChatCompletion
+
+# Model name and client class of the local backend in a config_list
+LOCAL_LLM_MODEL = "local-scripted"
+LOCAL_LLM_CLIENT = "LocalScriptedClient"
+
+# Simulated LLM latency: fixed seconds per reply plus seconds per completion token
+LOCAL_LLM_LATENCY_SECONDS = 0.0
+LOCAL_LLM_SECONDS_PER_TOKEN = 0.0
+
+_ROLE = re.compile(r"You are the (\w+)")
+_PATIENT_ID = re.compile(r"Patient(?: ID)?:?\s*(\d{7})\b")
+_IMAGE_ID = re.compile(r"\b\d{7}\|[\w./-]+")
+_KL_GRADE = re.compile(r"[\"']kl_grade[\"']\s*:\s*([0-4])|\bKL(?:\s*grade)?\s*[:=]?\s*([0-4])\b", re.IGNORECASE)
+
+
+def local_config_list(latency: float = LOCAL_LLM_LATENCY_SECONDS,
+                      seconds_per_token: float = LOCAL_LLM_SECONDS_PER_TOKEN) -> List[Dict[str, Any]]:
+    return [{
+        "model": LOCAL_LLM_MODEL,
+        "model_client_cls": LOCAL_LLM_CLIENT,
+        "latency": latency,
+        "seconds_per_token": seconds_per_token,
+    }]
+
+
+def _text(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    return content if isinstance(content, str) else ""
+
+
+def _tool_call(name: str, arguments: Dict[str, Any], index: int) -> Dict[str, Any]:
+    return {
+        "id": f"call_{name}_{index}",
+        "type": "function",
+        "function": {"name": name, "arguments": json.dumps(arguments)},
+    }
+
+
+def scripted_reply(messages: List[Dict[str, Any]], tools: Iterable[Dict[str, Any]] = ()) -> Dict[str, Any]:
+    """
+    Rule-generated reply of a workflow agent, identified by its system message.
+    The Assessment agent calls load_patient_data and the Structuralist calls
+    analyze_imaging for image IDs it has not analyzed, unless the case data
+    was pre-assembled; otherwise each role answers in the shape its prompt
+    asks for (KL grade, risk, phenotype, plan).
+    """
+    system = next((_text(m) for m in messages if m.get("role") == "system"), "")
+    role = (_ROLE.search(system) or [None, ""])[1]
+    text = "\n".join(_text(m) for m in messages if m.get("role") != "system")
+    tool_names = {t.get("function", {}).get("name") for t in tools}
+    called = [c["function"] for m in messages for c in (m.get("tool_calls") or [])]
+    pre_assembled = "PRE-ASSEMBLED CASE DATA" in text
+    patient = _PATIENT_ID.search(text)
+    patient_id = patient.group(1) if patient else None
+
+    if role == "Assessment_Agent" and "load_patient_data" in tool_names and patient_id and not pre_assembled \
+            and not any(c["name"] == "load_patient_data" for c in called):
+        return {"content": None, "tool_calls": [_tool_call("load_patient_data", {"patient_id": patient_id}, 0)]}
+
+    if role == "Structuralist_Agent" and "analyze_imaging" in tool_names and not pre_assembled:
+        analyzed = {json.loads(c["arguments"]).get("image_id") for c in called if c["name"] == "analyze_imaging"}
+        pending = [i for i in dict.fromkeys(_IMAGE_ID.findall(text)) if i not in analyzed]
+        if pending:
+            return {"content": None, "tool_calls": [
+                _tool_call("analyze_imaging", {"image_id": image_id}, i) for i, image_id in enumerate(pending)
+            ]}
+
+    grades = [int(a or b) for a, b in _KL_GRADE.findall(text)]
+    kl = max(grades) if grades else 2
+    progressed = "JSN has increased" in text
+    elevated = "elevated" in text.lower()
+
+    if role == "Assessment_Agent":
+        content = f"Patient {patient_id or 'unknown'}: profile, history and biomarkers summarized; baseline imaging available."
+    elif role == "Structuralist_Agent":
+        change = " JSN progression of 0.8mm on follow-up." if progressed else ""
+        content = f"KL grade {kl} on baseline imaging.{change}"
+    elif role == "Physiologist_Agent":
+        content = "Biomarkers elevated: high risk of progression." if elevated or kl < 2 else "Biomarkers unremarkable: low risk of progression."
+    elif role == "Lead_Consultant_Agent":
+        if progressed:
+            phenotype = "Rapid Progressor (RP)"
+        elif kl >= 2:
+            phenotype = "Slow Progressor (SP)"
+        else:
+            phenotype = "Combined" if elevated else "Non-Progressor"
+        content = f"Final phenotype: {phenotype}. Imaging KL {kl} weighed against the biomarker risk."
+    elif role == "Therapy_Group_Manager":
+        content = json.dumps({"plan": ["Structured exercise therapy", "Weight management", "Annual imaging follow-up"]})
+    else:
+        content = "Noted."
+    return {"content": content}
+
+
+class LocalScriptedClient:
+    """
+    In-process, OpenAI-compatible model client (autogen ModelClient protocol)
+    returning scripted replies with simulated latency, for offline runs and
+    benchmarks of the orchestration. 'script' maps (messages, tools) to a
+    reply dict with 'content' and optionally 'tool_calls'.
+    """
+
+    # Calls, tool calls requested, tokens and simulated seconds across all instances (one client per agent)
+    calls = 0
+    tool_calls = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+    simulated_seconds = 0.0
+    _lock = threading.Lock()
+
+    def __init__(self, config: Dict[str, Any], script: Optional[Callable] = None):
+        self.model = config.get("model", LOCAL_LLM_MODEL)
+        self.latency = float(config.get("latency", LOCAL_LLM_LATENCY_SECONDS))
+        self.seconds_per_token = float(config.get("seconds_per_token", LOCAL_LLM_SECONDS_PER_TOKEN))
+        self.script = script or scripted_reply
+
+    def create(self, params: Dict[str, Any]) -> ChatCompletion:
+        reply = self.script(params.get("messages", []), params.get("tools") or [])
+        content = reply.get("content")
+        completion_tokens = max(1, len(json.dumps(reply)) // 4)
+        prompt_tokens = sum(len(_text(m)) for m in params.get("messages", [])) // 4
+        delay = self.latency + self.seconds_per_token * completion_tokens
+        if delay > 0:
+            time.sleep(delay)
+        with LocalScriptedClient._lock:
+            LocalScriptedClient.calls += 1
+            LocalScriptedClient.tool_calls += len(reply.get("tool_calls") or [])
+            LocalScriptedClient.prompt_tokens += prompt_tokens
+            LocalScriptedClient.completion_tokens += completion_tokens
+            LocalScriptedClient.simulated_seconds += delay
+
+        message: Dict[str, Any] = {"role": "assistant", "content": content}
+        if reply.get("tool_calls"):
+            message["tool_calls"] = reply["tool_calls"]
+        return ChatCompletion.model_validate({
+            "id": f"local-{LocalScriptedClient.calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "finish_reason": "tool_calls" if reply.get("tool_calls") else "stop",
+                "message": message,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def message_retrieval(self, response: ChatCompletion) -> List[Any]:
+        # Same shape as autogen's OpenAI client: the message object for tool calls, else its text
+        return [
+            choice.message if choice.message.tool_calls else choice.message.content
+            for choice in response.choices
+        ]
+
+    def cost(self, response: ChatCompletion) -> float:
+        return 0.0
+
+    @staticmethod
+    def get_usage(response: ChatCompletion) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens,
+            "cost": 0.0,
+            "model": response.model,
+        }
+
+    @classmethod
+    def counters(cls) -> Dict[str, int]:
+        with cls._lock:
+            return {
+                "llm_calls": cls.calls,
+                "tool_calls": cls.tool_calls,
+                "prompt_tokens": cls.prompt_tokens,
+                "completion_tokens": cls.completion_tokens,
+            }
+
+    @classmethod
+    def reset_counters(cls):
+        with cls._lock:
+            cls.calls = 0
+            cls.tool_calls = 0
+            cls.prompt_tokens = 0
+            cls.completion_tokens = 0
+            cls.simulated_seconds = 0.0
+
+
+def uses_local_backend(agent: Any) -> bool:
+    config = getattr(agent, "llm_config", None)
+    return bool(config) and any(c.get("model_client_cls") == LOCAL_LLM_CLIENT for c in config.get("config_list", []))
+
+
+def register_local_clients(agents: Iterable[Any], groupchat: Optional[Any] = None):
+    """
+    Register the local client on agents configured for it (autogen requires
+    this after construction); no-op for other backends. autogen's "auto"
+    speaker selection builds its own agents, which cannot use the local
+    client, so the group chat's workflow selector gets no LLM fallbacks.
+    """
+    local = False
+    for agent in agents:
+        if uses_local_backend(agent):
+            agent.register_model_client(LocalScriptedClient)
+            local = True
+    selector = getattr(groupchat, "speaker_selection_method", None)
+    if local and hasattr(selector, "max_llm_fallbacks"):
+        selector.max_llm_fallbacks = 0
+
+
+def use_local_backend(latency: float = LOCAL_LLM_LATENCY_SECONDS, seconds_per_token: float = LOCAL_LLM_SECONDS_PER_TOKEN):
+    """Point the shared llm_config at the local backend; affects agents created afterwards."""
+    from oa_diagnosis.agents.config import llm_config
+    llm_config["config_list"] = local_config_list(latency, seconds_per_token)
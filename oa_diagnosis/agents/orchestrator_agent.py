@@ -1,7 +1,7 @@
 from autogen import AssistantAgent, GroupChatManager, GroupChat
 from oa_diagnosis.agents.config import llm_config
 
-def create_lead_consultant_agent(groupchat: GroupChat):
+def create_lead_consultant_agent(groupchat: GroupChat, is_termination_msg=None):
     # Update config with temperature 0.3
     specific_config = llm_config.copy()
     specific_config["temperature"] = 0.3
@@ -10,6 +10,7 @@ def create_lead_consultant_agent(groupchat: GroupChat):
         groupchat=groupchat,
         name="Lead_Consultant_Agent",
         llm_config=specific_config,
+        is_termination_msg=is_termination_msg,
         system_message="""You are the Lead_Consultant_Agent (Judge/Orchestrator).
         Role: Debate moderator and final decision maker.
 
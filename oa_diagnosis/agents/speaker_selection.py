@@ -0,0 +1,277 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from autogen import Agent, GroupChat
+
+# Agent names of the workflow (the Lead Consultant is the GroupChatManager and
+# gives its verdict once the selector ends the round)
+ASSESSMENT = "Assessment_Agent"
+STRUCTURALIST = "Structuralist_Agent"
+PHYSIOLOGIST = "Physiologist_Agent"
+THERAPY = "Therapy_Group_Manager"
+LEAD_CONSULTANT = "Lead_Consultant_Agent"
+
+# Debate rounds after a conflict (one round: Physiologist presents, Structuralist rebuts)
+DEBATE_ROUNDS = 1
+
+# LLM ("auto") speaker selections allowed per chat when the state is ambiguous
+MAX_LLM_FALLBACKS = 1
+
+# Opening message of a stage (see main.py / app.py); with clear_history=False
+# several stages share one transcript, so a stage starts at the last such message
+_STAGE_START = re.compile(r"^\s*(START DIAGNOSIS|STAGE\s+\d)", re.IGNORECASE)
+
+_KL_PATTERN = re.compile(r"\bKL(?:\s*grade)?\s*[:=]?\s*([0-4])\b", re.IGNORECASE)
+_HIGH_RISK = ("high risk", "elevated risk", "pre-radiographic progressor", "rapid progressor", "progressor (high")
+_LOW_RISK = ("low risk", "non-progressor", "non progressor", "minimal risk")
+_EXPLICIT_CONFLICT = re.compile(r"\b(?:conflict|disagree|discordan)\w*(-free)?", re.IGNORECASE)
+# Words that negate a conflict mention when among the few words before it, in the same clause
+_NEGATIONS = ("no", "not", "without", "neither", "nor", "never", "absence", "lack", "free")
+# Words that make the mention a question or instruction ("determine if there is a conflict")
+_HEDGES = ("if", "whether")
+_NEGATION_WINDOW = 4
+# A heading or question after the mention ("Conflict: none", "Is there a conflict? No.") and its answer
+_ANSWER = re.compile(r"^[^\n.:?]{0,40}?([:=?]|\s[-\u2013]\s)[\s*_\"']*([a-z/]+)?", re.IGNORECASE)
+_NEGATIVE_ANSWERS = ("no", "none", "absent", "not", "nil", "negative", "false", "n/a")
+_POSITIVE_ANSWERS = ("yes", "present", "detected", "confirmed", "identified", "true")
+
+
+def structural_kl(text: str) -> Optional[int]:
+    """Highest KL grade stated in a Structuralist message, or None."""
+    grades = [int(g) for g in _KL_PATTERN.findall(text or "")]
+    return max(grades) if grades else None
+
+
+def physiological_risk(text: str) -> Optional[str]:
+    """'high' / 'low' risk read from a Physiologist message, or None if it states neither (or both)."""
+    lowered = (text or "").lower()
+    high = any(k in lowered for k in _HIGH_RISK)
+    low = any(k in lowered for k in _LOW_RISK)
+    if high == low:
+        return None
+    return "high" if high else "low"
+
+
+def stated_conflict(text: str) -> Optional[bool]:
+    """
+    True if a message asserts a conflict ('the findings conflict', 'imaging
+    and biomarkers disagree', 'Conflict: yes'), False if it only denies one
+    ('no conflict', 'not in conflict', 'conflict-free', 'Conflict: none',
+    'Is there a conflict? No.'), None if it mentions none or only asks
+    ('determine if there is a conflict', a heading without a yes/no answer).
+    """
+    text = text or ""
+    asserted = denied = False
+    for match in _EXPLICIT_CONFLICT.finditer(text):
+        clause = re.split(r"[.;:!?,\n]", text[:match.start()])[-1]
+        before = [w.lower() for w in re.findall(r"[\w']+", clause)[-_NEGATION_WINDOW:]]
+        answer = _ANSWER.match(text[match.end():])
+        if match.group(1) or any(w in _NEGATIONS or w.endswith("n't") for w in before):
+            denied = True
+        elif answer is not None:
+            # Heading or question: the answer after it decides; without a yes/no it asserts nothing
+            word = (answer.group(2) or "").lower()
+            if word in _NEGATIVE_ANSWERS:
+                denied = True
+            elif word in _POSITIVE_ANSWERS:
+                asserted = True
+        elif not any(w in _HEDGES for w in before):
+            asserted = True
+    if asserted:
+        return True
+    return False if denied else None
+
+
+def assess_conflict(structural: str, physiological: str) -> Optional[bool]:
+    """
+    Conflict between imaging and clinical/biomarker findings: either
+    specialist asserting a conflict, or mild imaging (KL < 2) with high
+    clinical risk, or advanced imaging (KL >= 3) with low risk. When KL or
+    risk cannot be read, a specialist denying a conflict decides; otherwise
+    None (undecided).
+    """
+    stated = [stated_conflict(structural), stated_conflict(physiological)]
+    if True in stated:
+        return True
+    kl, risk = structural_kl(structural), physiological_risk(physiological)
+    if kl is None or risk is None:
+        return False if False in stated else None
+    return (kl < 2 and risk == "high") or (kl >= 3 and risk == "low")
+
+
+def _content(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    return content if isinstance(content, str) else ""
+
+
+def _is_tool_request(message: Dict[str, Any]) -> bool:
+    return bool(message.get("tool_calls") or message.get("function_call"))
+
+
+def _is_tool_response(message: Dict[str, Any]) -> bool:
+    return message.get("role") in ("tool", "function") or "tool_responses" in message
+
+
+class WorkflowSpeakerSelector:
+    """
+    Deterministic speaker selection for GroupChat (speaker_selection_method=
+    WorkflowSpeakerSelector()). The next speaker follows from the transcript:
+
+    - a tool call goes to the agent that can execute it, and the result goes
+      back to the agent that asked;
+    - primary stage: Assessment -> Structuralist -> Physiologist; follow-up
+      stage: Structuralist -> Physiologist (no intake);
+    - if their findings conflict, DEBATE_ROUNDS of Physiologist -> Structuralist;
+    - then the round ends (None) for the Lead Consultant's verdict;
+    - therapy stage: Therapy_Group_Manager once, then the round ends.
+
+    Only when the conflict cannot be read from the messages, or the last
+    speaker is outside the workflow, is the choice left to the LLM ("auto"),
+    at most MAX_LLM_FALLBACKS times per chat.
+    """
+
+    def __init__(self, max_llm_fallbacks: int = MAX_LLM_FALLBACKS, debate_rounds: int = DEBATE_ROUNDS):
+        self.max_llm_fallbacks = max_llm_fallbacks
+        self.debate_rounds = debate_rounds
+        self.llm_fallbacks = 0
+        self.rule_selections = 0
+        # Index and text of the current stage's opening message, and the transcript length seen
+        self._chat_start: Optional[Tuple[int, str]] = None
+        self._seen = 0
+
+    def reset(self):
+        """Forget the current stage and counters (the group chat is being reused)."""
+        self.llm_fallbacks = 0
+        self.rule_selections = 0
+        self._chat_start = None
+        self._seen = 0
+
+    @staticmethod
+    def stage(first_message: str) -> str:
+        """'therapy', 'follow_up' or 'primary', from the chat's opening message."""
+        text = first_message.upper()
+        if "STAGE 3" in text or "THERAPY GENERATION" in text:
+            return "therapy"
+        if "STAGE 2" in text or "FOLLOW-UP" in text:
+            return "follow_up"
+        return "primary"
+
+    def _fallback(self) -> Union[str, None]:
+        if self.llm_fallbacks < self.max_llm_fallbacks:
+            self.llm_fallbacks += 1
+            return "auto"
+        return None
+
+    def _agent(self, groupchat: GroupChat, name: str) -> Optional[Agent]:
+        return next((a for a in groupchat.agents if a.name == name), None)
+
+    def __call__(self, last_speaker: Agent, groupchat: GroupChat) -> Union[Agent, str, None]:
+        selected = self.select(last_speaker, groupchat)
+        if isinstance(selected, Agent):
+            self.rule_selections += 1
+        return selected
+
+    def select(self, last_speaker: Agent, groupchat: GroupChat) -> Union[Agent, str, None]:
+        messages: List[Dict[str, Any]] = groupchat.messages
+        if not messages:
+            return self._fallback()
+        start = next((i for i in range(len(messages) - 1, -1, -1) if _STAGE_START.match(_content(messages[i]))), 0)
+        # A new stage: another opening message, or a cleared transcript (clear_history
+        # restarts at index 0, possibly with the same opening text)
+        opening = (start, _content(messages[start]))
+        if opening != self._chat_start or len(messages) < self._seen:
+            # Its opening message defines the workflow
+            self._chat_start = opening
+            self.llm_fallbacks = 0
+        self._seen = len(messages)
+        chat = messages[start:]
+        last = chat[-1]
+
+        # Tool calls are executed by whichever agent registered the tool
+        if _is_tool_request(last):
+            calls = last.get("tool_calls") or [{"function": last.get("function_call")}]
+            name = (calls[0].get("function") or {}).get("name")
+            for agent in groupchat.agents:
+                if agent is not last_speaker and hasattr(agent, "can_execute_function") and agent.can_execute_function(name):
+                    return agent
+            return self._fallback()
+        if _is_tool_response(last):
+            requester = next((m.get("name") for m in reversed(chat[:-1]) if _is_tool_request(m)), None)
+            agent = self._agent(groupchat, requester) if requester else None
+            return agent if agent is not None else self._fallback()
+
+        # An empty reply still counts as the agent's turn, or it would be selected again every round
+        spoken = [m.get("name") for m in chat[1:] if not _is_tool_response(m) and not _is_tool_request(m)]
+        stage = self.stage(_content(chat[0]))
+
+        if stage == "therapy":
+            if THERAPY not in spoken and self._agent(groupchat, THERAPY) is not None:
+                return self._agent(groupchat, THERAPY)
+            return None
+
+        order = [STRUCTURALIST, PHYSIOLOGIST] if stage == "follow_up" else [ASSESSMENT, STRUCTURALIST, PHYSIOLOGIST]
+        for name in order:
+            agent = self._agent(groupchat, name)
+            if name not in spoken and agent is not None:
+                return agent
+
+        if last.get("name") not in order + [THERAPY] and len(chat) > 1:
+            # Someone outside the workflow spoke (e.g. an LLM-selected agent)
+            return self._fallback()
+
+        # Debate: after the first full pass, alternate Physiologist -> Structuralist
+        first_pass_end = max((spoken.index(name) for name in order if name in spoken), default=-1)
+        debate = [n for n in spoken[first_pass_end + 1:] if n in (STRUCTURALIST, PHYSIOLOGIST)]
+        if debate and debate[-1] == PHYSIOLOGIST:
+            return self._agent(groupchat, STRUCTURALIST)
+        if len(debate) // 2 >= self.debate_rounds:
+            return None
+
+        structural = next((_content(m) for m in reversed(chat) if m.get("name") == STRUCTURALIST), "")
+        physiological = next((_content(m) for m in reversed(chat) if m.get("name") == PHYSIOLOGIST), "")
+        conflict = assess_conflict(structural, physiological)
+        if conflict is None:
+            return self._fallback()
+        return self._agent(groupchat, PHYSIOLOGIST) if conflict else None
+
+
+def transcript(groupchat: GroupChat) -> List[Dict[str, str]]:
+    """The group chat so far as plain 'Name: content' user messages (tool traffic dropped)."""
+    return [
+        {"role": "user", "content": f"{m.get('name', 'user')}: {_content(m)}"}
+        for m in groupchat.messages if _content(m).strip()
+    ]
+
+
+def post_message(groupchat: GroupChat, manager, message: Dict[str, Any], speaker: Agent):
+    """
+    Record a message produced outside GroupChatManager.run_chat the way a
+    chat round does: append it, and broadcast it to every other participant
+    so it is in their history (and shown by the UI proxy) for later stages.
+    """
+    groupchat.append(message, speaker)
+    for agent in groupchat.agents:
+        if agent is not speaker:
+            manager.send(message, agent, request_reply=False, silent=True)
+
+
+def lead_verdict(lead_consultant, groupchat: GroupChat,
+                 termination: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Optional[str]:
+    """
+    One Lead Consultant (GroupChatManager) LLM reply on the stage transcript,
+    posted to the chat: its conflict judgment / phenotype verdict after the
+    selector has ended the round. The manager never speaks inside run_chat,
+    so its is_termination_msg ('termination', e.g. WorkflowTermination) is
+    applied to the posted verdict here, which records the phenotype.
+    """
+    messages = transcript(groupchat)
+    if not messages:
+        return None
+    final, reply = lead_consultant.generate_oai_reply(messages=messages)
+    if not final or reply is None:
+        return None
+    content = reply if isinstance(reply, str) else reply.get("content")
+    if content:
+        post_message(groupchat, lead_consultant, {"role": "user", "content": content}, lead_consultant)
+        if termination is not None:
+            termination(groupchat.messages[-1])
+    return content
@@ -0,0 +1,126 @@
+import re
+import json
+from typing import Any, Dict, List, Optional, Sequence
+from autogen import GroupChat
+from oa_diagnosis.agents.speaker_selection import LEAD_CONSULTANT, THERAPY, _STAGE_START, _content, _is_tool_response
+
+# The Lead Consultant's 4-class phenotype (orchestrator_agent.py), canonical names
+PHENOTYPES = ("Non-Progressor", "Rapid Progressor", "Slow Progressor", "Combined")
+
+# Minimum items of a therapy plan written as a bullet or numbered list
+MIN_PLAN_ITEMS = 2
+
+_PHENOTYPE_ALIASES = {
+    "non-progressor": "Non-Progressor", "non progressor": "Non-Progressor", "nonprogressor": "Non-Progressor",
+    "rapid progressor": "Rapid Progressor", "rp": "Rapid Progressor",
+    "slow progressor": "Slow Progressor", "sp": "Slow Progressor",
+    "combined": "Combined",
+}
+_PHENOTYPE_STATEMENT = re.compile(
+    r"phenotype\s*(?:is|[:=\-])\s*[*_\"']*\s*(non[- ]?progressor|rapid progressor|slow progressor|combined|rp|sp)\b",
+    re.IGNORECASE,
+)
+_PLAN_KEYS = ("plan", "management_plan", "recommendations", "therapy")
+_LIST_ITEM = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+\S")
+
+
+def _json_object(text: str) -> Optional[Dict[str, Any]]:
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").split("\n", 1)[-1]
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        value = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def parse_phenotype(text: str) -> Optional[str]:
+    """Canonical phenotype stated in a message ('Final phenotype: X' or a JSON 'phenotype' field), or None."""
+    data = _json_object(text or "")
+    if data is not None and isinstance(data.get("phenotype"), str):
+        value = re.sub(r"\s*\(.*\)$", "", data["phenotype"]).strip().lower()
+        return _PHENOTYPE_ALIASES.get(value)
+    match = _PHENOTYPE_STATEMENT.search(text or "")
+    return _PHENOTYPE_ALIASES.get(match.group(1).lower()) if match else None
+
+
+def parse_therapy_plan(text: str) -> Optional[List[str]]:
+    """Items of a therapy plan (JSON with a non-empty plan field, or a bullet / numbered list), or None."""
+    data = _json_object(text or "")
+    if data is not None:
+        for key in _PLAN_KEYS:
+            value = data.get(key)
+            if isinstance(value, list) and value:
+                return [json.dumps(v) if isinstance(v, dict) else str(v) for v in value]
+            if isinstance(value, dict) and value:
+                return [f"{k}: {v}" for k, v in value.items()]
+        return None
+    items = [line.strip() for line in (text or "").splitlines() if _LIST_ITEM.match(line)]
+    return items if len(items) >= MIN_PLAN_ITEMS else None
+
+
+class WorkflowTermination:
+    """
+    is_termination_msg for the Lead Consultant (GroupChatManager): ends the
+    group chat as soon as the Therapy_Group_Manager delivers a valid plan.
+    The manager never speaks inside run_chat, so its verdict is checked by
+    lead_verdict, which posts it; a valid 4-class phenotype there is
+    recorded the same way. Stage openings and tool traffic never match.
+    Each match is recorded in 'events'; stop_reason() explains how the last
+    stage ended.
+    """
+
+    def __init__(self, phenotype_speakers: Sequence[str] = (LEAD_CONSULTANT,),
+                 plan_speakers: Sequence[str] = (THERAPY,)):
+        self.phenotype_speakers = tuple(phenotype_speakers)
+        self.plan_speakers = tuple(plan_speakers)
+        self.events: List[Dict[str, Any]] = []
+
+    def check(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The termination event a message triggers, or None."""
+        text = _content(message)
+        if not text.strip() or _is_tool_response(message) or _STAGE_START.match(text):
+            return None
+        speaker = message.get("name")
+        if speaker in self.phenotype_speakers:
+            phenotype = parse_phenotype(text)
+            if phenotype is not None:
+                return {"reason": "phenotype", "speaker": speaker, "phenotype": phenotype}
+        if speaker in self.plan_speakers:
+            plan = parse_therapy_plan(text)
+            if plan is not None:
+                return {"reason": "therapy_plan", "speaker": speaker, "plan_items": len(plan)}
+        return None
+
+    def __call__(self, message: Dict[str, Any]) -> bool:
+        event = self.check(message)
+        if event is None:
+            return False
+        event["content"] = _content(message)
+        self.events.append(event)
+        return True
+
+    def reset(self):
+        self.events.clear()
+
+    def stop_reason(self, groupchat: GroupChat) -> Dict[str, Any]:
+        """
+        Why the last stage stopped: 'phenotype' (the Lead Consultant's verdict
+        posted by lead_verdict), 'therapy_plan' (this predicate in run_chat),
+        'max_round', or 'workflow_complete' (the speaker selector ended the
+        round and no verdict matched). 'rounds' counts the stage's messages.
+        """
+        messages = groupchat.messages
+        start = next((i for i in range(len(messages) - 1, -1, -1) if _STAGE_START.match(_content(messages[i]))), 0)
+        rounds = len(messages) - start
+        last = messages[-1] if messages else {}
+        if self.events and self.events[-1]["content"] == _content(last) and self.check(last) is not None:
+            event = {k: v for k, v in self.events[-1].items() if k != "content"}
+            return dict(event, rounds=rounds)
+        if rounds >= groupchat.max_round:
+            return {"reason": "max_round", "rounds": rounds}
+        return {"reason": "workflow_complete", "rounds": rounds}
@@ -10,20 +10,19 @@ import autogen
 import chainlit as cl
 import json
 import ast
-from oa_diagnosis.agents import (
-    create_assessment_agent,
-    create_structuralist_agent,
-    create_physiologist_agent,
-    create_case_retrieval_agent,
-    create_lead_consultant_agent,
-    create_therapy_group_manager
-)
+import threading
 
 # Tool imports
 from oa_diagnosis.tools.oai_data_loader import load_patient_data
 from oa_diagnosis.tools.imaging_analysis import analyze_imaging
-from oa_diagnosis.tools.clinical_analysis import analyze_contraindications, get_treatment_guidelines
-from oa_diagnosis.tools.similarity_search import find_similar_cases
+from oa_diagnosis.agents.context_assembly import assemble_case_context, format_case_context, prestage_stats, summarize_case
+from oa_diagnosis.agents.speaker_selection import lead_verdict
+from oa_diagnosis.agents.agent_pool import AgentPool, AgentSet
+from oa_diagnosis.agents.concurrent_specialists import SPECIALIST_EXECUTION, concurrent_consultation
+
+# Run the Stage 1 data tools in Python and hand the agents a case summary;
+# False leaves load_patient_data / analyze_imaging to the agents' tool calls
+PREASSEMBLE_CASE_CONTEXT = True
 
 # -------------------------------------------------------------------------
 # Custom UserProxy to Intercept Messages for UI
@@ -120,141 +119,193 @@ class ChainlitUserProxyAgent(autogen.UserProxyAgent):
 # -------------------------------------------------------------------------
 # Main Logic
 # -------------------------------------------------------------------------
-def setup_and_run_workflow(patient_id: str):
-    """
-    Sets up the agents and runs the 3-stage diagnosis workflow.
-    """
-    print(f"DEBUG: Starting workflow for {patient_id}")
-    
-    # 1. Create the User Proxy (The Bridge)
-    # This agent will sit in the GroupChat and "hear" everything, printing it to Chainlit.
-    user_proxy = ChainlitUserProxyAgent(
-        name="Admin_User",
-        system_message="A human admin. Execute the tools proposed by the agents.",
-        code_execution_config=False,
-        human_input_mode="NEVER",
-        max_consecutive_auto_reply=10,
-    )
+def analyze_imaging_with_display(image_id: str):
+    print(f"DEBUG: analyze_imaging_with_display called with image_id: {image_id}")
+    result = analyze_imaging(image_id)
+    return display_imaging_result(image_id, result)
 
-    # 2. Create Agents
-    assessment_agent = create_assessment_agent()
-    structuralist_agent = create_structuralist_agent()
-    physiologist_agent = create_physiologist_agent()
-    therapy_manager = create_therapy_group_manager()
-
-    # 3. Register Tools with Image Display Wrapper
-    def analyze_imaging_with_display(image_id: str):
-        print(f"DEBUG: analyze_imaging_with_display called with image_id: {image_id}")
-        result = analyze_imaging(image_id)
-        print(f"DEBUG: Result keys: {result.keys() if isinstance(result, dict) else 'not a dict'}")
+def display_imaging_result(image_id: str, result):
+    print(f"DEBUG: Result keys: {result.keys() if isinstance(result, dict) else 'not a dict'}")
+    
+    # Check if this was skipped (non-knee image)
+    if isinstance(result, dict) and result.get("status") == "Skipped - Not a knee image":
+        print(f"DEBUG: Skipping non-knee image: {result.get('body_part')}")
+        # Still display a message about the skipped image
+        cl.run_sync(
+            cl.Message(
+                content=f"⏭️ **Skipped** (Not a knee image): {result.get('body_part')} - Image ID: {image_id}",
+                author="Imaging System"
+            ).send()
+        )
+        return result
+    
+    # If result contains an image path, display it with analysis
+    if isinstance(result, dict):
+        image_path = result.get("image_path")
+        kl_grade = result.get("kl_grade", "Unknown")
+        prediction = result.get("resnet_prediction", "Unknown")
+        modality = result.get("metadata", {}).get("Modality", "Unknown")
         
-        # Check if this was skipped (non-knee image)
-        if isinstance(result, dict) and result.get("status") == "Skipped - Not a knee image":
-            print(f"DEBUG: Skipping non-knee image: {result.get('body_part')}")
-            # Still display a message about the skipped image
-            cl.run_sync(
-                cl.Message(
-                    content=f"⏭️ **Skipped** (Not a knee image): {result.get('body_part')} - Image ID: {image_id}",
-                    author="Imaging System"
-                ).send()
-            )
-            return result
+        print(f"DEBUG: image_path = {image_path}, KL Grade = {kl_grade}")
         
-        # If result contains an image path, display it with analysis
-        if isinstance(result, dict):
-            image_path = result.get("image_path")
-            kl_grade = result.get("kl_grade", "Unknown")
-            prediction = result.get("resnet_prediction", "Unknown")
-            modality = result.get("metadata", {}).get("Modality", "Unknown")
-            
-            print(f"DEBUG: image_path = {image_path}, KL Grade = {kl_grade}")
-            
-            # Create analysis summary
-            analysis_text = f"**Analysis of Image ID: {image_id}**\n\n"
-            analysis_text += f"🔍 **Prediction**: {prediction}\n"
-            analysis_text += f"📊 **Modality**: {modality}\n"
-            
-            if image_path and os.path.exists(image_path):
-                print(f"DEBUG: Image exists, displaying: {image_path}")
-                try:
-                    # Send image with analysis to UI
-                    cl.run_sync(
-                        cl.Message(
-                            content=analysis_text,
-                            elements=[
-                                cl.Image(
-                                    path=image_path, 
-                                    name=f"Knee Image - KL Grade {kl_grade}",
-                                    display="inline",
-                                    size="large"
-                                )
-                            ],
-                            author="Imaging System"
-                        ).send()
-                    )
-                    print(f"DEBUG: Image and analysis sent to UI successfully")
-                except Exception as e:
-                    print(f"DEBUG: Error sending image: {e}")
-                    import traceback
-                    traceback.print_exc()
-            else:
-                print(f"DEBUG: Image file does not exist: {image_path}")
-                # Still show analysis even if no image file
+        # Create analysis summary
+        analysis_text = f"**Analysis of Image ID: {image_id}**\n\n"
+        analysis_text += f"🔍 **Prediction**: {prediction}\n"
+        analysis_text += f"📊 **Modality**: {modality}\n"
+        
+        if image_path and os.path.exists(image_path):
+            print(f"DEBUG: Image exists, displaying: {image_path}")
+            try:
+                # Send image with analysis to UI
                 cl.run_sync(
                     cl.Message(
-                        content=analysis_text + f"\n(Image file not available at {image_path})",
+                        content=analysis_text,
+                        elements=[
+                            cl.Image(
+                                path=image_path, 
+                                name=f"Knee Image - KL Grade {kl_grade}",
+                                display="inline",
+                                size="large"
+                            )
+                        ],
                         author="Imaging System"
                     ).send()
                 )
-        
-        return result
-    
-    user_proxy.register_for_execution(name="load_patient_data")(load_patient_data)
-    user_proxy.register_for_execution(name="analyze_imaging")(analyze_imaging_with_display)
-    user_proxy.register_for_execution(name="analyze_contraindications")(analyze_contraindications)
-    user_proxy.register_for_execution(name="get_treatment_guidelines")(get_treatment_guidelines)
-    user_proxy.register_for_execution(name="find_similar_cases")(find_similar_cases)
+                print(f"DEBUG: Image and analysis sent to UI successfully")
+            except Exception as e:
+                print(f"DEBUG: Error sending image: {e}")
+                import traceback
+                traceback.print_exc()
+        else:
+            print(f"DEBUG: Image file does not exist: {image_path}")
+            # Still show analysis even if no image file
+            cl.run_sync(
+                cl.Message(
+                    content=analysis_text + f"\n(Image file not available at {image_path})",
+                    author="Imaging System"
+                ).send()
+            )
     
-    # 4. Create Group Chat
-    groupchat = autogen.GroupChat(
-        agents=[user_proxy, assessment_agent, structuralist_agent, physiologist_agent, therapy_manager], 
-        messages=[], 
-        max_round=30,
-        speaker_selection_method="auto"
+    return result
+
+
+def new_agent_set() -> AgentSet:
+    # The user proxy is the bridge: it sits in the GroupChat, "hears" everything
+    # and prints it to Chainlit. Image results are displayed by the tool wrapper.
+    user_proxy = ChainlitUserProxyAgent(
+        name="Admin_User",
+        system_message="A human admin. Execute the tools proposed by the agents.",
+        code_execution_config=False,
+        human_input_mode="NEVER",
+        max_consecutive_auto_reply=10,
     )
-    
-    # 5. Create Lead Consultant (Orchestrator)
-    lead_consultant = create_lead_consultant_agent(groupchat)
+    return AgentSet(user_proxy, tools={"analyze_imaging": analyze_imaging_with_display})
 
-    # -----------------------------------------------------------------
-    # Optional: Focused Image Display for Specific Patient IDs
-    # If a user requests a patient for which we want to display a curated
-    # subset of images (e.g., demonstration or QA), show those first and
-    # avoid flooding the UI with every image.
+
+# Pre-built agent sets shared by sessions: checked out per patient and reset on
+# return instead of rebuilding agents, tool registrations and LLM clients
+agent_pool = AgentPool(new_agent_set)
+
+# Agent sets built in the background at app load, so the first session
+# does not pay for building them (0 leaves it to the first checkout)
+AGENT_POOL_WARM = 1
+
+
+def _warm_agent_pool():
     try:
-        patient_data_preview = load_patient_data(patient_id)
-        imaging_ids_list = patient_data_preview.get('imaging_ids', []) if isinstance(patient_data_preview, dict) else []
-
-        focus_map = {
-            "9001695": [
-                f"{patient_id}|20041203/00422803_1x1.jpg",
-                f"{patient_id}|20050104/10098604_2x2.jpg",
-                f"{patient_id}|20050104/10098607_2x2.jpg",
-            ]
-        }
-
-        if patient_id in focus_map:
-            cl.run_sync(cl.Message(content=f"🔎 Displaying selected images for {patient_id}", author="System").send())
-            for iid in focus_map[patient_id]:
-                if iid in imaging_ids_list:
-                    try:
-                        analyze_imaging_with_display(iid)
-                    except Exception as e:
-                        print(f"DEBUG: Failed to display focused image {iid}: {e}")
-                else:
-                    print(f"DEBUG: Focus image {iid} not found in imaging_ids_list")
+        agent_pool.warm(AGENT_POOL_WARM)
+        print(f"DEBUG: Agent pool warmed ({agent_pool.built} set(s) built)")
     except Exception as e:
-        print(f"DEBUG: Error while attempting focused image display: {e}")
+        # Not fatal: checkout() builds a set on demand
+        print(f"DEBUG: Could not warm agent pool: {e}")
+
+
+threading.Thread(target=_warm_agent_pool, name="agent-pool-warm", daemon=True).start()
+
+
+def setup_and_run_workflow(patient_id: str):
+    """
+    Checks out an agent set and runs the 3-stage diagnosis workflow.
+    """
+    print(f"DEBUG: Starting workflow for {patient_id}")
+    try:
+        with agent_pool.checkout() as agents:
+            print(f"DEBUG: Agent set {agents.sessions} session(s) old; {agent_pool.built} set(s) built")
+            run_workflow(agents, patient_id)
+    except TimeoutError as e:
+        print(f"DEBUG: {e}")
+        cl.run_sync(cl.Message(content="All diagnosis teams are busy. Please try again shortly.", author="System").send())
+
+
+def run_workflow(agents: AgentSet, patient_id: str):
+    """
+    Runs the 3-stage diagnosis workflow on a checked-out agent set.
+    """
+    user_proxy = agents.user_proxy
+    groupchat = agents.groupchat
+    lead_consultant = agents.lead_consultant
+
+    def run_diagnosis_stage(message, clear_history=True):
+        # Concurrent: Structuralist and Physiologist answer in parallel and the
+        # Lead Consultant judges their merged findings; otherwise serial GroupChat
+        # turns, ended by the speaker selector. Posted messages (findings, verdict)
+        # reach the UI through user_proxy.receive. Without a pre-assembled case
+        # context the data comes from the Assessment agent's tool calls, which
+        # only the GroupChat runs.
+        if SPECIALIST_EXECUTION == "concurrent" and case_context:
+            result = concurrent_consultation(lead_consultant, groupchat, message, user_proxy, clear_history,
+                                             agents.termination)
+            print(f"DEBUG: Stage completed in {result['seconds']}s; specialists: "
+                  f"{[(f['name'], f['seconds']) for f in result['findings']]}, conflict: {result['conflict']}, "
+                  f"phenotype: {result['phenotype']}; stopped: {agents.termination.stop_reason(groupchat)}")
+            return
+        user_proxy.initiate_chat(lead_consultant, message=message, clear_history=clear_history, cache=agents.llm_cache)
+        try:
+            lead_verdict(lead_consultant, groupchat, agents.termination)
+        except Exception as e:
+            print(f"DEBUG: Lead verdict failed: {e}")
+        print(f"DEBUG: Stage stopped: {agents.termination.stop_reason(groupchat)}")
+
+    # -----------------------------------------------------------------
+    # Deterministic pre-stage: run the data and imaging tools in Python
+    # (imaging, similar cases and the embedding estimate in parallel) and
+    # hand the agents a compact case summary, so no chat rounds are spent
+    # on tool calls. For patients with a curated subset of images (e.g.
+    # demonstration or QA), only that subset is analyzed and displayed.
+    focus_map = {
+        "9001695": [
+            f"{patient_id}|20041203/00422803_1x1.jpg",
+            f"{patient_id}|20050104/10098604_2x2.jpg",
+            f"{patient_id}|20050104/10098607_2x2.jpg",
+        ]
+    }
+    case_context = ""
+    if PREASSEMBLE_CASE_CONTEXT:
+        try:
+            focus_ids = None
+            if patient_id in focus_map:
+                imaging_ids_list = load_patient_data(patient_id).get('imaging_ids', [])
+                focus_ids = [iid for iid in focus_map[patient_id] if iid in imaging_ids_list]
+                for iid in focus_map[patient_id]:
+                    if iid not in focus_ids:
+                        print(f"DEBUG: Focus image {iid} not found in imaging_ids_list")
+                cl.run_sync(cl.Message(content=f"🔎 Displaying selected images for {patient_id}", author="System").send())
+
+            context = assemble_case_context(patient_id, image_ids=focus_ids)
+            summary = summarize_case(context)
+            if "error" in summary:
+                # Leave the lookup to the agents' tool calls rather than hand them an error
+                raise RuntimeError(summary["error"])
+            case_context = format_case_context(summary)
+            print(f"DEBUG: Pre-assembled case data: {prestage_stats(context, case_context)}")
+
+            for iid, result in context["imaging"].items():
+                try:
+                    display_imaging_result(iid, result)
+                except Exception as e:
+                    print(f"DEBUG: Failed to display image {iid}: {e}")
+        except Exception as e:
+            print(f"DEBUG: No pre-assembled case context: {e}")
 
     # ---------------------------------------------------------------------
     # STAGE 1: Primary Consultation
@@ -273,12 +324,19 @@ def setup_and_run_workflow(patient_id: str):
             )
     except Exception:
         pass
+    assessment_instruction = f"Use 'load_patient_data' tool to fetch demographics, history, biomarker data, and imaging_ids for Patient {patient_id}."
+    if case_context:
+        # Tools already ran in the pre-stage; agents only interpret the results
+        assessment_instruction = "Summarize the pre-assembled patient profile below (no tool call needed)."
+        analyze_instruction = "Interpret the pre-assembled imaging findings below; call 'analyze_imaging' only for images missing from them."
 
     initial_message = f"""
     START DIAGNOSIS for Patient ID: {patient_id}.
+
+    {case_context}
     
     STAGE 1 GOAL: 
-    1. Assessment_Agent: Use 'load_patient_data' tool to fetch demographics, history, biomarker data, and imaging_ids for Patient {patient_id}.
+    1. Assessment_Agent: {assessment_instruction}
     2. Structuralist_Agent: {analyze_instruction}
     3. Physiologist_Agent: Analyze the biomarker and clinical data.
     
@@ -288,10 +346,7 @@ def setup_and_run_workflow(patient_id: str):
     """
     
     # Initiate Chat
-    user_proxy.initiate_chat(
-        lead_consultant,
-        message=initial_message
-    )
+    run_diagnosis_stage(initial_message)
 
     # ---------------------------------------------------------------------
     # STAGE 2: Follow-Up
@@ -312,6 +367,12 @@ def setup_and_run_workflow(patient_id: str):
             )
     except Exception:
         pass
+    if case_context:
+        # History is cleared between stages; restate the baseline data instead of re-running tools
+        follow_up_analyze_instruction = (
+            "Structuralist_Agent: Re-evaluate imaging against the baseline findings below (no tool calls needed).\n"
+            + case_context
+        )
 
     Task = "Re-evaluate phenotype based on this progression."
     Lead = "Lead Consultant: Finalize phenotype (Rapid Progressor vs Others)."
@@ -328,11 +389,7 @@ def setup_and_run_workflow(patient_id: str):
     {Lead}
     """
     
-    user_proxy.initiate_chat(
-        lead_consultant,
-        message=follow_up_message,
-        clear_history=True # Reset chat to avoid tool call errors
-    )
+    run_diagnosis_stage(follow_up_message, clear_history=True) # Reset chat to avoid tool call errors
 
     # ---------------------------------------------------------------------
     # STAGE 3: Therapy
@@ -348,8 +405,11 @@ def setup_and_run_workflow(patient_id: str):
     user_proxy.initiate_chat(
         lead_consultant,
         message=therapy_message,
-        clear_history=True # Reset chat
+        clear_history=True, # Reset chat
+        cache=agents.llm_cache
     )
+    print(f"DEBUG: Chat stopped: {agents.termination.stop_reason(groupchat)}")
+    print(f"DEBUG: LLM cache: {agents.llm_cache.stats() if agents.llm_cache else 'off'}")
     
     cl.run_sync(cl.Message(content="### Diagnosis Complete", author="System").send())
 
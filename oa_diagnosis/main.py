@@ -14,6 +14,28 @@ from oa_diagnosis.tools.oai_data_loader import load_patient_data
 from oa_diagnosis.tools.imaging_analysis import analyze_imaging
 from oa_diagnosis.tools.clinical_analysis import analyze_contraindications, get_treatment_guidelines
 from oa_diagnosis.tools.similarity_search import find_similar_cases
+from oa_diagnosis.tools.linear_probe import predict_from_embedding
+from oa_diagnosis.agents.context_assembly import assemble_case_context, format_case_context, prestage_stats, summarize_case
+from oa_diagnosis.agents.speaker_selection import WorkflowSpeakerSelector, lead_verdict
+from oa_diagnosis.agents.concurrent_specialists import SPECIALIST_EXECUTION, concurrent_consultation
+from oa_diagnosis.agents.llm_cache import get_llm_cache, use_llm_cache
+from oa_diagnosis.agents.local_llm import register_local_clients
+from oa_diagnosis.agents.termination import WorkflowTermination
+
+def run_diagnosis_stage(user_proxy, lead_consultant, groupchat, message, clear_history=True, cache=None, termination=None):
+    # Concurrent: Structuralist and Physiologist answer in parallel (the patient
+    # profile is pre-assembled, so no intake turn); otherwise serial GroupChat turns
+    if SPECIALIST_EXECUTION == "concurrent":
+        result = concurrent_consultation(lead_consultant, groupchat, message, user_proxy, clear_history, termination)
+        for finding in result["findings"] + result["debate"]:
+            print(f"\n{finding['name']} ({finding['seconds']}s): {finding['content']}")
+        print(f"\nLead_Consultant_Agent: {result['verdict']}")
+        print(f"(stage completed in {result['seconds']}s; phenotype: {result['phenotype']})")
+        return
+    user_proxy.initiate_chat(lead_consultant, message=message, clear_history=clear_history, cache=cache)
+    print(f"\nLead_Consultant_Agent: {lead_verdict(lead_consultant, groupchat, termination)}")
+    if termination is not None:
+        print(f"(stage stopped: {termination.stop_reason(groupchat)})")
 
 def main():
     print("Initializing OA Diagnosis Multi-Agent System (Refactored)...")
@@ -41,18 +63,27 @@ def main():
     user_proxy.register_for_execution(name="analyze_contraindications")(analyze_contraindications)
     user_proxy.register_for_execution(name="get_treatment_guidelines")(get_treatment_guidelines)
     user_proxy.register_for_execution(name="find_similar_cases")(find_similar_cases)
+    user_proxy.register_for_execution(name="predict_from_embedding")(predict_from_embedding)
     
     # 4. Create Group Chat for Diagnosis
     # We include therapy manager in the group but the orchestrator will manage the flow.
+    # Speakers follow the workflow rules; the LLM picks only when the state is ambiguous.
     groupchat = autogen.GroupChat(
         agents=[user_proxy, assessment_agent, structuralist_agent, physiologist_agent, therapy_manager], 
         messages=[], 
         max_round=30,
-        speaker_selection_method="auto" # Orchestrator determines order usually or auto
+        speaker_selection_method=WorkflowSpeakerSelector()
     )
     
     # 5. Create Lead Consultant (Orchestrator)
-    lead_consultant = create_lead_consultant_agent(groupchat)
+    # The chat ends as soon as the phenotype or the therapy plan is delivered
+    termination = WorkflowTermination()
+    lead_consultant = create_lead_consultant_agent(groupchat, is_termination_msg=termination)
+    register_local_clients(groupchat.agents + [lead_consultant], groupchat)
+
+    # Identical prompts (e.g. re-running a patient) are answered from the disk cache
+    llm_cache = get_llm_cache()
+    use_llm_cache(groupchat.agents + [lead_consultant], llm_cache)
     
     # 6. Start the process - Real Data Mode
     print("\n--- STAGE 1: Primary Consultation ---")
@@ -61,24 +92,31 @@ def main():
         patient_id = "9001695" # Default to a known ID if empty
     
     print(f"Starting diagnosis for Patient ID: {patient_id}...")
+
+    # Deterministic pre-stage: patient data, imaging, similar cases and the
+    # embedding estimate are computed here, so no chat rounds go to tool calls
+    context = assemble_case_context(patient_id)
+    case_context = format_case_context(summarize_case(context))
+    stats = prestage_stats(context, case_context)
+    print(f"Pre-assembled case data: {stats['tool_calls_prerun']} tool calls run in Python, "
+          f"{stats['summary_tokens']} tokens of summary")
     
     initial_message = f"""
     START DIAGNOSIS for Patient ID: {patient_id}.
+
+    {case_context}
     
     STAGE 1 GOAL: 
-    1. Assessment_Agent: Use 'load_patient_data' tool to fetch demographics, history, and biomarker data for Patient {patient_id}.
-    2. Structuralist & Physiologist: Analyze the retrieved data.
-    3. Structuralist: Compare Imaging findings (simulate reading "IMG_Baseline" if specific IDs missing).
+    1. Assessment_Agent: Summarize the pre-assembled patient profile above (no tool call needed).
+    2. Structuralist & Physiologist: Analyze the pre-assembled data.
+    3. Structuralist: Interpret the imaging findings above; call 'analyze_imaging' only for images missing from them.
     
     Determine if there is a conflict between Structural/Imaging status and Clinical/Biomarker risk.
     
     Lead Consultant: Monitor for conflict and organize the debate if needed.
     """
     
-    user_proxy.initiate_chat(
-        lead_consultant,
-        message=initial_message
-    )
+    run_diagnosis_stage(user_proxy, lead_consultant, groupchat, initial_message, cache=llm_cache, termination=termination)
     
     # Optional: We can still do the simulated follow-up or try to fetch real longitudinal data if available.
     # For now, we will simulate the follow-up 'time jump' but using the REAL baseline we just found as context.
@@ -96,11 +134,7 @@ def main():
     Lead Consultant: Finalize phenotype (Rapid Progressor vs Others).
     """
     
-    user_proxy.initiate_chat(
-        lead_consultant,
-        message=follow_up_message,
-        clear_history=False # Keep context
-    )
+    run_diagnosis_stage(user_proxy, lead_consultant, groupchat, follow_up_message, clear_history=False, cache=llm_cache, termination=termination) # Keep context
 
     print("\n--- STAGE 3: Therapy Generation ---")
     therapy_message = """
@@ -112,8 +146,12 @@ def main():
     user_proxy.initiate_chat(
         lead_consultant,
         message=therapy_message,
-        clear_history=False
+        clear_history=False,
+        cache=llm_cache
     )
+    print(f"(chat stopped: {termination.stop_reason(groupchat)})")
+    if llm_cache is not None:
+        print(f"\nLLM cache: {llm_cache.stats()}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,123 @@
+"""
+Offline end-to-end benchmark of the 3-stage workflow (app.setup_and_run_workflow)
+on the local scripted LLM backend: no network, no API key, configurable
+simulated LLM latency. The Chainlit UI calls are replaced by a counting sink.
+With --latency 0 the session time is the orchestration overhead alone (agent
+checkout, case assembly, tools, chat bookkeeping). --no-preassembly skips
+the Python pre-stage, so the agents fetch the data with scripted
+load_patient_data / analyze_imaging tool calls. --compare-preassembly runs
+each patient both ways, in groupchat execution, and reports the LLM calls
+and tokens the pre-stage removes.
+
+    python oa_diagnosis/scripts/benchmark_workflow.py 9001695 9003406 --runs 3 --latency 0.2
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from oa_diagnosis.agents import llm_cache
+from oa_diagnosis.agents.context_assembly import measure_context_savings
+from oa_diagnosis.agents.local_llm import LocalScriptedClient, use_local_backend
+
+
+class HeadlessUI:
+    """Stands in for the chainlit module in app.py: messages are counted, not sent."""
+
+    def __init__(self):
+        self.messages = 0
+        self._lock = threading.Lock()
+        ui = self
+
+        class Message:
+            def __init__(self, content="", elements=None, author=None, **kwargs):
+                self.content = content
+
+            def send(self):
+                with ui._lock:
+                    ui.messages += 1
+
+        class Image:
+            def __init__(self, **kwargs):
+                pass
+
+        self.Message = Message
+        self.Image = Image
+
+    def run_sync(self, result):
+        return result
+
+
+def run_once(app, patient_id: str) -> float:
+    start = time.perf_counter()
+    app.setup_and_run_workflow(patient_id)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the diagnosis workflow offline on the local scripted LLM backend.")
+    parser.add_argument("patient_ids", nargs="*", default=["9001695"])
+    parser.add_argument("--runs", type=int, default=1, help="Passes over the patient list")
+    parser.add_argument("--concurrency", type=int, default=1, help="Sessions run at once")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per LLM reply")
+    parser.add_argument("--seconds-per-token", type=float, default=0.0, help="Simulated seconds per completion token")
+    parser.add_argument("--execution", choices=["concurrent", "groupchat"], default=None,
+                        help="Specialist execution mode (default: SPECIALIST_EXECUTION)")
+    parser.add_argument("--no-preassembly", action="store_true",
+                        help="Leave the Stage 1 data tools to the agents' tool calls (PREASSEMBLE_CASE_CONTEXT = False)")
+    parser.add_argument("--compare-preassembly", action="store_true",
+                        help="Run each patient with and without the pre-stage (both in groupchat execution, "
+                             "--execution is ignored) and report the LLM calls and tokens it removes")
+    parser.add_argument("--cache", action="store_true", help="Keep the LLM response cache on (off by default, so every reply is generated)")
+    args = parser.parse_args()
+
+    use_local_backend(args.latency, args.seconds_per_token)
+    if not args.cache:
+        llm_cache.LLM_CACHE_MODE = "off"
+
+    from oa_diagnosis import app
+    ui = HeadlessUI()
+    app.cl = ui
+    if args.execution:
+        app.SPECIALIST_EXECUTION = args.execution
+    if args.no_preassembly:
+        app.PREASSEMBLE_CASE_CONTEXT = False
+
+    if args.compare_preassembly:
+        # Without the pre-stage the specialists always run as a group chat, so
+        # both runs are pinned to it; otherwise the difference would mix the
+        # pre-stage with the execution mode
+        app.SPECIALIST_EXECUTION = "groupchat"
+
+        def run_session(pid, preassemble):
+            app.PREASSEMBLE_CASE_CONTEXT = preassemble
+            run_once(app, pid)
+
+        for pid in args.patient_ids:
+            runs = measure_context_savings(lambda preassemble: run_session(pid, preassemble))
+            for label, counts in runs.items():
+                print(f"{pid} {label}: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+        sys.exit(0)
+
+    sessions = [pid for _ in range(args.runs) for pid in args.patient_ids]
+    LocalScriptedClient.reset_counters()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        durations = list(pool.map(lambda pid: run_once(app, pid), sessions))
+    elapsed = time.perf_counter() - start
+
+    for pid, seconds in zip(sessions, durations):
+        print(f"{pid}: {seconds:.3f}s")
+    llm_seconds = LocalScriptedClient.simulated_seconds
+    print(f"{len(sessions)} sessions in {elapsed:.3f}s ({len(sessions) / elapsed:.2f}/s, concurrency {args.concurrency})")
+    print(f"LLM calls: {LocalScriptedClient.calls} ({LocalScriptedClient.calls / len(sessions):.1f} per session), "
+          f"tool calls: {LocalScriptedClient.tool_calls}, simulated LLM time {llm_seconds:.3f}s")
+    # With no simulated latency the whole session time is orchestration overhead;
+    # with latency, concurrent specialist calls overlap, so compare the two runs
+    label = "orchestration overhead" if args.latency == 0 and args.seconds_per_token == 0 else "mean session"
+    print(f"{label}: {sum(durations) / len(sessions):.3f}s; UI messages: {ui.messages}; "
+          f"agent sets built: {app.agent_pool.built}")
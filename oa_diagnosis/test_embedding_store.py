@@ -0,0 +1,36 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pickle
+import tempfile
+import numpy as np
+
+from oa_diagnosis.tools.embedding_index import get_embedding_index
+from oa_diagnosis.tools.embedding_store import append_embeddings, has_store
+
+
+def test_append_to_pickle_only_embeddings():
+    """
+    Appending to embeddings that exist only as a pickle must keep the
+    pickled patients: the new store is what get_embedding_index serves.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "xray_embeddings.pkl")
+        with open(path, "wb") as f:
+            pickle.dump({str(9000000 + i): rng.normal(size=8) for i in range(5)}, f)
+        old = len(get_embedding_index(path))
+
+        new_ids = ["9100001", "9100002"]
+        added = append_embeddings(path, new_ids, rng.normal(size=(2, 8)))
+        index = get_embedding_index(path)
+
+        print(f"pickle: {old} patients, appended: {added}, index: {len(index)}")
+        assert has_store(path)
+        assert added == len(new_ids)
+        assert len(index) == old + len(new_ids)
+        assert "9000000" in index and "9100002" in index
+
+
+if __name__ == "__main__":
+    test_append_to_pickle_only_embeddings()
@@ -0,0 +1,107 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex
+from oa_diagnosis.tools.fusion_index import FusionIndex
+from oa_diagnosis.tools.hybrid_retrieval import CLINICAL_FEATURES, HybridRetriever, kl_grade_of, sex_code_of
+
+
+def _frame():
+    # 100 is the query patient: 101 is its clinical twin, 103 is out of the
+    # KL window, 104 is male
+    rows = [
+        # ID, sex, age, bmi, KL
+        (100, "2: Female", 60, 25.0, "2:02:00"),
+        (101, "2: Female", 61, 25.0, "2:02:00"),
+        (102, "2: Female", 70, 30.0, "3:03:00"),
+        (103, "2: Female", 60, 25.0, "4:04:00"),
+        (104, "1: Male", 60, 25.0, "2:02:00"),
+        (105, "2: Female", 62, 26.0, "1:01:00"),
+    ]
+    frame = pd.DataFrame({
+        "ID": [r[0] for r in rows],
+        "SIDE": ["1: Right"] * len(rows),
+        CLINICAL_FEATURES["sex"]: [r[1] for r in rows],
+        CLINICAL_FEATURES["age"]: [r[2] for r in rows],
+        CLINICAL_FEATURES["bmi"]: [r[3] for r in rows],
+        CLINICAL_FEATURES["kl_grade"]: [r[4] for r in rows],
+    })
+    for feature, column in CLINICAL_FEATURES.items():
+        if column not in frame:
+            frame[column] = 1.0
+    return frame
+
+
+def _ids(results):
+    return [r["case_id"] for r in results]
+
+
+def test_value_parsing():
+    assert kl_grade_of("2:02:00") == 2
+    assert kl_grade_of(3.0) == 3
+    assert kl_grade_of(None) is None
+    assert kl_grade_of("missing") is None
+    assert sex_code_of("1: Male") == 1
+    assert sex_code_of("F") == 2
+    assert sex_code_of(2.0) == 2
+    assert sex_code_of("unknown") is None
+
+
+def test_query_vector_text_values():
+    retriever = HybridRetriever(_frame())
+    age, bmi = retriever.features.index("age"), retriever.features.index("bmi")
+    raw, _, present = retriever.query_vector({"age": "61", "bmi": " 25.5 ", "sex": "Female", "kl_grade": "2"})
+    assert raw[age] == 61 and raw[bmi] == 25.5
+    assert raw[retriever.features.index("sex")] == 2 and raw[retriever.features.index("kl_grade")] == 2
+    # Unparseable text keeps the patient's own value
+    raw, _, present = retriever.query_vector({"age": "n/a"}, patient_id="102")
+    assert raw[age] == 70 and present[age]
+    raw, _, present = retriever.query_vector({"age": np.int64(65), "bmi": True})
+    assert raw[age] == 65 and not present[bmi]
+
+
+def test_search_filters():
+    retriever = HybridRetriever(_frame())
+    # Same sex, KL within 1, never the query patient, clinical twin first
+    assert _ids(retriever.search({}, patient_id="100", k=5)) == ["101", "105", "102"]
+    assert "104" in _ids(retriever.search({}, patient_id="100", k=5, same_sex=False))
+    assert "103" in _ids(retriever.search({}, patient_id="100", k=5, kl_window=None))
+    assert _ids(retriever.search({"age": "61", "sex": "F", "kl_grade": "2"}, k=1)) == ["101"]
+    batch = retriever.search_batch([{"patient_id": "100"}, {"patient_id": 104}], k=1, same_sex=False)
+    assert [_ids(results) for results in batch] == [["101"], ["100"]]
+
+
+def test_search_with_embeddings():
+    vectors = np.eye(4, dtype=np.float32)
+    # 102 shares 100's embedding, 105 is orthogonal to it, 101 has none
+    index = EmbeddingIndex(["100", "102", "105"], np.stack([vectors[0], vectors[0], vectors[1]]))
+    retriever = HybridRetriever(_frame(), index)
+    results = retriever.search({}, patient_id="100", k=5, embedding_weight=1.0)
+    # 101 has no score, so it gets the median scaled score (0.5)
+    assert _ids(results) == ["102", "101", "105"]
+    assert results[0]["embedding_similarity"] == 1.0
+    assert results[1]["embedding_similarity"] is None
+    assert results[1]["similarity_score"] == 0.5
+
+
+def test_search_with_fusion_index():
+    vectors = np.eye(4, dtype=np.float32)
+    xray = EmbeddingIndex(["100", "102", "105"], np.stack([vectors[0], vectors[0], vectors[1]]))
+    mri = EmbeddingIndex(["100", "105"], np.stack([vectors[2], vectors[2]]))
+    retriever = HybridRetriever(_frame(), FusionIndex(xray, mri))
+    results = retriever.search({}, patient_id="100", k=5, embedding_weight=1.0)
+    scores = {r["case_id"]: r["embedding_similarity"] for r in results}
+    # 102 shares only the X-ray (cosine 1); 105 averages X-ray 0 and MRI 1
+    assert scores == {"102": 1.0, "105": 0.5, "101": None}
+    assert _ids(results) == ["102", "101", "105"]
+
+
+if __name__ == "__main__":
+    test_value_parsing()
+    test_query_vector_text_values()
+    test_search_filters()
+    test_search_with_embeddings()
+    test_search_with_fusion_index()
@@ -0,0 +1,97 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tempfile
+
+from oa_diagnosis.agents import llm_cache
+from oa_diagnosis.agents.llm_cache import LLMCacheMiss, SQLiteLLMCache
+
+
+class _Clock:
+    """Stands in for the time module inside llm_cache, so TTL and LRU order do not depend on sleeps."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def _with_cache(test, **kwargs):
+    clock, real_time = _Clock(), llm_cache.time
+    llm_cache.time = clock
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SQLiteLLMCache(os.path.join(tmp, "llm.sqlite"), **kwargs)
+            try:
+                test(cache, clock)
+            finally:
+                cache.close()
+    finally:
+        llm_cache.time = real_time
+
+
+def test_read_write_and_replay():
+    def check(cache, clock):
+        assert cache.get("prompt-a") is None
+        cache.set("prompt-a", {"choices": ["reply a"]})
+        assert cache.get("prompt-a") == {"choices": ["reply a"]}
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+        replay = SQLiteLLMCache(cache.db_path, mode="replay")
+        try:
+            assert replay.get("prompt-a") == {"choices": ["reply a"]}
+            # Replay never writes and fails on a miss instead of calling the LLM
+            replay.set("prompt-b", {"choices": ["reply b"]})
+            try:
+                replay.get("prompt-b")
+                assert False, "replay served a response that was never cached"
+            except LLMCacheMiss:
+                pass
+        finally:
+            replay.close()
+    _with_cache(check)
+
+
+def test_ttl_expiry():
+    def check(cache, clock):
+        cache.set("prompt-a", "reply a")
+        clock.now += 50
+        assert cache.get("prompt-a") == "reply a"
+        clock.now += 51
+        # Expired entries are misses, and are purged on read
+        assert cache.get("prompt-a") is None
+        assert cache.stats()["entries"] == 0
+        cache.set("prompt-a", "reply a2")
+        assert cache.get("prompt-a") == "reply a2"
+    _with_cache(check, ttl=100)
+
+
+def test_lru_eviction():
+    def check(cache, clock):
+        for key in ("a", "b", "c"):
+            cache.set(key, key.upper())
+            clock.now += 1
+        # 'a' is read, so 'b' is now the least recently used
+        assert cache.get("a") == "A"
+        clock.now += 1
+        cache.set("d", "D")
+        assert cache.evictions == 1
+        assert cache.get("b") is None
+        assert [cache.get(key) for key in ("a", "c", "d")] == ["A", "C", "D"]
+        # Overwriting a key does not count as a new entry
+        cache.set("d", "D2")
+        assert cache.evictions == 1
+        assert cache.stats()["entries"] == 3
+    _with_cache(check, max_entries=3)
+
+
+def test_get_llm_cache_off():
+    assert llm_cache.get_llm_cache(mode="off") is None
+
+
+if __name__ == "__main__":
+    test_read_write_and_replay()
+    test_ttl_expiry()
+    test_lru_eviction()
+    test_get_llm_cache_off()
@@ -0,0 +1,133 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import autogen
+
+from oa_diagnosis.agents.speaker_selection import (
+    ASSESSMENT, PHYSIOLOGIST, STRUCTURALIST, THERAPY,
+    WorkflowSpeakerSelector, assess_conflict, stated_conflict
+)
+
+
+def _groupchat():
+    agents = [autogen.ConversableAgent(name, llm_config=False, human_input_mode="NEVER")
+              for name in (ASSESSMENT, STRUCTURALIST, PHYSIOLOGIST, THERAPY)]
+    return autogen.GroupChat(agents=agents, messages=[], max_round=30)
+
+
+def _say(groupchat, name, content):
+    groupchat.messages.append({"role": "user", "name": name, "content": content})
+
+
+def test_stated_conflict_phrasings():
+    asserted = [
+        "The findings conflict with each other.",
+        "Imaging and biomarkers disagree.",
+        "Conflict: Yes - KL 1 with high biomarker risk.",
+        "Is there a conflict? Yes.",
+        "No conflict in staging, but imaging and biomarkers disagree on severity.",
+    ]
+    denied = [
+        "No conflict between imaging and biomarkers.",
+        "Findings are not in conflict.",
+        "There is no discordance.",
+        "I don't disagree with the Structuralist.",
+        "A conflict-free picture.",
+        "Conflict: No",
+        "Is there a conflict? No.",
+        "Conflict assessment: none.",
+        "Structural/clinical conflict: absent",
+        "**Conflict:** **None**",
+    ]
+    neutral = [
+        "KL grade 2 on baseline imaging.",
+        "Determine if there is a conflict between imaging and biomarkers.",
+        "Conflict assessment: pending the Physiologist's findings.",
+        "Is there a conflict?",
+    ]
+    for text in asserted:
+        assert stated_conflict(text) is True, text
+    for text in denied:
+        assert stated_conflict(text) is False, text
+    for text in neutral:
+        assert stated_conflict(text) is None, text
+
+
+def test_assess_conflict_rules():
+    # A denial does not override the KL / risk rule, and does not start a debate on its own
+    assert assess_conflict("KL grade 3. Conflict: none.", "Biomarkers unremarkable: low risk of progression.") is True
+    assert assess_conflict("KL grade 2.", "Is there a conflict? No. Low risk of progression.") is False
+    assert assess_conflict("Imaging reviewed.", "Conflict assessment: none.") is False
+    assert assess_conflict("Imaging reviewed.", "Noted.") is None
+    assert assess_conflict("KL grade 1.", "Biomarkers elevated: high risk of progression.") is True
+
+
+def test_selector_primary_stage_and_debate():
+    groupchat = _groupchat()
+    selector = WorkflowSpeakerSelector(max_llm_fallbacks=0)
+    _say(groupchat, "Admin_User", "START DIAGNOSIS for Patient ID: 9001695.")
+    assert selector.select(None, groupchat).name == ASSESSMENT
+    _say(groupchat, ASSESSMENT, "Profile summarized.")
+    assert selector.select(None, groupchat).name == STRUCTURALIST
+    _say(groupchat, STRUCTURALIST, "KL grade 1 on baseline imaging.")
+    assert selector.select(None, groupchat).name == PHYSIOLOGIST
+    _say(groupchat, PHYSIOLOGIST, "Biomarkers elevated: high risk of progression.")
+    # KL < 2 with high risk: one debate round, then the round ends
+    assert selector.select(None, groupchat).name == PHYSIOLOGIST
+    _say(groupchat, PHYSIOLOGIST, "Biomarkers predict progression.")
+    assert selector.select(None, groupchat).name == STRUCTURALIST
+    _say(groupchat, STRUCTURALIST, "Imaging remains mild.")
+    assert selector.select(None, groupchat) is None
+
+
+def test_selector_denied_conflict_ends_round():
+    groupchat = _groupchat()
+    selector = WorkflowSpeakerSelector(max_llm_fallbacks=0)
+    _say(groupchat, "Admin_User", "STAGE 2: FOLLOW-UP (4 YEARS LATER) for Patient 9001695.")
+    _say(groupchat, STRUCTURALIST, "Imaging re-evaluated. Conflict: none.")
+    _say(groupchat, PHYSIOLOGIST, "Is there a conflict? No.")
+    assert selector.select(None, groupchat) is None
+
+
+def test_selector_empty_reply_counts_as_turn():
+    groupchat = _groupchat()
+    selector = WorkflowSpeakerSelector(max_llm_fallbacks=0)
+    _say(groupchat, "Admin_User", "STAGE 2: FOLLOW-UP (4 YEARS LATER) for Patient 9001695.")
+    _say(groupchat, STRUCTURALIST, "")
+    assert selector.select(None, groupchat).name == PHYSIOLOGIST
+
+
+def test_selector_resets_fallbacks_per_stage():
+    groupchat = _groupchat()
+    selector = WorkflowSpeakerSelector(max_llm_fallbacks=1)
+    # A tool nobody can execute is left to the LLM, once per stage
+    unknown_tool = {"role": "assistant", "name": STRUCTURALIST, "content": None,
+                    "tool_calls": [{"id": "call_0", "type": "function", "function": {"name": "unknown", "arguments": "{}"}}]}
+    _say(groupchat, "Admin_User", "START DIAGNOSIS for Patient ID: 9001695.")
+    groupchat.messages.append(dict(unknown_tool))
+    assert selector.select(None, groupchat) == "auto"
+    assert selector.select(None, groupchat) is None
+    # clear_history: the next stage starts again at index 0
+    groupchat.messages.clear()
+    _say(groupchat, "Admin_User", "STAGE 2: FOLLOW-UP (4 YEARS LATER) for Patient 9001695.")
+    groupchat.messages.append(dict(unknown_tool))
+    assert selector.select(None, groupchat) == "auto"
+
+
+def test_selector_therapy_stage():
+    groupchat = _groupchat()
+    selector = WorkflowSpeakerSelector(max_llm_fallbacks=0)
+    _say(groupchat, "Admin_User", "STAGE 3: THERAPY GENERATION for Patient 9001695.")
+    assert selector.select(None, groupchat).name == THERAPY
+    _say(groupchat, THERAPY, '{"plan": ["Exercise", "Weight management"]}')
+    assert selector.select(None, groupchat) is None
+
+
+if __name__ == "__main__":
+    test_stated_conflict_phrasings()
+    test_assess_conflict_rules()
+    test_selector_primary_stage_and_debate()
+    test_selector_denied_conflict_ends_round()
+    test_selector_empty_reply_counts_as_turn()
+    test_selector_resets_fallbacks_per_stage()
+    test_selector_therapy_stage()
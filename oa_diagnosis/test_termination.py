@@ -0,0 +1,91 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import autogen
+
+from oa_diagnosis.agents.speaker_selection import LEAD_CONSULTANT, STRUCTURALIST, THERAPY
+from oa_diagnosis.agents.termination import WorkflowTermination, parse_phenotype, parse_therapy_plan
+
+
+def _groupchat(max_round=30):
+    agents = [autogen.ConversableAgent(name, llm_config=False, human_input_mode="NEVER")
+              for name in (STRUCTURALIST, THERAPY)]
+    return autogen.GroupChat(agents=agents, messages=[], max_round=max_round)
+
+
+def _message(name, content):
+    return {"role": "user", "name": name, "content": content}
+
+
+def test_parse_phenotype():
+    assert parse_phenotype("Final phenotype: Rapid Progressor.") == "Rapid Progressor"
+    assert parse_phenotype("The phenotype is **non-progressor** given stable imaging.") == "Non-Progressor"
+    assert parse_phenotype("Phenotype = SP") == "Slow Progressor"
+    assert parse_phenotype('{"phenotype": "Combined (structural + biomarker)", "confidence": 0.7}') == "Combined"
+    assert parse_phenotype('```json\n{"phenotype": "Rapid Progressor"}\n```') == "Rapid Progressor"
+    assert parse_phenotype('{"phenotype": "Unclear"}') is None
+    assert parse_phenotype("Rapid progressors are discussed in the literature.") is None
+    assert parse_phenotype("") is None
+    assert parse_phenotype(None) is None
+
+
+def test_parse_therapy_plan():
+    assert parse_therapy_plan('{"plan": ["Exercise", "Weight management"]}') == ["Exercise", "Weight management"]
+    assert parse_therapy_plan('{"recommendations": {"exercise": "3x weekly"}}') == ["exercise: 3x weekly"]
+    assert parse_therapy_plan('{"plan": [{"step": "NSAIDs"}]}') == ['{"step": "NSAIDs"}']
+    # A JSON reply without a plan is not read as a list
+    assert parse_therapy_plan('{"plan": []}') is None
+    assert parse_therapy_plan('{"notes": "- Exercise\\n- Bracing"}') is None
+    assert parse_therapy_plan("Plan:\n1. Physiotherapy\n2) Weight loss\n- Topical NSAIDs") == [
+        "1. Physiotherapy", "2) Weight loss", "- Topical NSAIDs"]
+    # Fewer than MIN_PLAN_ITEMS list items is not a plan
+    assert parse_therapy_plan("- Exercise only") is None
+    assert parse_therapy_plan("We will discuss therapy next.") is None
+
+
+def test_termination_predicate():
+    termination = WorkflowTermination()
+    plan = '{"plan": ["Exercise", "Weight management"]}'
+    assert termination(_message(THERAPY, plan)) is True
+    assert termination.events[-1]["reason"] == "therapy_plan"
+    assert termination.events[-1]["plan_items"] == 2
+    # Only the configured speakers, and never stage openings or tool results
+    assert termination(_message(STRUCTURALIST, plan)) is False
+    assert termination(_message(THERAPY, "STAGE 3: THERAPY GENERATION\n- Exercise\n- Bracing")) is False
+    assert termination({"role": "tool", "name": THERAPY, "content": plan,
+                        "tool_responses": [{"tool_call_id": "call_0", "role": "tool", "content": plan}]}) is False
+    assert termination(_message(LEAD_CONSULTANT, "Final phenotype: Slow Progressor")) is True
+    assert termination.events[-1]["phenotype"] == "Slow Progressor"
+    termination.reset()
+    assert termination.events == []
+
+
+def test_stop_reason():
+    termination = WorkflowTermination()
+    groupchat = _groupchat()
+    groupchat.messages.append(_message("Admin_User", "STAGE 3: THERAPY GENERATION for Patient 9001695."))
+    plan = _message(THERAPY, '{"plan": ["Exercise", "Weight management"]}')
+    groupchat.messages.append(plan)
+    termination(plan)
+    assert termination.stop_reason(groupchat) == {
+        "reason": "therapy_plan", "speaker": THERAPY, "plan_items": 2, "rounds": 2}
+
+    # The selector ended the next stage without a verdict
+    groupchat.messages.clear()
+    groupchat.messages.append(_message("Admin_User", "STAGE 2: FOLLOW-UP (4 YEARS LATER) for Patient 9001695."))
+    groupchat.messages.append(_message(STRUCTURALIST, "Imaging re-evaluated."))
+    assert termination.stop_reason(groupchat) == {"reason": "workflow_complete", "rounds": 2}
+
+    # Rounds are counted from the last stage opening
+    groupchat = _groupchat(max_round=3)
+    groupchat.messages.append(_message(STRUCTURALIST, "Earlier stage."))
+    groupchat.messages.append(_message("Admin_User", "START DIAGNOSIS for Patient ID: 9001695."))
+    groupchat.messages.extend(_message(STRUCTURALIST, f"Turn {i}.") for i in range(2))
+    assert termination.stop_reason(groupchat) == {"reason": "max_round", "rounds": 3}
+
+
+if __name__ == "__main__":
+    test_parse_phenotype()
+    test_parse_therapy_plan()
+    test_termination_predicate()
+    test_stop_reason()
@@ -0,0 +1,268 @@
+import os
+import time
+import argparse
+import threading
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex, embeddings_mtime, get_embedding_index, normalize_rows, top_k
+
+# Lists probed per query; higher is slower and closer to exact
+DEFAULT_NPROBE = 8
+
+# Training points per centroid used by k-means (the rest are only assigned)
+KMEANS_POINTS_PER_LIST = 64
+KMEANS_ITERATIONS = 20
+
+# Rows scored per matrix product when assigning vectors to lists
+ASSIGN_CHUNK_ROWS = 65536
+
+INDEX_VERSION = 1
+
+
+def default_nlist(n: int) -> int:
+    """Usual IVF sizing: about 4 * sqrt(n) lists, at least one."""
+    return max(1, int(4 * np.sqrt(n)))
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid (inner product) for every row."""
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_ROWS):
+        block = vectors[start:start + ASSIGN_CHUNK_ROWS]
+        out[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on L2-normalized rows (cosine similarity), trained on
+    a sample of at most KMEANS_POINTS_PER_LIST * k rows. Returns (k x dim)
+    normalized centroids. Empty clusters are re-seeded from random rows.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    sample_size = min(len(vectors), KMEANS_POINTS_PER_LIST * k)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)] if sample_size < len(vectors) else vectors
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=k)
+        # Per-cluster sums via one sort + reduceat (np.add.at is far slower)
+        order = np.argsort(labels, kind="stable")
+        sums = np.zeros_like(centroids)
+        present = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)])[present]
+        sums[present] = np.add.reduceat(sample[order], starts, axis=0)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        new_centroids = normalize_rows(sums)
+        if np.allclose(new_centroids, centroids, atol=1e-6):
+            centroids = new_centroids
+            break
+        centroids = new_centroids
+    return centroids
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Inverted-file ANN index: vectors are grouped by their nearest k-means
+    centroid and a query scores only the rows of its nprobe closest lists.
+    Drop-in replacement for EmbeddingIndex (same search/search_ids results).
+    """
+
+    approximate = True
+
+    def __init__(self, ids: Sequence[str], vectors: np.ndarray,
+                 centroids: Optional[np.ndarray] = None,
+                 assignments: Optional[np.ndarray] = None,
+                 nlist: Optional[int] = None,
+                 nprobe: int = DEFAULT_NPROBE,
+                 seed: int = 0):
+        super().__init__(ids, vectors)
+        if centroids is None:
+            centroids = kmeans(self.vectors, nlist or default_nlist(len(self.vectors)), seed=seed)
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.assignments = assign(self.vectors, self.centroids) if assignments is None else np.asarray(assignments, dtype=np.int32)
+        self.nprobe = nprobe
+        self._build_lists()
+
+    def _build_lists(self):
+        # CSR layout: rows of list i are order[offsets[i]:offsets[i + 1]]
+        self.order = np.argsort(self.assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        """Append vectors to their nearest existing lists (centroids are not retrained)."""
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, np.asarray([str(i) for i in ids])])
+        self.vectors = np.ascontiguousarray(np.concatenate([self.vectors, vectors]))
+        self.assignments = np.concatenate([self.assignments, assign(vectors, self.centroids)])
+        for offset, pid in enumerate(self.ids[start:].tolist()):
+            self._row[pid] = start + offset
+        self._build_lists()
+
+    def _probed_rows(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes, _ = top_k(query[np.newaxis, :] @ self.centroids.T, nprobe)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probes[0]])
+
+    def similarities(self, patient_id: str, nprobe: Optional[int] = None) -> Optional[np.ndarray]:
+        """
+        Cosine similarity of one patient to the rows of its nprobe closest
+        lists; NaN for rows that were not scored. None if not indexed.
+        """
+        query = self.vector(patient_id)
+        if query is None:
+            return None
+        rows = self._probed_rows(query, nprobe)
+        out = np.full(len(self.ids), np.nan, dtype=np.float32)
+        out[rows] = self.vectors[rows] @ query
+        return out
+
+    def search(self, queries: np.ndarray, k: int = 5,
+               exclude: Optional[Sequence[Optional[str]]] = None,
+               nprobe: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+        queries = normalize_rows(np.atleast_2d(queries))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probes, _ = top_k(queries @ self.centroids.T, nprobe)
+
+        results = []
+        for q, query in enumerate(queries):
+            rows = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probes[q]])
+            scores = self.vectors[rows] @ query
+            if exclude is not None and exclude[q] is not None:
+                own = self._row_of(exclude[q])
+                if own is not None:
+                    scores[rows == own] = -np.inf
+            best, best_scores = top_k(scores[np.newaxis, :], k)
+            results.append([
+                (self.ids[rows[i]], float(s)) for i, s in zip(best[0], best_scores[0]) if np.isfinite(s)
+            ])
+        return results
+
+    def save(self, path: str, source_mtime: Optional[float] = None):
+        """Persist to a single .npz (written to a temp file, then moved into place)."""
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            version=INDEX_VERSION,
+            ids=self.ids,
+            vectors=self.vectors,
+            centroids=self.centroids,
+            assignments=self.assignments,
+            nprobe=self.nprobe,
+            source_mtime=np.nan if source_mtime is None else source_mtime,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                raise ValueError(f"Unsupported IVF index version in {path}")
+            return cls(data["ids"], data["vectors"], centroids=data["centroids"],
+                       assignments=data["assignments"], nprobe=int(data["nprobe"]))
+
+
+def ann_path_for(embeddings_path: str) -> str:
+    """'xray_..._train_only.pkl' -> 'xray_..._train_only.ivf.npz'"""
+    return os.path.splitext(embeddings_path)[0] + ".ivf.npz"
+
+
+def _saved_source_mtime(path: str) -> Optional[float]:
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return float(data["source_mtime"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def build_ann_index(embeddings_path: str, nlist: Optional[int] = None,
+                    nprobe: int = DEFAULT_NPROBE, out_path: Optional[str] = None) -> IVFIndex:
+    """Train an IVF index over an embedding file and save it next to it."""
+    exact = get_embedding_index(embeddings_path)
+    index = IVFIndex(exact.ids, exact.vectors, nlist=nlist, nprobe=nprobe)
+    index.save(out_path or ann_path_for(embeddings_path), source_mtime=embeddings_mtime(embeddings_path))
+    return index
+
+
+_ann_indexes: Dict[str, Tuple[float, IVFIndex]] = {}
+_ann_indexes_lock = threading.Lock()
+
+def get_ann_index(embeddings_path: str) -> IVFIndex:
+    """
+    Shared IVF index for an embedding file. Loaded from the saved .ivf.npz if
+    it was built from the current file, otherwise trained and saved.
+    """
+    mtime = embeddings_mtime(embeddings_path)
+    with _ann_indexes_lock:
+        cached = _ann_indexes.get(embeddings_path)
+        if cached is None or cached[0] != mtime:
+            saved = ann_path_for(embeddings_path)
+            if os.path.exists(saved) and _saved_source_mtime(saved) == mtime:
+                index = IVFIndex.load(saved)
+            else:
+                index = build_ann_index(embeddings_path)
+            cached = (mtime, index)
+            _ann_indexes[embeddings_path] = cached
+        return cached[1]
+
+
+def recall_at_k(exact: List[List[Tuple[str, float]]], approx: List[List[Tuple[str, float]]]) -> float:
+    """Fraction of the exact top-k neighbours that the approximate search also returned."""
+    hits = total = 0
+    for truth, found in zip(exact, approx):
+        truth_ids = {pid for pid, _ in truth}
+        hits += len(truth_ids & {pid for pid, _ in found})
+        total += len(truth_ids)
+    return hits / total if total else 1.0
+
+
+def benchmark(index: IVFIndex, queries: np.ndarray, k: int = 10,
+              nprobes: Sequence[int] = (1, 2, 4, 8, 16, 32)) -> List[Dict[str, Any]]:
+    """
+    Recall@k against brute force and latency per query for each nprobe,
+    plus the brute-force baseline itself (nprobe None).
+    """
+    start = time.perf_counter()
+    exact = EmbeddingIndex.search(index, queries, k)
+    rows = [{"nprobe": None, "recall": 1.0, "ms_per_query": (time.perf_counter() - start) * 1000 / len(queries)}]
+    for nprobe in nprobes:
+        if nprobe > index.nlist:
+            break
+        start = time.perf_counter()
+        approx = index.search(queries, k, nprobe=nprobe)
+        elapsed = time.perf_counter() - start
+        rows.append({"nprobe": nprobe, "recall": recall_at_k(exact, approx), "ms_per_query": elapsed * 1000 / len(queries)})
+    return rows
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.similarity_search import XRAY_EMBEDDINGS_PATH
+
+    parser = argparse.ArgumentParser(description="Build an IVF index over an embedding file and benchmark its recall.")
+    parser.add_argument("embeddings", nargs="?", default=XRAY_EMBEDDINGS_PATH)
+    parser.add_argument("--nlist", type=int, default=None, help="Number of lists (default: 4 * sqrt(n))")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE, help="Lists probed per query at search time")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000, help="Indexed vectors used as benchmark queries")
+    args = parser.parse_args()
+
+    start = time.time()
+    index = build_ann_index(args.embeddings, nlist=args.nlist, nprobe=args.nprobe)
+    print(f"Built IVF index ({len(index)} vectors, {index.nlist} lists) in {time.time() - start:.1f}s")
+    print(f"Index: {ann_path_for(args.embeddings)}")
+
+    rng = np.random.default_rng(0)
+    queries = index.vectors[rng.choice(len(index), min(args.queries, len(index)), replace=False)]
+    for row in benchmark(index, queries, k=args.k):
+        label = "exact" if row["nprobe"] is None else f"nprobe={row['nprobe']}"
+        print(f"  {label:>10}: recall@{args.k}={row['recall']:.3f}  {row['ms_per_query']:.3f} ms/query")
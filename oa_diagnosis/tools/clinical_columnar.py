@@ -0,0 +1,129 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from typing import List, Optional
+
+# Columns read by load_patient_data. Loading only these keeps parse time and
+# resident memory independent of how wide the cohort export is.
+PATIENT_COLUMNS = [
+    'ID', 'SIDE',
+    'V00AGE', 'P01BMI', 'P02SEX',
+    'V00XRKL', 'V00WOMKP', 'V00WOMADL',
+    'Labcorp_V00Serum_C2C_lc', 'Labcorp_V00Serum_CPII_lc',
+    'Labcorp_V00Serum_NTXI_lc', 'Labcorp_V00Urine_CTXII_lc',
+]
+
+# Text columns with fewer distinct values than this fraction of rows become categoricals
+CATEGORY_MAX_RATIO = 0.5
+
+
+def columnar_path_for(csv_path: str) -> str:
+    """Location of the Parquet copy of a clinical CSV (same folder, same name)."""
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def _has_fresh_columnar(csv_path: str) -> bool:
+    columnar_path = columnar_path_for(csv_path)
+    if not os.path.exists(columnar_path):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    return os.path.getmtime(columnar_path) >= os.path.getmtime(csv_path)
+
+
+def dataset_mtime(csv_path: str) -> float:
+    """Modification time of whichever copy of the dataset read_clinical_columns would use."""
+    if _has_fresh_columnar(csv_path):
+        return os.path.getmtime(columnar_path_for(csv_path))
+    return os.path.getmtime(csv_path)
+
+
+def _float32_is_lossless(series: pd.Series) -> bool:
+    """True if every value reads back unchanged from float32's shortest repr (as as_python_scalar does)."""
+    values = series.to_numpy(dtype=np.float64)
+    narrowed = series.astype(np.float32).astype(str).astype(np.float64).to_numpy()
+    return bool(np.array_equal(values, narrowed, equal_nan=True))
+
+
+def downcast_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Shrink dtypes: float64 -> float32 where no value changes (a column with
+    e.g. 15.86666667 needs more than float32's ~7 significant digits and
+    stays float64, so profile text matches the CSV), integers -> smallest
+    signed int, low-cardinality text -> category.
+    """
+    out = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_float_dtype(series):
+            out[col] = series.astype(np.float32) if _float32_is_lossless(series) else series
+        elif pd.api.types.is_integer_dtype(series):
+            out[col] = pd.to_numeric(series, downcast='integer')
+        elif series.nunique(dropna=True) <= CATEGORY_MAX_RATIO * max(len(series), 1):
+            out[col] = series.astype('category')
+        else:
+            out[col] = series
+    return pd.DataFrame(out, index=df.index)
+
+
+def build_columnar_dataset(csv_path: str, out_path: Optional[str] = None) -> str:
+    """
+    Convert the clinical CSV to a downcast Parquet file that can be memory-mapped
+    and read column by column. Returns the path written.
+    """
+    out_path = out_path or columnar_path_for(csv_path)
+    df = downcast_frame(pd.read_csv(csv_path, low_memory=False))
+
+    # Write next to the target and rename so readers never see a partial file
+    tmp_path = out_path + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def read_clinical_columns(csv_path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Read the clinical dataset, restricted to 'columns' when given.
+    Uses the Parquet copy when it is at least as new as the CSV, otherwise
+    falls back to parsing only the requested CSV columns.
+    """
+    if _has_fresh_columnar(csv_path):
+        try:
+            if columns is not None:
+                import pyarrow.parquet as pq
+                available = set(pq.read_schema(columnar_path_for(csv_path)).names)
+                columns = [c for c in columns if c in available]
+            return pd.read_parquet(columnar_path_for(csv_path), columns=columns, memory_map=True)
+        except ImportError:
+            # pyarrow not installed; the CSV is still authoritative
+            pass
+
+    if columns is None:
+        return pd.read_csv(csv_path, low_memory=False)
+    wanted = set(columns)
+    return pd.read_csv(csv_path, usecols=lambda c: c in wanted, low_memory=False)
+
+
+def as_python_scalar(value):
+    """
+    Convert numpy scalars back to plain Python values. float32 values are
+    rounded through their shortest repr so 28.6 stays 28.6 after downcasting.
+    """
+    if isinstance(value, np.floating):
+        return float(str(value))
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.oai_data_loader import DATA_FILE_PATH
+
+    parser = argparse.ArgumentParser(description="Build the columnar (Parquet) copy of the clinical CSV.")
+    parser.add_argument("csv_path", nargs="?", default=DATA_FILE_PATH)
+    parser.add_argument("--out", default=None, help="Output path (default: CSV path with .parquet)")
+    args = parser.parse_args()
+
+    path = build_columnar_dataset(args.csv_path, args.out)
+    print(f"Wrote {path}")
@@ -0,0 +1,308 @@
+import io
+import os
+import time
+import sqlite3
+import tarfile
+import argparse
+import posixpath
+import threading
+import pydicom
+from concurrent.futures import ProcessPoolExecutor
+from oa_diagnosis.tools.seekable_archive import load_index, seekable_paths
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Bytes of the first archive member handed to the header parser; doubled
+# until the header parses (headers are normally a few KB)
+HEADER_PROBE_BYTES = 64 * 1024
+
+# Friendly names used in analysis results for common DICOM modality codes
+MODALITY_NAMES = {
+    "CR": "X-Ray",
+    "DX": "X-Ray",
+    "MR": "MRI",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    patient_id TEXT NOT NULL,
+    rel_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    member TEXT,
+    modality TEXT,
+    body_part TEXT,
+    study_date TEXT,
+    rows INTEGER,
+    columns INTEGER,
+    frames INTEGER,
+    transfer_syntax TEXT,
+    error TEXT,
+    PRIMARY KEY (patient_id, rel_path)
+);
+"""
+
+# Columns (0028,0011), the highest tag parse_header reads. Elements are stored
+# in tag order, so a prefix that parses past it holds every field there is
+_LAST_HEADER_TAG = 0x00280011
+
+_FIELDS = ("member", "modality", "body_part", "study_date", "rows", "columns", "frames", "transfer_syntax", "error")
+
+
+def parse_header(data: bytes, complete: bool = True) -> Dict[str, Any]:
+    """
+    Parse DICOM header fields from a file, without pixel data. With
+    complete=False 'data' is only a prefix, and ValueError is raised unless
+    it reaches past the last field read: a cut-off prefix still parses
+    (force=True) but silently lacks the later elements.
+    """
+    ds = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True, force=True)
+    if not complete and max(ds.keys(), default=0) <= _LAST_HEADER_TAG:
+        raise ValueError("DICOM header continues past the bytes read")
+    file_meta = getattr(ds, "file_meta", None)
+    return {
+        # None marks a missing element, as opposed to a present but empty one
+        "modality": str(ds.Modality) if "Modality" in ds else None,
+        "body_part": str(ds.BodyPartExamined) if "BodyPartExamined" in ds else None,
+        "study_date": str(ds.StudyDate) if "StudyDate" in ds else None,
+        "rows": int(ds.Rows) if "Rows" in ds else None,
+        "columns": int(ds.Columns) if "Columns" in ds else None,
+        "frames": int(ds.NumberOfFrames) if "NumberOfFrames" in ds else 1,
+        "transfer_syntax": str(file_meta.TransferSyntaxUID) if file_meta is not None and "TransferSyntaxUID" in file_meta else None,
+    }
+
+
+def read_member_header(f, size: int) -> Dict[str, Any]:
+    """
+    Read just enough of an archive member to parse its DICOM header: the
+    probe grows until the header is complete, up to the whole member (e.g.
+    when a large private element precedes BodyPartExamined).
+    """
+    data = b""
+    probe = HEADER_PROBE_BYTES
+    while True:
+        data += f.read(min(probe, size) - len(data))
+        try:
+            return parse_header(data, complete=len(data) >= size)
+        except Exception:
+            if len(data) >= size:
+                raise
+            probe *= 2
+
+
+def read_study_header(file_path: str) -> Dict[str, Any]:
+    """
+    Header of the first DICOM member of a .tar.gz study. Reads the member by
+    offset from the seekable copy when one exists; otherwise the archive is
+    read as a stream and decompression stops once the header has been parsed.
+    """
+    index = load_index(file_path)
+    if index is not None and index["members"]:
+        first = index["members"][0]
+        tar_path, _ = seekable_paths(file_path)
+        with open(tar_path, "rb") as f:
+            f.seek(first["offset"])
+            header = read_member_header(f, first["size"])
+        header["member"] = first["name"]
+        return header
+
+    with tarfile.open(file_path, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name != ".":
+                header = read_member_header(tar.extractfile(member), member.size)
+                header["member"] = member.name
+                return header
+    raise ValueError("No valid file found inside archive")
+
+
+def _read_catalog_entry(args):
+    # Top-level so it can be pickled into pool workers
+    patient_id, rel_path, file_path, size, mtime_ns = args
+    try:
+        entry = read_study_header(file_path)
+        entry["error"] = None
+    except Exception as e:
+        entry = {"error": str(e)}
+    entry.update({"patient_id": patient_id, "rel_path": rel_path, "size": size, "mtime_ns": mtime_ns})
+    return entry
+
+
+def is_knee(entry: Optional[Dict[str, Any]]) -> bool:
+    """
+    Same rule analyze_imaging has always applied: a missing BodyPartExamined
+    counts as 'Unknown' and is skipped, an empty one is kept. Studies without
+    a readable header are kept.
+    """
+    if not entry or entry.get("error"):
+        return True
+    body_part = entry.get("body_part")
+    if body_part is None:
+        body_part = "Unknown"
+    return not body_part or body_part.upper() == "KNEE"
+
+
+def default_catalog_path(root: str) -> str:
+    return os.path.join(os.path.dirname(os.path.normpath(root)), "dicom_catalog.sqlite")
+
+
+class DicomCatalog:
+    """
+    SQLite catalog of DICOM header fields for every study archive under the
+    image root (root/<patient_id>/<rel_path>.tar.gz). Entries are keyed by
+    patient and path and invalidated by file size and mtime.
+    """
+
+    def __init__(self, root: str, db_path: Optional[str] = None):
+        self.root = root
+        self.db_path = db_path or default_catalog_path(root)
+        self._lock = threading.Lock()
+        # Pool workers share the file: wait for a writer instead of failing
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+
+    def _file_path(self, patient_id: str, rel_path: str) -> str:
+        return os.path.join(self.root, patient_id, *rel_path.split("/"))
+
+    def lookup(self, patient_id: str, rel_path: str, verify: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Catalog entry for a study, or None if it is missing or (with verify)
+        the archive changed since it was catalogued.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT size, mtime_ns, {', '.join(_FIELDS)} FROM studies WHERE patient_id = ? AND rel_path = ?",
+                (patient_id, rel_path),
+            ).fetchone()
+        if row is None:
+            return None
+        if verify:
+            try:
+                st = os.stat(self._file_path(patient_id, rel_path))
+            except OSError:
+                return None
+            if (st.st_size, st.st_mtime_ns) != (row[0], row[1]):
+                return None
+        return dict(zip(_FIELDS, row[2:]))
+
+    def entries_for(self, patient_id: str) -> Dict[str, Dict[str, Any]]:
+        """All catalogued studies of a patient, keyed by rel_path (not re-verified)."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT rel_path, {', '.join(_FIELDS)} FROM studies WHERE patient_id = ?", (patient_id,)
+            ).fetchall()
+        return {row[0]: dict(zip(_FIELDS, row[1:])) for row in rows}
+
+    def record(self, entry: Dict[str, Any]):
+        """Insert or replace one entry (as produced by _read_catalog_entry)."""
+        self.record_many([entry])
+
+    def record_many(self, entries: Iterable[Dict[str, Any]]):
+        columns = ("patient_id", "rel_path", "size", "mtime_ns") + _FIELDS
+        rows = [tuple(entry.get(c) for c in columns) for entry in entries]
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO studies ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                rows,
+            )
+            self._conn.commit()
+
+    def build(self, image_ids: Iterable[str], workers: Optional[int] = None) -> int:
+        """
+        Catalog every .tar.gz in image_ids ('PatientID|RelPath') that is new or
+        changed, reading headers across a process pool. Returns the number of
+        archives read.
+        """
+        pending = []
+        for image_id in image_ids:
+            patient_id, rel_path = image_id.split("|", 1)
+            if not rel_path.lower().endswith(".tar.gz"):
+                continue
+            file_path = self._file_path(patient_id, rel_path)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT size, mtime_ns FROM studies WHERE patient_id = ? AND rel_path = ?", (patient_id, rel_path)
+                ).fetchone()
+            if row != (st.st_size, st.st_mtime_ns):
+                pending.append((patient_id, rel_path, file_path, st.st_size, st.st_mtime_ns))
+
+        if not pending:
+            return 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            self.record_many(pool.map(_read_catalog_entry, pending, chunksize=16))
+        return len(pending)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def study_for_preview(rel_path: str, entries: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Catalog entry of the archive a preview image belongs to, matched by folder
+    and basename ('20050104/10098604_2x2.jpg' -> '20050104/10098604.tar.gz').
+    """
+    folder, name = posixpath.split(rel_path)
+    base = name.split("_", 1)[0].split(".", 1)[0]
+    return entries.get(posixpath.join(folder, base + ".tar.gz"))
+
+
+def filter_knee_images(image_ids: List[str], catalog: "DicomCatalog") -> List[str]:
+    """
+    Drop catalogued non-knee studies, and their preview images, from a list of
+    image IDs. Studies that are not in the catalog are kept.
+    """
+    entries_by_patient: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    kept = []
+    for image_id in image_ids:
+        patient_id, rel_path = image_id.split("|", 1)
+        if patient_id not in entries_by_patient:
+            entries_by_patient[patient_id] = catalog.entries_for(patient_id)
+        entries = entries_by_patient[patient_id]
+        if rel_path.lower().endswith(".tar.gz"):
+            entry = entries.get(rel_path)
+        else:
+            entry = study_for_preview(rel_path, entries)
+        if is_knee(entry):
+            kept.append(image_id)
+    return kept
+
+
+_catalogs: Dict[Tuple[str, int], DicomCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+def get_dicom_catalog(root: str) -> DicomCatalog:
+    """Return the shared catalog for an image root, opening it on first use."""
+    with _catalogs_lock:
+        # Keyed by PID too: a SQLite connection must not be reused in a forked pool worker
+        key = (root, os.getpid())
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = DicomCatalog(root)
+            _catalogs[key] = catalog
+        return catalog
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.imaging_analysis import IMG_BASE_DIR
+    from oa_diagnosis.tools.image_manifest import ImageManifest
+
+    parser = argparse.ArgumentParser(description="Build or update the header-only DICOM catalog.")
+    parser.add_argument("root", nargs="?", default=IMG_BASE_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="Header reader processes (default: CPU count)")
+    args = parser.parse_args()
+
+    start = time.time()
+    manifest = ImageManifest(args.root)
+    image_ids = []
+    for patient_id in sorted(manifest.refresh()):
+        image_ids.extend(manifest.images_for(patient_id))
+
+    catalog = DicomCatalog(args.root)
+    read = catalog.build(image_ids, workers=args.workers)
+    print(f"Catalogued {read} archives in {time.time() - start:.1f}s")
+    print(f"Catalog: {catalog.db_path}")
@@ -0,0 +1,167 @@
+import os
+import pickle
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools.embedding_store import EmbeddingStore, has_store, store_is_fresh, store_paths
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize rows as float32; all-zero rows stay zero."""
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row-wise top-k of a (queries x candidates) score matrix, best first.
+    Returns (indices, scores), each (queries x k).
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+class EmbeddingIndex:
+    """
+    Exact cosine-similarity index over per-patient embeddings.
+    Vectors are held as one contiguous float32 matrix with L2-normalized rows,
+    so a batch of queries is a single matrix product plus a top-k selection.
+    """
+
+    # Exact scores for every row (approximate subclasses set this to True)
+    approximate = False
+
+    def __init__(self, ids: Sequence[str], vectors: np.ndarray):
+        self.ids = np.asarray([str(i) for i in ids])
+        self.vectors = normalize_rows(vectors)
+        self._row = {pid: row for row, pid in enumerate(self.ids.tolist())}
+
+    @classmethod
+    def from_pickle(cls, path: str) -> "EmbeddingIndex":
+        """Load a pickled {patient_id: vector} dict, as shipped under data/model/."""
+        with open(path, "rb") as f:
+            embeddings = pickle.load(f)
+        ids = list(embeddings.keys())
+        return cls(ids, np.stack([np.asarray(embeddings[i], dtype=np.float32) for i in ids]))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _row_of(self, patient_id) -> Optional[int]:
+        return self._row.get(str(patient_id))
+
+    def __contains__(self, patient_id) -> bool:
+        return self._row_of(patient_id) is not None
+
+    def _vectors_at(self, rows: List[int]) -> np.ndarray:
+        return self.vectors[rows]
+
+    def vector(self, patient_id: str) -> Optional[np.ndarray]:
+        """Normalized embedding of a patient, or None if there is none."""
+        row = self._row_of(patient_id)
+        return self._vectors_at([row])[0] if row is not None else None
+
+    def similarities(self, patient_id: str) -> Optional[np.ndarray]:
+        """Cosine similarity of one patient to every indexed patient, or None if not indexed."""
+        query = self.vector(patient_id)
+        if query is None:
+            return None
+        return np.asarray(self.vectors, dtype=np.float32) @ query
+
+    def search(self, queries: np.ndarray, k: int = 5,
+               exclude: Optional[Sequence[Optional[str]]] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Top-k most similar patients for each query vector.
+        'exclude' optionally names one patient ID per query to leave out
+        (typically the query patient itself).
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        scores = queries @ self.vectors.T
+        if exclude is not None:
+            for q, pid in enumerate(exclude):
+                row = self._row_of(pid) if pid is not None else None
+                if row is not None:
+                    scores[q, row] = -np.inf
+
+        indices, best = top_k(scores, k)
+        return [
+            [(self.ids[i], float(s)) for i, s in zip(row_idx, row_scores) if np.isfinite(s)]
+            for row_idx, row_scores in zip(indices, best)
+        ]
+
+    def search_ids(self, patient_ids: Iterable[str], k: int = 5) -> List[List[Tuple[str, float]]]:
+        """
+        Batch query by patient ID, excluding each patient from their own
+        results. Patients without an embedding get an empty list.
+        """
+        patient_ids = [str(p) for p in patient_ids]
+        rows_of = {p: self._row_of(p) for p in patient_ids}
+        known = [p for p in patient_ids if rows_of[p] is not None]
+        found = {}
+        if known:
+            rows = self._vectors_at([rows_of[p] for p in known])
+            found = dict(zip(known, self.search(rows, k, exclude=known)))
+        return [found.get(p, []) for p in patient_ids]
+
+
+class MappedEmbeddingIndex(EmbeddingIndex):
+    """
+    EmbeddingIndex over a memory-mapped EmbeddingStore. The stored rows are
+    already normalized and sorted by ID, so opening it copies nothing and
+    IDs are found by binary search instead of a dict built at startup.
+    """
+
+    def __init__(self, store: EmbeddingStore):
+        self.store = store
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.store.ids
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.store.vectors
+
+    def _row_of(self, patient_id) -> Optional[int]:
+        return self.store.row_of(patient_id)
+
+
+def has_embeddings(path: str) -> bool:
+    """True if an embedding pickle or its converted store exists."""
+    return os.path.exists(path) or has_store(path)
+
+
+def embeddings_mtime(path: str) -> float:
+    """Modification time of whichever form of the embeddings get_embedding_index serves."""
+    return os.path.getmtime(store_paths(path)[0] if store_is_fresh(path) else path)
+
+
+_indexes: Dict[str, Tuple[float, EmbeddingIndex]] = {}
+_indexes_lock = threading.Lock()
+
+def get_embedding_index(path: str) -> EmbeddingIndex:
+    """
+    Shared index for an embedding pickle; reloaded if the file changes.
+    Served from the memory-mapped store (embedding_store.py) when one at
+    least as new as the pickle exists.
+    """
+    use_store = store_is_fresh(path)
+    mtime = embeddings_mtime(path)
+    with _indexes_lock:
+        cached = _indexes.get(path)
+        if cached is None or cached[0] != mtime:
+            index = MappedEmbeddingIndex(EmbeddingStore(path)) if use_store else EmbeddingIndex.from_pickle(path)
+            cached = (mtime, index)
+            _indexes[path] = cached
+        return cached[1]
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools import oai_data_loader
+from oa_diagnosis.tools.dicom_catalog import get_dicom_catalog, is_knee, read_study_header
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex, embeddings_mtime, get_embedding_index, has_embeddings
+from oa_diagnosis.tools.embedding_store import append_embeddings
+from oa_diagnosis.tools.image_preprocessing import batch_inputs, study_inputs
+from oa_diagnosis.tools.ann_index import IVFIndex, ann_path_for
+from oa_diagnosis.tools.embedding_quantization import QUANTIZATION_MODES, QuantizedIndex, quantized_path_for
+from oa_diagnosis.tools.similarity_search import MODEL_DIR, MRI_EMBEDDINGS_PATH, XRAY_EMBEDDINGS_PATH
+
+# TorchScript ResNet18 feature extractor (512-d output, same preprocessing as
+# image_preprocessing.py) and the pipeline's progress file
+EMBEDDING_MODEL_PATH = os.path.join(MODEL_DIR, "resnet18_embedding.pt")
+CHECKPOINT_PATH = os.path.join(MODEL_DIR, "embedding_pipeline_checkpoint.json")
+
+# Studies embedded per model call (MRI studies contribute several slices each)
+EMBED_BATCH_SIZE = 32
+
+# Modality codes embedded into each store
+STORE_MODALITIES = {
+    "xray": ("CR", "DX"),
+    "mri": ("MR",),
+}
+
+
+class TorchScriptEmbedder:
+    """
+    CPU ResNet18 feature extractor saved with torch.jit.save; maps a
+    (n, 3, 224, 224) float32 batch to (n, 512) embeddings. Loaded once.
+    """
+
+    def __init__(self, model_path: str, threads: Optional[int] = None):
+        try:
+            import torch
+        except ImportError:
+            raise RuntimeError("PyTorch is required to compute embeddings (pip install torch)")
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Embedding model not found at {model_path}")
+        self._torch = torch
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = torch.jit.load(model_path, map_location="cpu").eval()
+
+    def embed(self, batch: np.ndarray) -> np.ndarray:
+        with self._torch.inference_mode():
+            out = self.model(self._torch.from_numpy(batch))
+        return out.reshape(len(batch), -1).numpy().astype(np.float32)
+
+
+class Checkpoint:
+    """
+    Progress file of the pipeline: studies that were embedded or failed, so a
+    restarted run skips them. Rewritten atomically after every batch. The
+    embedding store itself is the record of embedded patients; the checkpoint
+    mostly keeps failed studies from being retried on every run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, str] = {}
+        self.failed: Dict[str, str] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                self.done = state.get("done", {})
+                self.failed = state.get("failed", {})
+            except (OSError, ValueError):
+                pass
+
+    def seen(self, image_id: str) -> bool:
+        return image_id in self.done or image_id in self.failed
+
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done, "failed": self.failed, "updated": time.time()}, f)
+        os.replace(tmp, self.path)
+
+
+def _img_root() -> str:
+    # Same location _find_patient_images lists studies from
+    return os.path.join(os.path.dirname(oai_data_loader.DATA_FILE_PATH), "img")
+
+
+def _study_modality(patient_id: str, rel_path: str) -> Optional[str]:
+    """DICOM modality code of a study, from the header catalog (read and recorded if missing)."""
+    catalog = get_dicom_catalog(_img_root())
+    entry = catalog.lookup(patient_id, rel_path)
+    if entry is None:
+        file_path = os.path.join(catalog.root, patient_id, *rel_path.split("/"))
+        st = os.stat(file_path)
+        entry = read_study_header(file_path)
+        catalog.record(dict(entry, error=None, patient_id=patient_id, rel_path=rel_path,
+                            size=st.st_size, mtime_ns=st.st_mtime_ns))
+    if entry.get("error") or not is_knee(entry):
+        return None
+    return entry.get("modality")
+
+
+def find_pending_studies(patient_ids: Sequence[str], store: str, embeddings_path: str,
+                         checkpoint: Optional[Checkpoint] = None) -> Iterator[Tuple[str, str, str]]:
+    """
+    Yield (patient_id, image_id, modality code) for the first knee study of
+    the store's modality of each patient that has no embedding yet. Studies
+    come from _find_patient_images (manifest + catalog filtering).
+    """
+    index: Optional[EmbeddingIndex] = get_embedding_index(embeddings_path) if has_embeddings(embeddings_path) else None
+    wanted = STORE_MODALITIES[store]
+    for patient_id in patient_ids:
+        if index is not None and patient_id in index:
+            continue
+        for image_id in sorted(oai_data_loader._find_patient_images(patient_id)):
+            _, rel_path = image_id.split("|", 1)
+            if not rel_path.lower().endswith(".tar.gz"):
+                continue
+            if checkpoint is not None and checkpoint.seen(image_id):
+                continue
+            try:
+                modality = _study_modality(patient_id, rel_path)
+            except Exception:
+                continue
+            if modality in wanted:
+                yield patient_id, image_id, modality
+                break
+
+
+def _update_indexes(embeddings_path: str, ids: List[str], vectors: np.ndarray):
+    """Add new vectors to any saved IVF / quantized index, keeping it in step with the store."""
+    mtime = embeddings_mtime(embeddings_path)
+    ann_path = ann_path_for(embeddings_path)
+    if os.path.exists(ann_path):
+        index = IVFIndex.load(ann_path)
+        index.add(ids, vectors)
+        index.save(ann_path, source_mtime=mtime)
+    for mode in QUANTIZATION_MODES:
+        path = quantized_path_for(embeddings_path, mode)
+        if os.path.exists(path):
+            index = QuantizedIndex.load(path)
+            index.add(ids, vectors)
+            index.save(path, source_mtime=mtime)
+
+
+def run_pipeline(embedder, store: str, embeddings_path: str,
+                 patient_ids: Optional[Sequence[str]] = None,
+                 batch_size: int = EMBED_BATCH_SIZE,
+                 checkpoint_path: Optional[str] = None,
+                 limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Embed every pending study of one modality ('xray' or 'mri') in batches
+    and append the vectors to its store and saved indexes. 'embedder' is any
+    object with embed(batch) -> (n, dim) array, e.g. TorchScriptEmbedder.
+    Each batch is committed (store, indexes, checkpoint) before the next
+    starts, so a killed run resumes with the next unembedded study.
+    """
+    if patient_ids is None:
+        from oa_diagnosis.tools.image_manifest import get_image_manifest
+        patient_ids = sorted(get_image_manifest(_img_root()).refresh())
+    checkpoint = Checkpoint(checkpoint_path or CHECKPOINT_PATH)
+
+    stats = {"embedded": 0, "failed": 0, "batches": 0}
+    pending = find_pending_studies(patient_ids, store, embeddings_path, checkpoint)
+    batch: List[Tuple[str, str, np.ndarray]] = []
+
+    def flush():
+        if not batch:
+            return
+        inputs, counts = batch_inputs([x for _, _, x in batch])
+        outputs = embedder.embed(inputs)
+        # One vector per study: MRI slice embeddings are averaged
+        vectors, start = [], 0
+        for count in counts:
+            vectors.append(outputs[start:start + count].mean(axis=0))
+            start += count
+        ids = [pid for pid, _, _ in batch]
+        vectors = np.stack(vectors)
+        append_embeddings(embeddings_path, ids, vectors)
+        _update_indexes(embeddings_path, ids, vectors)
+        for pid, image_id, _ in batch:
+            checkpoint.done[image_id] = pid
+        checkpoint.save()
+        stats["embedded"] += len(batch)
+        stats["batches"] += 1
+        batch.clear()
+
+    for patient_id, image_id, modality in pending:
+        if limit is not None and stats["embedded"] + len(batch) >= limit:
+            break
+        _, rel_path = image_id.split("|", 1)
+        file_path = os.path.join(_img_root(), patient_id, *rel_path.split("/"))
+        try:
+            batch.append((patient_id, image_id, study_inputs(file_path, modality)))
+        except Exception as e:
+            checkpoint.failed[image_id] = str(e)
+            checkpoint.save()
+            stats["failed"] += 1
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed new studies and append them to the embedding stores.")
+    parser.add_argument("--store", choices=sorted(STORE_MODALITIES), default="xray")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_PATH, help="TorchScript ResNet18 feature extractor")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads used by the model")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many studies")
+    args = parser.parse_args()
+
+    embedder = TorchScriptEmbedder(args.model, threads=args.threads)
+    target = XRAY_EMBEDDINGS_PATH if args.store == "xray" else MRI_EMBEDDINGS_PATH
+    start = time.time()
+    stats = run_pipeline(embedder, args.store, target, batch_size=args.batch_size,
+                         checkpoint_path=args.checkpoint, limit=args.limit)
+    print(f"Embedded {stats['embedded']} studies in {stats['batches']} batches "
+          f"({stats['failed']} failed) in {time.time() - start:.1f}s")
@@ -0,0 +1,374 @@
+import os
+import time
+import argparse
+import threading
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools.ann_index import recall_at_k
+from oa_diagnosis.tools.embedding_index import (
+    EmbeddingIndex, embeddings_mtime, get_embedding_index, normalize_rows, top_k
+)
+from oa_diagnosis.tools.embedding_store import convert_embeddings, store_is_fresh
+
+# Product quantization layout: 512 dims split into 128 sub-vectors of 4 dims,
+# each coded by one byte (16x smaller than float32)
+PQ_SUBQUANTIZERS = 128
+PQ_CENTROIDS = 256
+PQ_TRAIN_ITERATIONS = 15
+PQ_TRAIN_POINTS_PER_CENTROID = 64
+
+# Candidates from the compressed scan that are re-scored with float32 vectors
+RERANK_CANDIDATES = 100
+
+# Database rows scored per block, bounds the (queries x rows) temporaries
+SCORE_CHUNK_ROWS = 65536
+
+QUANTIZATION_VERSION = 1
+QUANTIZATION_MODES = ("sq8", "pq")
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension 8-bit scalar quantization: x ~= vmin + code * scale.
+    Inner products with a float query are computed directly on the codes
+    (asymmetric distance): q.x ~= (q * scale).code + q.vmin.
+    """
+
+    def __init__(self, vmin: np.ndarray, scale: np.ndarray):
+        self.vmin = np.asarray(vmin, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> "ScalarQuantizer":
+        vmin = vectors.min(axis=0)
+        span = vectors.max(axis=0) - vmin
+        return cls(vmin, np.where(span > 0, span / 255.0, 1.0))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.vmin + codes.astype(np.float32) * self.scale
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        weighted = queries * self.scale
+        offset = queries @ self.vmin
+        out = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_CHUNK_ROWS):
+            block = codes[start:start + SCORE_CHUNK_ROWS].astype(np.float32)
+            out[:, start:start + len(block)] = weighted @ block.T + offset[:, np.newaxis]
+        return out
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"vmin": self.vmin, "scale": self.scale}
+
+
+def _kmeans_l2(points: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    """Plain (Euclidean) k-means for one PQ subspace."""
+    k = min(k, len(points))
+    centroids = points[rng.choice(len(points), k, replace=False)].copy()
+    for _ in range(iterations):
+        # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+        labels = np.argmax(points @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        order = np.argsort(labels, kind="stable")
+        present = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)])[present]
+        sums[present] = np.add.reduceat(points[order], starts, axis=0)
+        empty = counts == 0
+        sums[empty] = points[rng.choice(len(points), int(empty.sum()), replace=False)]
+        counts[empty] = 1
+        centroids = sums / counts[:, np.newaxis]
+    return centroids.astype(np.float32)
+
+
+class ProductQuantizer:
+    """
+    Product quantization: each vector is split into m sub-vectors and every
+    sub-vector is replaced by the index of its nearest sub-centroid (1 byte).
+    Queries stay float: per query an (m x ksub) table of sub-inner-products
+    is built once, and a row's score is the sum of m table lookups.
+    """
+
+    def __init__(self, centroids: np.ndarray):
+        # (m, ksub, dsub)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+
+    @property
+    def m(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, m: int = PQ_SUBQUANTIZERS, ksub: int = PQ_CENTROIDS,
+              iterations: int = PQ_TRAIN_ITERATIONS, seed: int = 0) -> "ProductQuantizer":
+        if vectors.shape[1] % m:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} is not divisible by {m} sub-quantizers")
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), PQ_TRAIN_POINTS_PER_CENTROID * ksub), replace=False)]
+        subs = sample.reshape(len(sample), m, -1)
+        ksub = min(ksub, len(sample))
+        return cls(np.stack([_kmeans_l2(subs[:, j], ksub, iterations, rng) for j in range(m)]))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subs = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.m, -1)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8, order="F")
+        half_norms = 0.5 * (self.centroids ** 2).sum(axis=2)
+        for j in range(self.m):
+            codes[:, j] = np.argmax(subs[:, j] @ self.centroids[j].T - half_norms[j], axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        parts = [self.centroids[j][codes[:, j]] for j in range(self.m)]
+        return np.concatenate(parts, axis=1)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        tables = np.einsum("qmd,mkd->qmk", queries.reshape(len(queries), self.m, -1), self.centroids)
+        # Column-major codes make each sub-quantizer's column contiguous, so the
+        # per-query table lookups are 1-D gathers (several times faster than
+        # gathering for all queries at once)
+        codes = np.asfortranarray(codes)
+        out = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for q in range(len(queries)):
+            acc = out[q]
+            for j in range(self.m):
+                acc += np.take(tables[q, j], codes[:, j])
+        return out
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"centroids": self.centroids}
+
+
+def train_quantizer(mode: str, vectors: np.ndarray):
+    if mode == "sq8":
+        return ScalarQuantizer.train(vectors)
+    if mode == "pq":
+        return ProductQuantizer.train(vectors)
+    raise ValueError(f"Unknown quantization mode '{mode}', expected one of {QUANTIZATION_MODES}")
+
+
+class QuantizedIndex(EmbeddingIndex):
+    """
+    Similarity search over compressed codes. Candidates are scored with
+    asymmetric distances on the codes; with float32 vectors attached
+    (normally the memory-mapped store, which stays on disk), the best
+    'rerank' candidates are re-scored exactly before the final top-k.
+    """
+
+    approximate = True
+
+    def __init__(self, ids: Sequence[str], quantizer, codes: np.ndarray,
+                 vectors: Optional[np.ndarray] = None,
+                 rerank: int = RERANK_CANDIDATES):
+        self.ids = np.asarray([str(i) for i in ids])
+        self._row = {pid: row for row, pid in enumerate(self.ids.tolist())}
+        self.quantizer = quantizer
+        self.codes = codes
+        self.vectors = vectors
+        self.rerank = rerank
+
+    @property
+    def mode(self) -> str:
+        return "pq" if isinstance(self.quantizer, ProductQuantizer) else "sq8"
+
+    @classmethod
+    def build(cls, index: EmbeddingIndex, mode: str, rerank: int = RERANK_CANDIDATES,
+              keep_vectors: bool = True) -> "QuantizedIndex":
+        """
+        Quantize the vectors of an existing index. With keep_vectors they stay
+        attached for re-ranking, but only if memory-mapped: an in-memory
+        float32 copy would cost more than the codes save.
+        """
+        vectors = np.asarray(index.vectors, dtype=np.float32)
+        quantizer = train_quantizer(mode, vectors)
+        mapped = isinstance(index.vectors, np.memmap)
+        return cls(index.ids, quantizer, quantizer.encode(vectors),
+                   vectors=index.vectors if keep_vectors and mapped else None, rerank=rerank)
+
+    def _vectors_at(self, rows: List[int]) -> np.ndarray:
+        if self.vectors is not None:
+            return self.vectors[rows]
+        return normalize_rows(self.quantizer.decode(self.codes[rows]))
+
+    def similarities(self, patient_id: str) -> Optional[np.ndarray]:
+        """Similarity of one patient to every indexed patient, scored on the codes; None if not indexed."""
+        query = self.vector(patient_id)
+        if query is None:
+            return None
+        return self.quantizer.scores(normalize_rows(query[np.newaxis, :]), self.codes)[0]
+
+    def search(self, queries: np.ndarray, k: int = 5,
+               exclude: Optional[Sequence[Optional[str]]] = None,
+               rerank: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+        queries = normalize_rows(np.atleast_2d(queries))
+        scores = self.quantizer.scores(queries, self.codes)
+        if exclude is not None:
+            for q, pid in enumerate(exclude):
+                row = self._row_of(pid) if pid is not None else None
+                if row is not None:
+                    scores[q, row] = -np.inf
+
+        rerank = self.rerank if rerank is None else rerank
+        if self.vectors is None or rerank <= 0:
+            indices, best = top_k(scores, k)
+        else:
+            candidates, candidate_scores = top_k(scores, max(k, rerank))
+            exact = np.empty(candidates.shape, dtype=np.float32)
+            for q in range(len(queries)):
+                # Read candidate rows in file order (friendlier to a memory-mapped store)
+                order = np.argsort(candidates[q])
+                exact[q, order] = np.asarray(self.vectors[candidates[q][order]], dtype=np.float32) @ queries[q]
+            exact[~np.isfinite(candidate_scores)] = -np.inf
+            order, best = top_k(exact, k)
+            indices = np.take_along_axis(candidates, order, axis=1)
+
+        return [
+            [(self.ids[i], float(s)) for i, s in zip(row_idx, row_scores) if np.isfinite(s)]
+            for row_idx, row_scores in zip(indices, best)
+        ]
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        """Encode and append new vectors with the existing quantizer (no retraining)."""
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, np.asarray([str(i) for i in ids])])
+        codes = np.concatenate([self.codes, self.quantizer.encode(vectors)])
+        self.codes = np.asfortranarray(codes) if self.mode == "pq" else codes
+        for offset, pid in enumerate(self.ids[start:].tolist()):
+            self._row[pid] = start + offset
+
+    @property
+    def code_bytes(self) -> int:
+        return int(self.codes.nbytes)
+
+    def save(self, path: str, source_mtime: Optional[float] = None):
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            version=QUANTIZATION_VERSION,
+            mode=self.mode,
+            ids=self.ids,
+            codes=self.codes,
+            rerank=self.rerank,
+            source_mtime=np.nan if source_mtime is None else source_mtime,
+            **self.quantizer.arrays(),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, vectors: Optional[np.ndarray] = None) -> "QuantizedIndex":
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != QUANTIZATION_VERSION:
+                raise ValueError(f"Unsupported quantized index version in {path}")
+            if str(data["mode"]) == "pq":
+                quantizer = ProductQuantizer(data["centroids"])
+            else:
+                quantizer = ScalarQuantizer(data["vmin"], data["scale"])
+            return cls(data["ids"], quantizer, data["codes"], vectors=vectors, rerank=int(data["rerank"]))
+
+
+def quantized_path_for(embeddings_path: str, mode: str) -> str:
+    """'xray_..._train_only.pkl' -> 'xray_..._train_only.pq.npz'"""
+    return f"{os.path.splitext(embeddings_path)[0]}.{mode}.npz"
+
+
+def _saved_source_mtime(path: str) -> Optional[float]:
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            return float(data["source_mtime"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _require_store(embeddings_path: str):
+    # Re-ranking reads float32 rows from the memory-mapped store; convert a
+    # pickle that has none (if that fails, search uses the codes alone)
+    if os.path.exists(embeddings_path) and not store_is_fresh(embeddings_path):
+        try:
+            convert_embeddings(embeddings_path)
+        except OSError:
+            pass
+
+
+def _rerank_vectors(embeddings_path: str) -> Optional[np.ndarray]:
+    vectors = get_embedding_index(embeddings_path).vectors
+    return vectors if isinstance(vectors, np.memmap) else None
+
+
+def build_quantized_index(embeddings_path: str, mode: str, rerank: int = RERANK_CANDIDATES) -> QuantizedIndex:
+    """Quantize an embedding file and save the codes next to it."""
+    _require_store(embeddings_path)
+    exact = get_embedding_index(embeddings_path)
+    index = QuantizedIndex.build(exact, mode, rerank=rerank)
+    index.save(quantized_path_for(embeddings_path, mode), source_mtime=embeddings_mtime(embeddings_path))
+    return index
+
+
+_quantized: Dict[Tuple[str, str], Tuple[float, QuantizedIndex]] = {}
+_quantized_lock = threading.Lock()
+
+def get_quantized_index(embeddings_path: str, mode: str) -> QuantizedIndex:
+    """
+    Shared quantized index for an embedding file, loaded from the saved codes
+    if they were built from the current file, otherwise built and saved.
+    Re-ranking uses the memory-mapped embedding store, which is converted
+    from the pickle first if needed; float32 vectors are never held in memory.
+    """
+    _require_store(embeddings_path)
+    mtime = embeddings_mtime(embeddings_path)
+    with _quantized_lock:
+        key = (embeddings_path, mode)
+        cached = _quantized.get(key)
+        if cached is None or cached[0] != mtime:
+            saved = quantized_path_for(embeddings_path, mode)
+            if os.path.exists(saved) and _saved_source_mtime(saved) == mtime:
+                index = QuantizedIndex.load(saved, vectors=_rerank_vectors(embeddings_path))
+            else:
+                index = build_quantized_index(embeddings_path, mode)
+            cached = (mtime, index)
+            _quantized[key] = cached
+        return cached[1]
+
+
+def evaluate(exact: EmbeddingIndex, index: QuantizedIndex, queries: np.ndarray, k: int = 10,
+             rerank: Optional[int] = None) -> Dict[str, Any]:
+    """Recall@k against exact search, latency and memory of a quantized index."""
+    truth = exact.search(queries, k)
+    start = time.perf_counter()
+    found = index.search(queries, k, rerank=rerank)
+    elapsed = time.perf_counter() - start
+    float_bytes = len(index.ids) * queries.shape[1] * 4
+    return {
+        "mode": index.mode,
+        "rerank": index.rerank if rerank is None else rerank,
+        "recall": recall_at_k(truth, found),
+        "ms_per_query": elapsed * 1000 / len(queries),
+        "code_bytes": index.code_bytes,
+        "compression": float_bytes / index.code_bytes,
+    }
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.similarity_search import XRAY_EMBEDDINGS_PATH
+
+    parser = argparse.ArgumentParser(description="Quantize an embedding file (int8 and/or PQ) and report recall loss.")
+    parser.add_argument("embeddings", nargs="?", default=XRAY_EMBEDDINGS_PATH)
+    parser.add_argument("--mode", choices=QUANTIZATION_MODES + ("all",), default="all")
+    parser.add_argument("--rerank", type=int, default=RERANK_CANDIDATES, help="Candidates re-scored with float32 vectors")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000, help="Indexed vectors used as evaluation queries")
+    args = parser.parse_args()
+
+    exact = get_embedding_index(args.embeddings)
+    rng = np.random.default_rng(0)
+    queries = np.asarray(exact.vectors[np.sort(rng.choice(len(exact), min(args.queries, len(exact)), replace=False))])
+
+    for mode in (QUANTIZATION_MODES if args.mode == "all" else (args.mode,)):
+        start = time.time()
+        index = build_quantized_index(args.embeddings, mode, rerank=args.rerank)
+        print(f"{mode}: built in {time.time() - start:.1f}s -> {quantized_path_for(args.embeddings, mode)}")
+        for rerank in (0, args.rerank):
+            row = evaluate(exact, index, queries, k=args.k, rerank=rerank)
+            print(f"  rerank={row['rerank']:>4}: recall@{args.k}={row['recall']:.3f}  "
+                  f"{row['ms_per_query']:.3f} ms/query  {row['code_bytes'] / 1e6:.2f} MB codes ({row['compression']:.0f}x smaller)")
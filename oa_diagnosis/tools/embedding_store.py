@@ -0,0 +1,236 @@
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+from typing import Optional, Sequence, Tuple
+
+
+def store_paths(embeddings_path: str) -> Tuple[str, str]:
+    """
+    Memory-mappable copy of a pickled embedding dict, stored next to it:
+    'xray_..._train_only.pkl' -> ('xray_..._train_only.f32.npy', 'xray_..._train_only.ids.npy').
+    """
+    base = os.path.splitext(embeddings_path)[0]
+    return base + ".f32.npy", base + ".ids.npy"
+
+
+def has_store(embeddings_path: str) -> bool:
+    return all(os.path.exists(p) for p in store_paths(embeddings_path))
+
+
+def store_is_fresh(embeddings_path: str) -> bool:
+    """True if the store exists and is at least as new as the pickle (or the pickle is gone)."""
+    if not has_store(embeddings_path):
+        return False
+    if not os.path.exists(embeddings_path):
+        return True
+    vectors_path, ids_path = store_paths(embeddings_path)
+    return min(os.path.getmtime(vectors_path), os.path.getmtime(ids_path)) >= os.path.getmtime(embeddings_path)
+
+
+def _id_table(ids: Sequence[str]) -> np.ndarray:
+    """
+    Structured ID array saved as .ids.npy: 'id' in matrix row order, plus
+    'sorted_id' / 'row' (the same IDs sorted, with their matrix rows) for
+    binary-search lookups. One file, so replacing it commits a new row count
+    and a consistent lookup table at once.
+    """
+    ids = np.asarray([str(i) for i in ids])
+    width = max(16, max((len(i) for i in ids.tolist()), default=0))
+    order = np.argsort(ids, kind="stable")
+    table = np.empty(len(ids), dtype=[("id", f"U{width}"), ("sorted_id", f"U{width}"), ("row", "<i8")])
+    table["id"] = ids
+    table["sorted_id"] = ids[order]
+    table["row"] = order
+    return table
+
+
+def _save_atomic(path: str, array: np.ndarray):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def convert_embeddings(embeddings_path: str) -> Tuple[str, str]:
+    """
+    Write a pickled {patient_id: vector} dict as one float32 matrix with
+    L2-normalized rows, sorted by patient ID, plus the matching ID table.
+    Both files are written to temp names and then moved into place.
+    """
+    with open(embeddings_path, "rb") as f:
+        embeddings = pickle.load(f)
+    ids = sorted(str(k) for k in embeddings)
+    by_str = {str(k): v for k, v in embeddings.items()}
+    dim = len(np.asarray(by_str[ids[0]])) if ids else 0
+
+    vectors_path, ids_path = store_paths(embeddings_path)
+    tmp_vectors = f"{vectors_path}.{os.getpid()}.tmp"
+
+    matrix = np.lib.format.open_memmap(tmp_vectors, mode="w+", dtype=np.float32, shape=(len(ids), dim))
+    for row, pid in enumerate(ids):
+        vector = np.asarray(by_str[pid], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        matrix[row] = vector / norm if norm else vector
+    matrix.flush()
+    del matrix
+
+    os.replace(tmp_vectors, vectors_path)
+    _save_atomic(ids_path, _id_table(ids))
+    return vectors_path, ids_path
+
+
+def _rewrite_npy_shape(path: str, shape: Tuple[int, ...]):
+    """
+    Change the row count in a float32 .npy header in place. Returns False if
+    the new header does not fit in the existing header block.
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version != (1, 0):
+            return False
+        np.lib.format.read_array_header_1_0(f)
+        data_offset = f.tell()
+        header = repr({"descr": "<f4", "fortran_order": False, "shape": tuple(shape)})
+        # Magic (6) + version (2) + header length (2); the block ends with '\n'
+        room = data_offset - 10
+        if len(header) + 1 > room:
+            return False
+        f.seek(10)
+        f.write((header.ljust(room - 1) + "\n").encode("latin1"))
+    return True
+
+
+def append_embeddings(embeddings_path: str, ids: Sequence[str], vectors: np.ndarray) -> int:
+    """
+    Add vectors for new patients to the store without rewriting the matrix:
+    rows are written after the current last row, the .npy header's row count
+    is updated in place, and the ID table is replaced last (it is the commit
+    record; readers only see rows it lists). IDs already in the store are
+    skipped. A pickle without a fresh store is converted first; with
+    neither, a new store is created. Returns the rows added.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1.0)
+    vectors_path, ids_path = store_paths(embeddings_path)
+
+    if os.path.exists(embeddings_path) and not store_is_fresh(embeddings_path):
+        # Start from the whole pickle: once written, the store is what
+        # get_embedding_index serves, so it must hold the existing rows too
+        convert_embeddings(embeddings_path)
+
+    if not has_store(embeddings_path):
+        order = np.argsort(np.asarray([str(i) for i in ids]), kind="stable")
+        sorted_ids = [str(ids[i]) for i in order]
+        tmp_vectors = f"{vectors_path}.{os.getpid()}.tmp"
+        with open(tmp_vectors, "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors[order]))
+        os.replace(tmp_vectors, vectors_path)
+        _save_atomic(ids_path, _id_table(sorted_ids))
+        return len(sorted_ids)
+
+    store = EmbeddingStore(embeddings_path)
+    existing = [str(i) for i in np.asarray(store.ids).tolist()]
+    known = set(existing)
+    new_rows = []
+    for pid, vector in zip((str(i) for i in ids), vectors):
+        if pid not in known:
+            known.add(pid)
+            new_rows.append((pid, vector))
+    if not new_rows:
+        return 0
+
+    dim = store.vectors.shape[1]
+    block = np.stack([v for _, v in new_rows]).astype("<f4")
+    if block.shape[1] != dim:
+        raise ValueError(f"Embedding dimension {block.shape[1]} does not match the store ({dim})")
+    count = len(existing)
+    store.close()
+
+    with open(vectors_path, "r+b") as f:
+        np.lib.format.read_magic(f)
+        np.lib.format.read_array_header_1_0(f)
+        f.seek(f.tell() + count * dim * 4)
+        f.write(block.tobytes())
+        f.truncate()
+    if not _rewrite_npy_shape(vectors_path, (count + len(block), dim)):
+        full = np.concatenate([np.load(vectors_path, mmap_mode="r")[:count], block])
+        tmp_vectors = f"{vectors_path}.{os.getpid()}.tmp"
+        with open(tmp_vectors, "wb") as f:
+            np.save(f, full)
+        os.replace(tmp_vectors, vectors_path)
+
+    _save_atomic(ids_path, _id_table(existing + [pid for pid, _ in new_rows]))
+    return len(new_rows)
+
+
+class EmbeddingStore:
+    """
+    Read-only view of a converted embedding store. Nothing is read at
+    construction; both arrays are opened with mmap_mode='r' on first use, so
+    pages are shared between processes through the OS page cache and opening
+    cost does not depend on the number of embeddings.
+    """
+
+    def __init__(self, embeddings_path: str):
+        self.vectors_path, self.ids_path = store_paths(embeddings_path)
+        self._vectors: Optional[np.ndarray] = None
+        self._table: Optional[np.ndarray] = None
+
+    @property
+    def table(self) -> np.ndarray:
+        if self._table is None:
+            table = np.load(self.ids_path, mmap_mode="r")
+            if table.dtype.names is None:
+                # Plain ID array (stores converted before the ID table existed): already sorted
+                table = _id_table(table.tolist())
+            self._table = table
+        return self._table
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            # The ID table decides how many rows are committed; an interrupted
+            # append may have left extra rows past them
+            self._vectors = np.load(self.vectors_path, mmap_mode="r")[:len(self.table)]
+        return self._vectors
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.table["id"]
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def row_of(self, patient_id: str) -> Optional[int]:
+        """Row of a patient's vector (binary search on the sorted IDs), or None."""
+        pid = str(patient_id)
+        sorted_ids = self.table["sorted_id"]
+        pos = int(np.searchsorted(sorted_ids, pid))
+        if pos < len(sorted_ids) and sorted_ids[pos] == pid:
+            return int(self.table["row"][pos])
+        return None
+
+    def close(self):
+        """Drop the memory maps (needed before the files are replaced on Windows)."""
+        self._vectors = None
+        self._table = None
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.similarity_search import MODEL_DIR
+
+    parser = argparse.ArgumentParser(description="Convert pickled embedding dicts into memory-mapped .npy stores.")
+    parser.add_argument("paths", nargs="*", help="Embedding pickles (default: every .pkl in the model folder)")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(
+        os.path.join(MODEL_DIR, name) for name in os.listdir(MODEL_DIR) if name.endswith(".pkl")
+    )
+    for path in paths:
+        start = time.time()
+        vectors_path, _ = convert_embeddings(path)
+        store = EmbeddingStore(path)
+        print(f"{os.path.basename(path)}: {len(store)} x {store.vectors.shape[1]} -> {vectors_path} ({time.time() - start:.1f}s)")
@@ -0,0 +1,192 @@
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex, embeddings_mtime, get_embedding_index, normalize_rows, top_k
+
+# "late": weighted mean of per-modality cosine scores over the modalities both
+# patients have; "early": cosine between concatenated, re-normalized vectors
+FUSION_MODES = ("late", "early")
+FUSION_MODE = "late"
+
+# Relative weight of each modality in both fusion modes
+MODALITY_WEIGHTS = {"xray": 0.5, "mri": 0.5}
+
+
+class FusionIndex:
+    """
+    Joint X-ray + MRI retrieval over the union of patients in both embedding
+    stores. Each modality is scored against its own store, mapped onto the
+    union by row-index arrays (as in LateFusionIndex), so no aligned copy of
+    either store is made; a batch of queries costs one matrix product per
+    modality in late fusion. The concatenated matrix for early fusion is
+    built on first use only. Patients with only one modality are still
+    searched and scored on what they share with the query.
+    """
+
+    def __init__(self, xray: EmbeddingIndex, mri: EmbeddingIndex,
+                 weights: Optional[Dict[str, float]] = None,
+                 mode: str = FUSION_MODE):
+        if mode not in FUSION_MODES:
+            raise ValueError(f"Unknown fusion mode '{mode}', expected one of {FUSION_MODES}")
+        weights = weights or MODALITY_WEIGHTS
+        self.mode = mode
+        self.weights = (float(weights.get("xray", 0.0)), float(weights.get("mri", 0.0)))
+        self.indexes = (xray, mri)
+
+        modality_ids = [[str(i) for i in np.asarray(index.ids).tolist()] for index in self.indexes]
+        self.ids = np.asarray(sorted(set(modality_ids[0]) | set(modality_ids[1])))
+        self._row = {pid: row for row, pid in enumerate(self.ids.tolist())}
+        # Row in self.ids of each modality index's rows, and the inverse:
+        # each patient's row in a modality index (-1 where it has none)
+        self._rows = [np.asarray([self._row[pid] for pid in ids], dtype=np.int64) for ids in modality_ids]
+        self._members = []
+        for rows in self._rows:
+            member = np.full(len(self.ids), -1, dtype=np.int64)
+            member[rows] = np.arange(len(rows))
+            self._members.append(member)
+        self.has_xray, self.has_mri = (member >= 0 for member in self._members)
+
+        self._early: Optional[np.ndarray] = None
+        self._early_lock = threading.Lock()
+        if mode == "early":
+            self._early_matrix()
+
+    def _early_matrix(self) -> np.ndarray:
+        # Each block scaled by sqrt(weight), so the inner product of two
+        # concatenated vectors is the weighted sum of the cosines
+        with self._early_lock:
+            if self._early is None:
+                dims = [index.vectors.shape[1] for index in self.indexes]
+                concatenated = np.zeros((len(self.ids), sum(dims)), dtype=np.float32)
+                offset = 0
+                for index, rows, weight, dim in zip(self.indexes, self._rows, self.weights, dims):
+                    concatenated[rows, offset:offset + dim] = np.sqrt(weight) * index.vectors
+                    offset += dim
+                self._early = normalize_rows(concatenated)
+            return self._early
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, patient_id) -> bool:
+        return str(patient_id) in self._row
+
+    def modalities(self, patient_id: str) -> List[str]:
+        row = self._row.get(str(patient_id))
+        if row is None:
+            return []
+        return [name for name, present in (("xray", self.has_xray[row]), ("mri", self.has_mri[row])) if present]
+
+    def scores(self, rows: Sequence[int], mode: Optional[str] = None) -> np.ndarray:
+        """
+        (len(rows) x patients) fused similarity of indexed patients to all
+        others; -inf where two patients share no modality.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        mode = mode or self.mode
+        if mode == "early":
+            early = self._early_matrix()
+            out = early[rows] @ early.T
+            shared = (self.has_xray[rows, None] & self.has_xray[None, :]) | (self.has_mri[rows, None] & self.has_mri[None, :])
+            return np.where(shared, out, -np.inf).astype(np.float32)
+        if mode != "late":
+            raise ValueError(f"Unknown fusion mode '{mode}', expected one of {FUSION_MODES}")
+
+        fused = np.zeros((len(rows), len(self.ids)), dtype=np.float32)
+        total = np.zeros((len(rows), len(self.ids)), dtype=np.float32)
+        for index, columns, member, weight in zip(self.indexes, self._rows, self._members, self.weights):
+            queries = member[rows]
+            scored = np.flatnonzero(queries >= 0)
+            if weight <= 0 or not len(scored):
+                continue
+            cells = np.ix_(scored, columns)
+            fused[cells] += weight * (index.vectors[queries[scored]] @ index.vectors.T)
+            total[cells] += weight
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(total > 0, fused / total, -np.inf).astype(np.float32)
+
+    def similarities(self, patient_id: str, mode: Optional[str] = None) -> Optional[np.ndarray]:
+        """Fused similarity of one patient to every indexed patient (NaN where not comparable), or None."""
+        row = self._row.get(str(patient_id))
+        if row is None:
+            return None
+        out = self.scores([row], mode)[0]
+        out[~np.isfinite(out)] = np.nan
+        return out
+
+    def search_ids(self, patient_ids: Iterable[str], k: int = 5,
+                   mode: Optional[str] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Batch top-k by patient ID, best first, excluding the patient itself.
+        Patients in neither store get an empty list.
+        """
+        patient_ids = [str(p) for p in patient_ids]
+        known = [p for p in patient_ids if p in self._row]
+        found = {}
+        if known:
+            rows = [self._row[p] for p in known]
+            scores = self.scores(rows, mode)
+            scores[np.arange(len(rows)), rows] = -np.inf
+            indices, best = top_k(scores, k)
+            for pid, row_idx, row_scores in zip(known, indices, best):
+                found[pid] = [(self.ids[i], float(s)) for i, s in zip(row_idx, row_scores) if np.isfinite(s)]
+        return [found.get(p, []) for p in patient_ids]
+
+
+class LateFusionIndex:
+    """
+    Late fusion over two indexes of any kind (exact, IVF or quantized): each
+    modality's similarities come from its own index, so an approximate
+    search backend carries over, and are averaged with MODALITY_WEIGHTS over
+    the modalities that scored a patient (NaN where neither did). Used by
+    hybrid retrieval when the search backend is approximate.
+    """
+
+    def __init__(self, xray: EmbeddingIndex, mri: EmbeddingIndex,
+                 weights: Optional[Dict[str, float]] = None):
+        weights = weights or MODALITY_WEIGHTS
+        self.indexes = ((xray, float(weights.get("xray", 0.0))), (mri, float(weights.get("mri", 0.0))))
+        modality_ids = [[str(i) for i in np.asarray(index.ids).tolist()] for index, _ in self.indexes]
+        self.ids = np.asarray(sorted(set(modality_ids[0]) | set(modality_ids[1])))
+        self._row = {pid: row for row, pid in enumerate(self.ids.tolist())}
+        # Row in self.ids of each modality index's rows
+        self._rows = [np.asarray([self._row[pid] for pid in ids], dtype=np.int64) for ids in modality_ids]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, patient_id) -> bool:
+        return str(patient_id) in self._row
+
+    def similarities(self, patient_id: str) -> Optional[np.ndarray]:
+        """Fused similarity of one patient to every indexed patient (NaN where not scored), or None."""
+        total = np.zeros(len(self.ids), dtype=np.float32)
+        weight = np.zeros(len(self.ids), dtype=np.float32)
+        found = False
+        for (index, w), rows in zip(self.indexes, self._rows):
+            scores = index.similarities(patient_id) if w > 0 else None
+            if scores is None:
+                continue
+            found = True
+            scored = np.isfinite(scores)
+            total[rows[scored]] += w * scores[scored]
+            weight[rows[scored]] += w
+        if not found:
+            return None
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(weight > 0, total / weight, np.nan).astype(np.float32)
+
+
+_fusion_indexes: Dict[Tuple[str, str], Tuple[Tuple[float, float], FusionIndex]] = {}
+_fusion_lock = threading.Lock()
+
+def get_fusion_index(xray_path: str, mri_path: str) -> FusionIndex:
+    """Shared fusion index over two embedding files; rebuilt when either changes."""
+    stamp = (embeddings_mtime(xray_path), embeddings_mtime(mri_path))
+    key = (xray_path, mri_path)
+    with _fusion_lock:
+        cached = _fusion_indexes.get(key)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, FusionIndex(get_embedding_index(xray_path), get_embedding_index(mri_path)))
+            _fusion_indexes[key] = cached
+        return cached[1]
@@ -0,0 +1,275 @@
+import threading
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from oa_diagnosis.tools.patient_store import get_patient_store
+from oa_diagnosis.tools.clinical_columnar import dataset_mtime
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex, get_embedding_index, top_k
+from oa_diagnosis.tools.fusion_index import FusionIndex, LateFusionIndex, get_fusion_index
+
+# Clinical features of the hybrid distance (feature name -> CSV column) and
+# their weights. One row per knee ('SIDE'), as in the CSV.
+CLINICAL_FEATURES = {
+    "age": 'V00AGE',
+    "bmi": 'P01BMI',
+    "sex": 'P02SEX',
+    "kl_grade": 'V00XRKL',
+    "womac_pain": 'V00WOMKP',
+    "womac_adl": 'V00WOMADL',
+    "serum_c2c": 'Labcorp_V00Serum_C2C_lc',
+    "serum_cpii": 'Labcorp_V00Serum_CPII_lc',
+    "serum_ntxi": 'Labcorp_V00Serum_NTXI_lc',
+    "urine_ctxii": 'Labcorp_V00Urine_CTXII_lc',
+}
+
+FEATURE_WEIGHTS = {
+    "age": 1.0,
+    "bmi": 1.0,
+    "sex": 0.5,
+    "kl_grade": 2.0,
+    "womac_pain": 1.0,
+    "womac_adl": 0.5,
+    "serum_c2c": 0.25,
+    "serum_cpii": 0.25,
+    "serum_ntxi": 0.25,
+    "urine_ctxii": 0.25,
+}
+
+# Share of the hybrid score given to embedding similarity when the query
+# patient has an embedding (imputed for candidates without a score)
+EMBEDDING_WEIGHT = 0.5
+
+HYBRID_COLUMNS = ['ID', 'SIDE'] + list(CLINICAL_FEATURES.values())
+
+KL_GRADES = range(0, 5)
+SEX_CODES = {"male": 1, "m": 1, "female": 2, "f": 2}
+
+
+def kl_grade_of(value) -> Optional[int]:
+    """Leading KL grade of a value such as '2:02:00' (or a plain number)."""
+    if value is None or pd.isna(value):
+        return None
+    try:
+        return int(str(value).split(":", 1)[0].split(".", 1)[0])
+    except ValueError:
+        return None
+
+
+def sex_code_of(value) -> Optional[int]:
+    """1 (male) / 2 (female) from '1: Male', 'Female', 'F', 2, ...; None if unknown."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    text = str(value).strip().lower()
+    if text in SEX_CODES:
+        return SEX_CODES[text]
+    head = text.split(":", 1)[0].split(".", 1)[0]
+    if head in ("1", "2"):
+        return int(head)
+    return None
+
+
+class HybridRetriever:
+    """
+    Case retrieval over one row per knee, combining a weighted distance on
+    standardized clinical features with embedding cosine similarity.
+    Everything query-independent is precomputed: the z-scored feature matrix
+    (missing values marked in a presence mask), each row's embedding row, and
+    packed bitmasks per sex and per KL window used as filters.
+    """
+
+    def __init__(self, frame: pd.DataFrame,
+                 embeddings: Optional[Union[EmbeddingIndex, FusionIndex, LateFusionIndex]] = None,
+                 weights: Optional[Dict[str, float]] = None):
+        self.features = list(CLINICAL_FEATURES)
+        self.ids = np.asarray([str(int(v)) for v in frame['ID']])
+        self.sides = np.asarray([str(v) if pd.notna(v) else "" for v in frame['SIDE']]) if 'SIDE' in frame else np.full(len(frame), "")
+        self.weights = np.asarray([(weights or FEATURE_WEIGHTS).get(f, 0.0) for f in self.features], dtype=np.float32)
+
+        raw = np.column_stack([self._feature_column(frame, f) for f in self.features]).astype(np.float32)
+        self.present = ~np.isnan(raw)
+        self.mean = np.nanmean(raw, axis=0)
+        std = np.nanstd(raw, axis=0)
+        self.std = np.where(std > 0, std, 1.0).astype(np.float32)
+        self.z = np.where(self.present, (raw - self.mean) / self.std, 0.0).astype(np.float32)
+        self.raw = raw
+
+        n = len(self.ids)
+        sex = raw[:, self.features.index("sex")]
+        kl = raw[:, self.features.index("kl_grade")]
+        self.sex_masks = {code: np.packbits(sex == code) for code in (1, 2)}
+        self.kl_masks = {
+            (grade, window): np.packbits(np.abs(kl - grade) <= window)
+            for grade in KL_GRADES for window in (0, 1, 2)
+        }
+        self.all_mask = np.packbits(np.ones(n, dtype=bool))
+
+        self.embeddings = embeddings
+        self.embedding_rows = np.full(n, -1, dtype=np.int64)
+        if embeddings is not None:
+            embedding_row = {pid: row for row, pid in enumerate(np.asarray(embeddings.ids).tolist())}
+            for pos, pid in enumerate(self.ids.tolist()):
+                self.embedding_rows[pos] = embedding_row.get(pid, -1)
+        self._row_by_id: Dict[str, int] = {}
+        for pos, pid in enumerate(self.ids.tolist()):
+            self._row_by_id.setdefault(pid, pos)
+
+    @staticmethod
+    def _feature_column(frame: pd.DataFrame, feature: str) -> np.ndarray:
+        column = CLINICAL_FEATURES[feature]
+        if column not in frame:
+            return np.full(len(frame), np.nan)
+        values = frame[column]
+        if feature == "kl_grade":
+            grades = (kl_grade_of(v) for v in values)
+            return np.asarray([np.nan if g is None else g for g in grades], dtype=float)
+        if feature == "sex":
+            return np.asarray([sex_code_of(v) or np.nan for v in values], dtype=float)
+        return pd.to_numeric(values.astype(object), errors="coerce").to_numpy(dtype=float)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def filter_mask(self, sex: Optional[int] = None, kl_grade: Optional[int] = None,
+                    kl_window: Optional[int] = 1) -> np.ndarray:
+        """Boolean row mask from the precomputed bitmasks (None disables a filter)."""
+        packed = self.all_mask
+        if sex in self.sex_masks:
+            packed = packed & self.sex_masks[sex]
+        if kl_grade is not None and kl_window is not None:
+            key = (int(kl_grade), int(kl_window))
+            if key in self.kl_masks:
+                packed = packed & self.kl_masks[key]
+            else:
+                kl = self.raw[:, self.features.index("kl_grade")]
+                packed = packed & np.packbits(np.abs(kl - kl_grade) <= kl_window)
+        return np.unpackbits(packed, count=len(self.ids)).astype(bool)
+
+    def query_vector(self, values: Dict[str, Any], patient_id: str = "") -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Raw and standardized query features plus their presence mask. Starts
+        from the patient's own CSV row when patient_id is known; explicit
+        values win.
+        """
+        raw = np.full(len(self.features), np.nan, dtype=np.float32)
+        row = self._row_by_id.get(str(patient_id))
+        if row is not None:
+            raw[:] = self.raw[row]
+        for i, feature in enumerate(self.features):
+            value = values.get(feature)
+            if feature == "sex":
+                value = sex_code_of(value)
+            elif feature == "kl_grade":
+                value = kl_grade_of(value)
+            elif isinstance(value, str):
+                # Tool-call arguments often arrive as text, e.g. age="60"
+                value = pd.to_numeric(value.strip(), errors="coerce")
+            if isinstance(value, (int, float, np.number)) and not isinstance(value, bool) and np.isfinite(value):
+                raw[i] = value
+        present = ~np.isnan(raw)
+        return raw, np.where(present, (raw - self.mean) / self.std, 0.0).astype(np.float32), present
+
+    def clinical_similarity(self, zq: np.ndarray, q_present: np.ndarray) -> np.ndarray:
+        """1 / (1 + weighted RMS z-distance) over features present in both query and row."""
+        both = self.present & q_present
+        w = both * self.weights
+        wsum = w.sum(axis=1)
+        d2 = (w * (self.z - zq) ** 2).sum(axis=1) / np.where(wsum > 0, wsum, 1.0)
+        sim = 1.0 / (1.0 + np.sqrt(d2))
+        return np.where(wsum > 0, sim, 0.0).astype(np.float32)
+
+    def search(self, values: Dict[str, Any], patient_id: str = "", k: int = 3,
+               same_sex: bool = True, kl_window: Optional[int] = 1,
+               embedding_weight: float = EMBEDDING_WEIGHT) -> List[Dict[str, Any]]:
+        """
+        Top-k knees for one query, best first. 'values' holds clinical
+        features by name (age, bmi, sex, kl_grade, womac_pain, ...). The query
+        patient's own rows are excluded.
+        """
+        raw, zq, q_present = self.query_vector(values, patient_id)
+        clinical = self.clinical_similarity(zq, q_present)
+
+        sex_i, kl_i = self.features.index("sex"), self.features.index("kl_grade")
+        sex = int(raw[sex_i]) if same_sex and q_present[sex_i] else None
+        kl = int(raw[kl_i]) if q_present[kl_i] else None
+        mask = self.filter_mask(sex, kl, kl_window)
+        if patient_id:
+            mask &= self.ids != str(patient_id)
+
+        embedding = np.full(len(self.ids), np.nan, dtype=np.float32)
+        similarities = self.embeddings.similarities(patient_id) if self.embeddings is not None and patient_id else None
+        has_embedding = self.embedding_rows >= 0
+        if similarities is not None and has_embedding.any():
+            embedding[has_embedding] = similarities[self.embedding_rows[has_embedding]]
+
+        # Cosine scores are rescaled to [0, 1] over the eligible candidates so
+        # they are on the same footing as the clinical similarity. Candidates
+        # without a score (no embedding, or not reached by an approximate
+        # index) get the median scaled score, so every candidate is ranked on
+        # the same blend instead of clinical-only scores competing with blended ones
+        scored = mask & ~np.isnan(embedding)
+        hybrid = clinical.copy()
+        if scored.any():
+            lo, hi = embedding[scored].min(), embedding[scored].max()
+            scaled = np.zeros(len(self.ids), dtype=np.float32)
+            scaled[scored] = (embedding[scored] - lo) / (hi - lo) if hi > lo else 1.0
+            scaled[mask & ~scored] = np.median(scaled[scored])
+            hybrid[mask] = embedding_weight * scaled[mask] + (1.0 - embedding_weight) * clinical[mask]
+        hybrid[~mask] = -np.inf
+
+        best, best_scores = top_k(hybrid[np.newaxis, :], k)
+        return [
+            {
+                "row": int(pos),
+                "case_id": self.ids[pos],
+                "side": self.sides[pos],
+                "similarity_score": float(score),
+                "clinical_similarity": float(clinical[pos]),
+                "embedding_similarity": None if np.isnan(embedding[pos]) else float(embedding[pos]),
+            }
+            for pos, score in zip(best[0], best_scores[0]) if np.isfinite(score)
+        ]
+
+    def search_batch(self, queries: List[Dict[str, Any]], k: int = 3, **options) -> List[List[Dict[str, Any]]]:
+        """
+        search() for several queries; each is a dict of feature values, with
+        an optional 'patient_id'.
+        """
+        return [self.search(q, patient_id=str(q.get("patient_id") or ""), k=k, **options) for q in queries]
+
+
+_retrievers: Dict[Tuple[str, str, str], Tuple[float, Tuple[Any, ...], HybridRetriever]] = {}
+_retrievers_lock = threading.Lock()
+
+def get_hybrid_retriever(data_path: str, embeddings_path: Optional[str] = None,
+                         mri_embeddings_path: Optional[str] = None,
+                         embedding_index: Callable[[str], EmbeddingIndex] = get_embedding_index) -> HybridRetriever:
+    """
+    Shared retriever; rebuilt when the clinical data or the embedding indexes
+    change. 'embedding_index' returns the index searched for an embedding
+    file (e.g. similarity_search's RETRIEVAL_BACKEND selector). With both an
+    X-ray and an MRI embedding file, embedding similarity is fused: from the
+    exact fusion index (fusion_index.py), or by late fusion of the two
+    backend indexes when either is approximate.
+    """
+    paths = [p for p in (embeddings_path, mri_embeddings_path) if p is not None]
+    try:
+        sources = tuple(embedding_index(p) for p in paths)
+    except OSError:
+        paths, sources = [], ()
+    stamp = dataset_mtime(data_path)
+    key = (data_path, embeddings_path or "", mri_embeddings_path or "")
+    with _retrievers_lock:
+        cached = _retrievers.get(key)
+        if (cached is None or cached[0] != stamp or len(cached[1]) != len(sources)
+                or any(old is not new for old, new in zip(cached[1], sources))):
+            frame = get_patient_store(data_path, HYBRID_COLUMNS).frame()
+            if len(sources) == 2:
+                approximate = any(getattr(index, "approximate", False) for index in sources)
+                embeddings = LateFusionIndex(*sources) if approximate else get_fusion_index(*paths)
+            elif sources:
+                embeddings = sources[0]
+            else:
+                embeddings = None
+            cached = (stamp, sources, HybridRetriever(frame, embeddings))
+            _retrievers[key] = cached
+        return cached[2]
@@ -0,0 +1,256 @@
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# File types listed for each patient (DICOM archives and their preview images)
+IMAGE_EXTENSIONS = (".tar.gz", ".jpg", ".jpeg", ".png")
+
+# Threads used for a full scan; directory listing is I/O bound, so threads
+# overlap the round trips to the (network) filer
+SCAN_WORKERS = 16
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    parent TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS files (
+    patient_id TEXT NOT NULL,
+    rel_path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (patient_id, rel_path)
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    checked_at REAL NOT NULL
+);
+"""
+
+
+def default_manifest_path(root: str) -> str:
+    """The manifest lives next to the image root, not inside it."""
+    return os.path.join(os.path.dirname(os.path.normpath(root)), "image_manifest.sqlite")
+
+
+class ImageManifest:
+    """
+    Persistent listing of the image tree (root/<patient_id>/...), stored in SQLite.
+    Every directory's mtime and every file's size and mtime are recorded; a
+    refresh re-lists only directories whose mtime changed or whose files were
+    rewritten or removed, and reuses the stored listing for the rest.
+    Paths are stored relative to the root with '/' separators.
+    """
+
+    def __init__(self, root: str, db_path: Optional[str] = None):
+        self.root = root
+        self.db_path = db_path or default_manifest_path(root)
+        self._lock = threading.Lock()
+        # Pool workers and sessions share the file: wait for a writer instead of failing
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+    def images_for(self, patient_id: str) -> List[str]:
+        """
+        Image IDs for a patient, formatted 'PatientID|RelPath' (RelPath relative
+        to the patient folder). The patient's directories and files are
+        stat'ed first, so the listing is current.
+        """
+        self.refresh_patient(patient_id)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rel_path FROM files WHERE patient_id = ? ORDER BY rel_path", (patient_id,)
+            ).fetchall()
+        return [f"{patient_id}|{rel_path}" for (rel_path,) in rows]
+
+    def patient_files(self, patient_id: str) -> List[str]:
+        """Paths of all listed files for a patient, relative to the patient folder (checked like images_for)."""
+        self.refresh_patient(patient_id)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rel_path FROM files WHERE patient_id = ? ORDER BY rel_path", (patient_id,)
+            ).fetchall()
+        return [rel_path for (rel_path,) in rows]
+
+    def file_stat(self, patient_id: str, rel_path: str) -> Optional[Dict[str, float]]:
+        """Recorded size and mtime for a listed file, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime FROM files WHERE patient_id = ? AND rel_path = ?", (patient_id, rel_path)
+            ).fetchone()
+        return {"size": row[0], "mtime": row[1]} if row else None
+
+    # ------------------------------------------------------------------
+    # Refresh
+    # ------------------------------------------------------------------
+    def refresh_patient(self, patient_id: str) -> int:
+        """
+        Bring one patient's listing up to date. Every directory and listed file
+        is stat'ed (no listing); only directories whose mtime changed, or with
+        a file rewritten in place or removed, are listed again. The database is
+        written only when something changed, so a lookup of an unchanged
+        patient takes no write lock. Returns the number of directories that
+        were re-listed.
+        """
+        patient_dir = os.path.join(self.root, patient_id)
+        if not os.path.isdir(patient_dir):
+            with self._lock:
+                if self._conn.execute("SELECT 1 FROM patients WHERE patient_id = ?", (patient_id,)).fetchone() is None:
+                    return 0
+                self._conn.execute("DELETE FROM files WHERE patient_id = ?", (patient_id,))
+                self._conn.execute("DELETE FROM dirs WHERE patient_id = ?", (patient_id,))
+                self._conn.execute("DELETE FROM patients WHERE patient_id = ?", (patient_id,))
+                self._conn.commit()
+            return 0
+
+        with self._lock:
+            listed_before = self._conn.execute(
+                "SELECT 1 FROM patients WHERE patient_id = ?", (patient_id,)
+            ).fetchone() is not None
+            known = {
+                path: (parent, mtime)
+                for path, parent, mtime in self._conn.execute(
+                    "SELECT path, parent, mtime FROM dirs WHERE patient_id = ?", (patient_id,)
+                )
+            }
+            known_files: Dict[str, List[Tuple[str, int, float]]] = {}
+            for rel_path, rel_dir, size, mtime in self._conn.execute(
+                "SELECT rel_path, dir, size, mtime FROM files WHERE patient_id = ?", (patient_id,)
+            ):
+                known_files.setdefault(rel_dir, []).append((rel_path, size, mtime))
+        children: Dict[str, List[str]] = {}
+        for path, (parent, _) in known.items():
+            children.setdefault(parent, []).append(path)
+
+        seen_dirs = {}
+        relisted = {}
+        stack = [(patient_id, None)]
+        while stack:
+            rel_dir, parent = stack.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime
+            except OSError:
+                continue
+            seen_dirs[rel_dir] = (parent, mtime)
+
+            unchanged = rel_dir in known and known[rel_dir][1] == mtime
+            # A file rewritten in place leaves the directory mtime alone, so check the files too
+            if unchanged and self._files_unchanged(patient_id, known_files.get(rel_dir, [])):
+                # Unchanged directory: its file list is still valid, descend via stored children
+                stack.extend((child, rel_dir) for child in children.get(rel_dir, []))
+                continue
+
+            files = []
+            with os.scandir(os.path.join(self.root, rel_dir)) as entries:
+                for entry in entries:
+                    child = f"{rel_dir}/{entry.name}"
+                    if entry.is_dir():
+                        stack.append((child, rel_dir))
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        st = entry.stat()
+                        files.append((child.split("/", 1)[1], st.st_size, st.st_mtime))
+            relisted[rel_dir] = files
+
+        removed = set(known) - set(seen_dirs)
+        if listed_before and not removed and not relisted:
+            return 0
+        with self._lock:
+            for rel_dir in removed:
+                self._conn.execute("DELETE FROM files WHERE patient_id = ? AND dir = ?", (patient_id, rel_dir))
+                self._conn.execute("DELETE FROM dirs WHERE path = ?", (rel_dir,))
+            for rel_dir, files in relisted.items():
+                self._conn.execute("DELETE FROM files WHERE patient_id = ? AND dir = ?", (patient_id, rel_dir))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO files (patient_id, rel_path, dir, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                    [(patient_id, rel_path, rel_dir, size, mtime) for rel_path, size, mtime in files],
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dirs (path, patient_id, parent, mtime) VALUES (?, ?, ?, ?)",
+                [(path, patient_id, *seen_dirs[path]) for path in relisted],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO patients (patient_id, checked_at) VALUES (?, ?)", (patient_id, time.time())
+            )
+            self._conn.commit()
+        return len(relisted)
+
+    def _files_unchanged(self, patient_id: str, files: List[Tuple[str, int, float]]) -> bool:
+        """True if every recorded file still exists with its recorded size and mtime."""
+        patient_dir = os.path.join(self.root, patient_id)
+        for rel_path, size, mtime in files:
+            try:
+                st = os.stat(os.path.join(patient_dir, *rel_path.split("/")))
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime != mtime:
+                return False
+        return True
+
+    def refresh(self, workers: int = SCAN_WORKERS) -> Dict[str, int]:
+        """
+        Scan (or incrementally rescan) every patient folder under the root in
+        parallel. Returns the number of re-listed directories per patient.
+        """
+        with os.scandir(self.root) as entries:
+            patient_ids = sorted(entry.name for entry in entries if entry.is_dir())
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            changed = dict(zip(patient_ids, pool.map(self.refresh_patient, patient_ids)))
+
+        with self._lock:
+            stale = [
+                pid for (pid,) in self._conn.execute("SELECT patient_id FROM patients")
+                if pid not in changed
+            ]
+        for pid in stale:
+            self.refresh_patient(pid)
+        return changed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_manifests: Dict[Tuple[str, int], ImageManifest] = {}
+_manifests_lock = threading.Lock()
+
+def get_image_manifest(root: str) -> ImageManifest:
+    """Return the shared manifest for an image root, opening it on first use."""
+    with _manifests_lock:
+        # Keyed by PID too: a SQLite connection must not be reused in a forked pool worker
+        key = (root, os.getpid())
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = ImageManifest(root)
+            _manifests[key] = manifest
+        return manifest
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.imaging_analysis import IMG_BASE_DIR
+
+    parser = argparse.ArgumentParser(description="Build or incrementally update the image manifest.")
+    parser.add_argument("root", nargs="?", default=IMG_BASE_DIR)
+    parser.add_argument("--workers", type=int, default=SCAN_WORKERS)
+    args = parser.parse_args()
+
+    start = time.time()
+    manifest = ImageManifest(args.root)
+    changed = manifest.refresh(workers=args.workers)
+    relisted = sum(changed.values())
+    print(f"Scanned {len(changed)} patients ({relisted} directories re-listed) in {time.time() - start:.1f}s")
+    print(f"Manifest: {manifest.db_path}")
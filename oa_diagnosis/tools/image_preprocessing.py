@@ -0,0 +1,106 @@
+import io
+import pydicom
+import numpy as np
+from PIL import Image
+from typing import List, Optional, Tuple
+from oa_diagnosis.tools.mri_stack import iter_stack_slices
+from oa_diagnosis.tools.seekable_archive import read_first_member
+
+# ResNet input: 3 x 224 x 224, ImageNet channel statistics
+INPUT_SIZE = 224
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+# Intensity window (percentiles) mapped to [0, 1] before normalization; robust
+# to the few saturated pixels typical of radiographs
+WINDOW_PERCENTILES = (1.0, 99.0)
+
+# Slices of an MRI series fed to the model (evenly spaced through the stack)
+MRI_SLICES = 16
+
+
+def _window_and_resize(pixels: np.ndarray, invert: bool = False) -> np.ndarray:
+    # Percentile windowing to [0, 1] and bilinear resize, still single channel
+    pixels = np.asarray(pixels, dtype=np.float32)
+    lo, hi = np.percentile(pixels, WINDOW_PERCENTILES)
+    scaled = np.clip((pixels - lo) / (hi - lo), 0.0, 1.0) if hi > lo else np.zeros_like(pixels)
+    if invert:
+        scaled = 1.0 - scaled
+    return np.asarray(
+        Image.fromarray(scaled, mode="F").resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR),
+        dtype=np.float32,
+    )
+
+
+def _normalize(grey: np.ndarray) -> np.ndarray:
+    return (np.broadcast_to(grey, (3, INPUT_SIZE, INPUT_SIZE)) - IMAGENET_MEAN) / IMAGENET_STD
+
+
+def to_model_input(pixels: np.ndarray, invert: bool = False) -> np.ndarray:
+    """
+    One 2-D image (any dtype/size) -> float32 (3, INPUT_SIZE, INPUT_SIZE)
+    tensor: percentile windowing, bilinear resize, grey replicated to three
+    channels, ImageNet normalization.
+    """
+    return _normalize(_window_and_resize(pixels, invert))
+
+
+def _is_inverted(ds: pydicom.Dataset) -> bool:
+    # MONOCHROME1: low values are displayed white
+    return str(ds.get("PhotometricInterpretation", "")) == "MONOCHROME1"
+
+
+def dicom_input(ds: pydicom.Dataset, pixels: Optional[np.ndarray] = None) -> np.ndarray:
+    """Model input for one decoded DICOM image, shape (1, 3, H, W) (first frame if multi-frame)."""
+    pixels = ds.pixel_array if pixels is None else pixels
+    if pixels.ndim > 2:
+        pixels = pixels[0]
+    return to_model_input(pixels, _is_inverted(ds))[np.newaxis]
+
+
+def preview_input(image_path: str) -> np.ndarray:
+    """Model input from a JPG/PNG preview image, shape (1, 3, H, W)."""
+    with Image.open(image_path) as img:
+        return to_model_input(np.asarray(img.convert("L")))[np.newaxis]
+
+
+def study_inputs(tar_gz_path: str, modality: str, max_slices: int = MRI_SLICES) -> np.ndarray:
+    """
+    Model inputs for a DICOM study archive, shape (n, 3, H, W): the first
+    image for radiographs, up to max_slices evenly spaced slices for an MR
+    series. Slices are subsampled while streaming: at most 2 * max_slices are
+    kept (reduced to model size as they are read), so memory stays bounded
+    for any series length or resolution.
+    """
+    if modality != "MR":
+        _, raw = read_first_member(tar_gz_path)
+        if raw is None:
+            raise ValueError("No valid file found inside archive")
+        return dicom_input(pydicom.dcmread(io.BytesIO(raw)))
+
+    # Every z_step-th slice is kept single channel at model size; when the
+    # kept set outgrows 2 * max_slices, every other one is dropped and the
+    # stride doubles (same scheme as mri_stack.analyze_stack)
+    max_slices = max(1, max_slices)
+    kept: List[np.ndarray] = []
+    z_step = 1
+    for index, (_, ds, pixels) in enumerate(iter_stack_slices(tar_gz_path)):
+        if index % z_step:
+            continue
+        kept.append(_window_and_resize(pixels, _is_inverted(ds)))
+        if len(kept) > 2 * max_slices:
+            kept = kept[::2]
+            z_step *= 2
+    if not kept:
+        raise ValueError("No image slices found in archive")
+    picks = np.unique(np.linspace(0, len(kept) - 1, min(max_slices, len(kept))).round().astype(int))
+    return np.stack([_normalize(kept[i]) for i in picks])
+
+
+def batch_inputs(inputs: List[np.ndarray]) -> Tuple[np.ndarray, List[int]]:
+    """
+    Concatenate per-study inputs into one batch; returns the batch and each
+    study's slice count (to split model outputs back per study).
+    """
+    counts = [len(x) for x in inputs]
+    return np.ascontiguousarray(np.concatenate(inputs)), counts
@@ -1,21 +1,236 @@
 import os
-import tarfile
 import pydicom
 import numpy as np
 import io
-from typing import Dict, Any
+import sqlite3
+import posixpath
+import threading
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
 from PIL import Image
+from oa_diagnosis.tools.image_manifest import get_image_manifest
+from oa_diagnosis.tools.imaging_cache import cache_key, get_imaging_cache
+from oa_diagnosis.tools.seekable_archive import read_first_member
+from oa_diagnosis.tools.mri_stack import analyze_stack, summarize_stack
+from oa_diagnosis.tools.dicom_catalog import MODALITY_NAMES, get_dicom_catalog, is_knee, parse_header, study_for_preview
+from oa_diagnosis.tools.image_preprocessing import dicom_input, study_inputs, to_model_input
+from oa_diagnosis.tools.kl_inference import KL_DESCRIPTIONS, find_kl_model, get_kl_engine
+from oa_diagnosis.tools.linear_probe import PROBE_TASKS, probe_path_for, probe_predictions
 
 # Base path for images
 IMG_BASE_DIR = r"c:\Users\pahad\Desktop\AutoGen\data\img"
 
+# Bump whenever the analysis output changes, so cached results are not reused
+ANALYZER_VERSION = "7"
+
+# Processes in the imaging pool shared by all batch calls (default: CPU count)
+IMAGING_POOL_WORKERS = None
+
+# Set in pool workers: they decode and preprocess but never load the KL model;
+# the model inputs go back to the parent's engine under _KL_PENDING
+_IN_POOL_WORKER = False
+_KL_PENDING = "_kl_pending"
+
+def _cache_dir():
+    return os.path.join(os.path.dirname(os.path.normpath(IMG_BASE_DIR)), "cache", "imaging")
+
+def _model_dir():
+    return os.path.join(os.path.dirname(os.path.normpath(IMG_BASE_DIR)), "model")
+
+def _probe_embeddings_path():
+    # X-ray embeddings the linear probes (linear_probe.py) were trained on
+    from oa_diagnosis.tools.similarity_search import XRAY_EMBEDDINGS_PATH
+    return os.path.join(_model_dir(), os.path.basename(XRAY_EMBEDDINGS_PATH))
+
+def _analyzer_version() -> str:
+    # Results depend on the installed KL model and probes too: a new or
+    # retrained model must not be served placeholder or stale cached predictions
+    version = ANALYZER_VERSION
+    model_path = find_kl_model(_model_dir())
+    if model_path is not None:
+        version += f"|{os.path.basename(model_path)}|{os.path.getmtime(model_path)}"
+    for task in PROBE_TASKS:
+        path = probe_path_for(_probe_embeddings_path(), task)
+        if os.path.exists(path):
+            version += f"|probe_{task}|{os.path.getmtime(path)}"
+    return version
+
 def analyze_imaging(image_id: str) -> Dict[str, Any]:
     """
     Analyzes an MRI/X-Ray image.
     Expects image_id in format: 'PatientID|RelativePathToTarGz'
     Example: '9001695|20041228/00456208.tar.gz'
+    Results are cached by (path, size, mtime, ANALYZER_VERSION, KL model), so
+    repeat views of the same image do not re-open the archive.
+    """
+    key, cached = _cache_lookup(image_id)
+    if cached is not None:
+        return cached
+
+    result = _analyze_imaging_uncached(image_id)
+    _cache_store(key, result)
+    return result
+
+def analyze_imaging_batch(image_ids: List[str], workers: Optional[int] = None) -> List[Dict[str, Any]]:
     """
-    
+    Analyze many images at once; returns results in the order of image_ids.
+    See analyze_imaging_as_completed.
+    """
+    results = dict(analyze_imaging_as_completed(image_ids, workers=workers))
+    return [results[image_id] for image_id in image_ids]
+
+def analyze_imaging_as_completed(image_ids: Iterable[str], workers: Optional[int] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yield (image_id, result) as each analysis finishes. Cached results are
+    yielded first; the rest are decompressed and decoded on the shared
+    process pool, at most 'workers' at a time (default: CPU count), and
+    their KL inference runs on this process's batching engine. A
+    failure, even a crashed worker, only produces an error result for the
+    images affected: after a crash the pool is replaced and the images that
+    were in flight are retried one at a time, so only the image that brings
+    a worker down again gets the error.
+    """
+    pending = {}
+    for image_id in dict.fromkeys(image_ids):
+        key, cached = _cache_lookup(image_id)
+        if cached is not None:
+            yield image_id, cached
+        else:
+            pending[image_id] = key
+
+    if not pending:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(pending))
+    if workers <= 1:
+        for image_id, key in pending.items():
+            result = _analyze_imaging_uncached(image_id)
+            _cache_store(key, result)
+            yield image_id, result
+        return
+
+    waiting = list(pending)
+    suspects: List[str] = []
+    alone: Optional[str] = None
+    running: Dict[Future, str] = {}
+    inferring: Dict[Future, Tuple[str, Dict[str, Any], str]] = {}
+    pool = _imaging_pool()
+    try:
+        while waiting or suspects or running or inferring:
+            if alone is None and suspects:
+                alone = suspects.pop(0)
+                running[pool.submit(_analyze_in_worker, alone, IMG_BASE_DIR)] = alone
+            elif alone is None:
+                while waiting and len(running) < workers:
+                    image_id = waiting.pop(0)
+                    running[pool.submit(_analyze_in_worker, image_id, IMG_BASE_DIR)] = image_id
+
+            done, _ = wait(list(running) + list(inferring), return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                if future in inferring:
+                    image_id, result, engine_name = inferring.pop(future)
+                    kl_pending = result.pop(_KL_PENDING)
+                    try:
+                        result.update(_engine_kl_fields(engine_name, future.result()))
+                    except Exception:
+                        result.update(_fallback_kl_fields(*kl_pending["fallback"]))
+                    _cache_store(pending[image_id], result)
+                    yield image_id, result
+                    continue
+                image_id = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    if image_id != alone:
+                        suspects.append(image_id)
+                        continue
+                    result = {"error": f"Failed to process image: worker process crashed ({str(e)})"}
+                except Exception as e:
+                    result = {"error": f"Failed to process image: {str(e)}"}
+                if image_id == alone:
+                    alone = None
+                if _KL_PENDING in result:
+                    # Decoded in the worker; the model runs here, batched with
+                    # other workers' and sessions' requests
+                    engine = _kl_engine()
+                    if engine is not None:
+                        try:
+                            inferring[engine.submit(result[_KL_PENDING]["inputs"])] = (image_id, result, engine.name)
+                            continue
+                        except Exception:
+                            pass
+                    kl_pending = result.pop(_KL_PENDING)
+                    result.update(_fallback_kl_fields(*kl_pending["fallback"]))
+                _cache_store(pending[image_id], result)
+                yield image_id, result
+            if broken:
+                # Every other future of a broken pool fails too; none of them ran to completion
+                suspects.extend(running.values())
+                running.clear()
+                pool = _imaging_pool(broken=pool)
+    finally:
+        for future in running:
+            future.cancel()
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def _imaging_pool(broken: Optional[ProcessPoolExecutor] = None) -> ProcessPoolExecutor:
+    """
+    The process pool shared by batch calls, created on first use; passing the
+    'broken' pool replaces it. Workers are started with forkserver (spawn
+    where that is unavailable), never fork: callers are threads of a busy
+    process, and a forked child can inherit a lock another thread was holding.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool is broken:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=IMAGING_POOL_WORKERS or os.cpu_count(), mp_context=context)
+        return _pool
+
+def _analyze_in_worker(image_id: str, img_base_dir: str) -> Dict[str, Any]:
+    # Runs in a pool process, which starts with a fresh copy of this module;
+    # carry the parent's image root over
+    global IMG_BASE_DIR, _IN_POOL_WORKER
+    IMG_BASE_DIR = img_base_dir
+    _IN_POOL_WORKER = True
+    return _analyze_imaging_uncached(image_id)
+
+def _kl_engine():
+    # A model that cannot be loaded means the fallback fields, never a failed batch
+    try:
+        return get_kl_engine(_model_dir())
+    except Exception:
+        return None
+
+def _cache_lookup(image_id: str):
+    """Returns (cache key or None, cached result or None)."""
+    if "|" not in image_id:
+        return None, None
+
+    patient_id, rel_path = image_id.split("|", 1)
+    file_path = os.path.join(IMG_BASE_DIR, patient_id, rel_path)
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None, None
+
+    key = cache_key(file_path, st.st_size, st.st_mtime_ns, _analyzer_version())
+    return key, get_imaging_cache(_cache_dir()).get(key)
+
+def _cache_store(key: Optional[str], result: Dict[str, Any]):
+    # Errors are not cached; they may be transient (e.g. a half-copied archive)
+    if key is not None and isinstance(result, dict) and "error" not in result:
+        get_imaging_cache(_cache_dir()).put(key, result)
+
+def _analyze_imaging_uncached(image_id: str) -> Dict[str, Any]:
     # 1. Parse ID
     if "|" not in image_id:
         # Fallback for old mock IDs or if formatted incorrectly
@@ -41,17 +256,21 @@ def analyze_imaging(image_id: str) -> Dict[str, Any]:
                 mean_intensity = np.mean(pixel_data)
                 std_intensity = np.std(pixel_data)
 
-                pseudo_random_score = (int(mean_intensity) % 4) + 1
-                kl_mapping = {
-                    1: "KL=1 (Doubtful)",
-                    2: "KL=2 (Mild)",
-                    3: "KL=3 (Moderate)",
-                    4: "KL=4 (Severe)"
-                }
-                prediction = kl_mapping.get(pseudo_random_score, "KL=0")
-
-                # Determine modality based on image path patterns and naming conventions
+                # Determine modality from the header catalog entry of the study this preview belongs to
                 modality = "Unknown"
+                body_part = "Unknown"
+                study_date = "Unknown"
+                catalog = _catalog()
+                study = study_for_preview(rel_path, catalog.entries_for(patient_id)) if catalog else None
+                if study and not study.get("error"):
+                    if not is_knee(study):
+                        return _skipped_result(image_id, study["body_part"] or "Unknown")
+                    if study.get("modality"):
+                        modality = MODALITY_NAMES.get(study["modality"], study["modality"])
+                    body_part = study.get("body_part") or body_part
+                    study_date = study.get("study_date") or study_date
+
+                # Otherwise fall back to image path patterns and naming conventions
                 # Mapping of known patient/date/image patterns to modalities
                 modality_map = {
                     "9001695|20041203": "X-Ray",      # 00422803_1x1.jpg is X-Ray
@@ -59,7 +278,7 @@ def analyze_imaging(image_id: str) -> Dict[str, Any]:
                 }
                 # Check if image_id prefix matches any known modality pattern
                 for pattern, mod in modality_map.items():
-                    if image_id.startswith(pattern):
+                    if modality == "Unknown" and image_id.startswith(pattern):
                         modality = mod
                         break
                 
@@ -70,143 +289,261 @@ def analyze_imaging(image_id: str) -> Dict[str, Any]:
                     elif "_2x2" in rel_path:
                         modality = "MRI"
 
-                return {
+                result = {
                     "image_id": image_id,
                     "status": "Processed Preview Image",
                     "image_path": file_path,
                     "metadata": {
                         "Modality": modality,
-                        "BodyPart": "Unknown",
-                        "Date": "Unknown",
+                        "BodyPart": body_part,
+                        "Date": study_date,
                         "ImageStats": f"Mean:{mean_intensity:.1f}, Std:{std_intensity:.1f}"
                     },
-                    "resnet_prediction": prediction,
-                    "kl_grade": pseudo_random_score,
-                    "kl_description": f"KL Grade {pseudo_random_score}: {prediction}",
                     "cartilage_loss": "Simulated from preview",
                     "osteophytes": "Simulated from preview",
                     "effusion": "Unknown",
-                    "mock_resnet_score": round(std_intensity / 1000.0, 2)
                 }
+                result.update(_kl_fields(lambda: to_model_input(pixel_data)[np.newaxis], mean_intensity, std_intensity,
+                                         patient_id, modality))
+                return result
             except Exception as e:
                 return {"error": f"Failed to process preview image: {str(e)}"}
-        # 3. Open .tar.gz and find DICOM
-        with tarfile.open(file_path, "r:gz") as tar:
-            # Find first valid file member (often named '001' or similar without extension)
-            dicom_member = None
-            for member in tar.getmembers():
-                if member.isfile() and member.name != ".":
-                    dicom_member = member
-                    break
-            
-            if not dicom_member:
-                 return {"error": "No valid file found inside archive. Value is missing."}
-
-            # 4. Read DICOM
-            f = tar.extractfile(dicom_member)
-            dicom_data = pydicom.dcmread(f)
-            
-            # 5. Extract Metadata
-            modality = dicom_data.get("Modality", "Unknown")
-            body_part = dicom_data.get("BodyPartExamined", "Unknown")
-            study_date = dicom_data.get("StudyDate", "Unknown")
-            
-            # FILTER: Only process KNEE images, skip hand and other body parts
-            if body_part and body_part.upper() != "KNEE":
-                return {
-                    "image_id": image_id,
-                    "status": "Skipped - Not a knee image",
-                    "body_part": body_part,
-                    "message": f"This is a {body_part} image. Only knee images are analyzed in this system."
-                }
-            
-            # 6. "Process" Image (Simulate Deep Learning Inference)
-            # In a real system, we would pass 'dicom_data.pixel_array' to a ResNet model.
-            # Here, we calculate stats to verify we read the pixels.
+        # 3. Skip studies the header catalog already knows are not knees,
+        # without opening the archive
+        catalog = _catalog()
+        entry = catalog.lookup(patient_id, rel_path) if catalog else None
+        if entry and not is_knee(entry):
+            return _skipped_result(image_id, entry["body_part"] or "Unknown")
+
+        # 4. Read the first DICOM member, by offset from the seekable copy of
+        # the study if one has been built, else by streaming the .tar.gz
+        member_name, raw = read_first_member(file_path)
+        if member_name is None:
+            return {"error": "No valid file found inside archive. Value is missing."}
+
+        # 5. Read the DICOM header first, so non-knee images are skipped
+        # before their pixel data is decoded
+        header = parse_header(raw)
+        if catalog:
+            # Best effort: a locked or failing catalog must not fail a decoded image
+            try:
+                st = os.stat(file_path)
+                catalog.record(dict(header, member=member_name, error=None, patient_id=patient_id,
+                                    rel_path=rel_path, size=st.st_size, mtime_ns=st.st_mtime_ns))
+            except (sqlite3.Error, OSError) as e:
+                print(f"DEBUG: Could not record {image_id} in the DICOM catalog: {e}")
+
+        modality = header["modality"] or "Unknown"
+        body_part = header["body_part"] if header["body_part"] is not None else "Unknown"
+        study_date = header["study_date"] or "Unknown"
+        
+        # FILTER: Only process KNEE images, skip hand and other body parts
+        if not is_knee(header):
+            return _skipped_result(image_id, body_part)
+
+        # 6. Pixel statistics, and the model inputs for KL inference (built
+        # only if a KL model is installed)
+        stack_summary = None
+        if header["modality"] == "MR":
+            # MRI series: stream every slice of the study with bounded memory
+            # instead of looking only at the first member
+            stack = analyze_stack(file_path)
+            stack_summary = summarize_stack(stack)
+            mean_intensity = stack["mean"]
+            std_intensity = stack["std"]
+            model_inputs = lambda: study_inputs(file_path, "MR")
+        else:
+            dicom_data = pydicom.dcmread(io.BytesIO(raw))
             pixel_data = dicom_data.pixel_array
             mean_intensity = np.mean(pixel_data)
             std_intensity = np.std(pixel_data)
-            
-            # deterministic mock prediction based on pixel stats to seem consistent
-            # This simulates "Model Inference"
-            pseudo_random_score = (int(mean_intensity) % 4) + 1  # 1 to 4 KL grade
-            
-            # Map stats to output structure
-            kl_mapping = {
-                1: "KL=1 (Doubtful)",
-                2: "KL=2 (Mild)",
-                3: "KL=3 (Moderate)",
-                4: "KL=4 (Severe)"
-            }
-            
-            prediction = kl_mapping.get(pseudo_random_score, "KL=0")
-            
-            # Find the corresponding JPG preview file(s)
-            # Common layouts in dataset:
-            # - preview named like "00422803_1x1.jpg" next to the tar
-            # - preview named like "00422803.jpg" or "00422803_1.jpg"
-            # - multiple jpgs in the same folder (choose the one matching basename or first jpg)
-            import glob
-            tar_basename = os.path.basename(file_path).replace('.tar.gz', '')
-            tar_dir = os.path.dirname(file_path)
-
-            candidates = []
-            # preferred exact patterns
-            candidates.append(os.path.join(tar_dir, f"{tar_basename}_1x1.jpg"))
-            candidates.append(os.path.join(tar_dir, f"{tar_basename}.jpg"))
-            candidates.append(os.path.join(tar_dir, f"{tar_basename}_1.jpg"))
-            candidates.append(os.path.join(tar_dir, f"{tar_basename}_0.jpg"))
-
-            # glob patterns that include the basename
-            candidates.extend(glob.glob(os.path.join(tar_dir, f"{tar_basename}*.jpg")))
-
-            # if still nothing, pick any jpg in the same directory
-            if not any(os.path.exists(p) for p in candidates):
-                jpgs = sorted(glob.glob(os.path.join(tar_dir, "*.jpg")))
-                if jpgs:
-                    candidates.extend(jpgs)
-
-            # select the first existing candidate, or None
-            image_preview_path = None
-            for p in candidates:
-                if p and os.path.exists(p):
-                    image_preview_path = p
-                    break
-
-            # Fallback: search recursively within the patient's folder for matching previews
-            if not image_preview_path:
-                try:
-                    patient_dir = os.path.join(IMG_BASE_DIR, patient_id)
-                    recursive_matches = glob.glob(os.path.join(patient_dir, "**", f"{tar_basename}*.jpg"), recursive=True)
-                    if recursive_matches:
-                        # Prefer files in date folders (contain digits) or take first
-                        image_preview_path = sorted(recursive_matches)[0]
-                except Exception:
-                    pass
-            
-            return {
-                "image_id": image_id,
-                "status": "Processed Real DICOM",
-                "file_read": dicom_member.name,
-                "image_path": image_preview_path,  # Add preview image path
-                "metadata": {
-                    "Modality": modality,
-                    "BodyPart": body_part,
-                    "Date": study_date,
-                    "ImageStats": f"Mean:{mean_intensity:.1f}, Std:{std_intensity:.1f}"
-                },
-                "resnet_prediction": prediction,
-                "kl_grade": pseudo_random_score,
-                "kl_description": f"KL Grade {pseudo_random_score}: {prediction}",  # Human-readable KL description
-                "cartilage_loss": "Simulated extraction from image features",
-                "osteophytes": "Simulated extraction from image features",
-                "effusion": "None detected (Model)",
-                "mock_resnet_score": round(std_intensity / 1000.0, 2) # Mock probability
-            }
+            model_inputs = lambda: dicom_input(dicom_data, pixel_data)
+        
+        # Find the corresponding JPG preview file(s)
+        image_preview_path = _find_preview_image(patient_id, rel_path)
+        
+        result = {
+            "image_id": image_id,
+            "status": "Processed Real DICOM",
+            "file_read": member_name,
+            "image_path": image_preview_path,  # Add preview image path
+            "metadata": {
+                "Modality": modality,
+                "BodyPart": body_part,
+                "Date": study_date,
+                "ImageStats": f"Mean:{mean_intensity:.1f}, Std:{std_intensity:.1f}"
+            },
+            "cartilage_loss": "Simulated extraction from image features",
+            "osteophytes": "Simulated extraction from image features",
+            "effusion": "None detected (Model)",
+        }
+        result.update(_kl_fields(model_inputs, mean_intensity, std_intensity, patient_id,
+                                 MODALITY_NAMES.get(modality, modality)))
+        if stack_summary is not None:
+            result["stack"] = stack_summary
+        return result
 
     except Exception as e:
         return {"error": f"Failed to process image: {str(e)}"}
 
+def _kl_fields(model_inputs, mean_intensity: float, std_intensity: float, patient_id: str,
+               modality: str) -> Dict[str, Any]:
+    """
+    KL fields of a result. With a KL classifier installed in the model folder
+    (kl_inference.py) the preprocessed image goes through the shared batching
+    engine. Otherwise, for an X-ray whose patient has an embedding and
+    validated linear probes (linear_probe.py), the patient-level estimate from
+    the embedding is added (kl_grade_estimate, kl_estimate_*) next to the
+    placeholder derived from pixel statistics: it is not a reading of this
+    image, and MRI studies never get it.
+    A pool worker returns the model inputs under _KL_PENDING instead, and the
+    parent completes the fields (analyze_imaging_as_completed).
+    """
+    engine = None
+    if _IN_POOL_WORKER:
+        if find_kl_model(_model_dir()) is not None:
+            try:
+                fallback = (float(mean_intensity), float(std_intensity), patient_id, modality)
+                return {_KL_PENDING: {"inputs": model_inputs(), "fallback": fallback}}
+            except Exception:
+                pass
+    else:
+        engine = _kl_engine()
+    if engine is not None:
+        try:
+            predicted = engine.predict(model_inputs())
+        except Exception:
+            predicted = None
+        if predicted is not None:
+            return _engine_kl_fields(engine.name, predicted)
+    return _fallback_kl_fields(mean_intensity, std_intensity, patient_id, modality)
+
+def _engine_kl_fields(engine_name: str, predicted: Dict[str, Any]) -> Dict[str, Any]:
+    grade = predicted["kl_grade"]
+    prediction = KL_DESCRIPTIONS.get(grade, f"KL={grade}")
+    return {
+        "resnet_prediction": prediction,
+        "kl_grade": grade,
+        "kl_description": f"KL Grade {grade}: {prediction}",
+        "kl_probabilities": predicted["probabilities"],
+        "resnet_score": predicted["confidence"],
+        "kl_model": engine_name,
+    }
+
+def _fallback_kl_fields(mean_intensity: float, std_intensity: float, patient_id: str, modality: str) -> Dict[str, Any]:
+    # deterministic mock prediction based on pixel stats to seem consistent
+    pseudo_random_score = (int(mean_intensity) % 4) + 1  # 1 to 4 KL grade
+    prediction = KL_DESCRIPTIONS[pseudo_random_score]
+    fields = {
+        "resnet_prediction": prediction,
+        "kl_grade": pseudo_random_score,
+        "kl_description": f"KL Grade {pseudo_random_score}: {prediction}",  # Human-readable KL description
+        "mock_resnet_score": round(std_intensity / 1000.0, 2)  # Mock probability
+    }
+
+    probed = None
+    if modality == "X-Ray":
+        # The probes were trained on X-ray embeddings with patient-level labels
+        try:
+            probed = probe_predictions(patient_id, _probe_embeddings_path())
+        except (OSError, ValueError):
+            probed = None
+    if probed is not None and "kl_grade" in probed:
+        # Next to the image's fields, not instead of them: it is a patient-level estimate
+        grade = probed["kl_grade"]
+        fields.update({
+            "kl_grade_estimate": grade,
+            "kl_estimate_description": f"KL Grade {grade} (estimated from the patient's X-ray embedding): "
+                                       f"{KL_DESCRIPTIONS.get(grade, f'KL={grade}')}",
+            "kl_estimate_probabilities": probed["kl_grade_probabilities"],
+            "kl_estimate_confidence": probed["kl_grade_confidence"],
+            "kl_estimate_source": "X-ray embedding linear probe",
+        })
+        if "progression" in probed:
+            fields["progression_estimate"] = probed["progression"]
+            fields["progression_probabilities"] = probed["progression_probabilities"]
+    return fields
+
+def _catalog():
+    try:
+        return get_dicom_catalog(IMG_BASE_DIR)
+    except (sqlite3.Error, OSError):
+        return None
+
+def _skipped_result(image_id: str, body_part: str) -> Dict[str, Any]:
+    return {
+        "image_id": image_id,
+        "status": "Skipped - Not a knee image",
+        "body_part": body_part,
+        "message": f"This is a {body_part} image. Only knee images are analyzed in this system."
+    }
+
+def _find_preview_image(patient_id: str, rel_path: str):
+    """
+    Locate the JPG preview for a DICOM archive using the image manifest
+    instead of globbing the filesystem; globs the folder (_glob_preview_image)
+    if the manifest cannot be read or lists no preview.
+    Common layouts in dataset:
+    - preview named like "00422803_1x1.jpg" next to the tar
+    - preview named like "00422803.jpg" or "00422803_1.jpg"
+    - multiple jpgs in the same folder (choose the one matching basename or first jpg)
+    """
+    try:
+        listed = get_image_manifest(IMG_BASE_DIR).patient_files(patient_id)
+    except (sqlite3.Error, OSError):
+        return _glob_preview_image(patient_id, rel_path)
+
+    tar_dir, tar_name = posixpath.split(rel_path)
+    tar_basename = tar_name.replace('.tar.gz', '')
+    jpgs = [p for p in listed if p.endswith('.jpg')]
+    same_dir = [p for p in jpgs if posixpath.dirname(p) == tar_dir]
+
+    # preferred exact patterns, then names that include the basename,
+    # then any jpg in the same directory
+    preferred = [posixpath.join(tar_dir, f"{tar_basename}{suffix}.jpg") for suffix in ("_1x1", "", "_1", "_0")]
+    candidates = [p for p in preferred if p in same_dir]
+    candidates += [p for p in same_dir if posixpath.basename(p).startswith(tar_basename)]
+    if not candidates:
+        candidates = same_dir
+    # Fallback: matching previews anywhere within the patient's folder
+    if not candidates:
+        candidates = [p for p in jpgs if posixpath.basename(p).startswith(tar_basename)]
+
+    if not candidates:
+        return _glob_preview_image(patient_id, rel_path)
+    return os.path.join(IMG_BASE_DIR, patient_id, *candidates[0].split('/'))
+
+def _glob_preview_image(patient_id: str, rel_path: str):
+    """_find_preview_image's search straight on the filesystem, for when the manifest can't answer."""
+    import glob
+    file_path = os.path.join(IMG_BASE_DIR, patient_id, *rel_path.split('/'))
+    tar_basename = os.path.basename(file_path).replace('.tar.gz', '')
+    tar_dir = os.path.dirname(file_path)
+
+    candidates = []
+    # preferred exact patterns
+    candidates.append(os.path.join(tar_dir, f"{tar_basename}_1x1.jpg"))
+    candidates.append(os.path.join(tar_dir, f"{tar_basename}.jpg"))
+    candidates.append(os.path.join(tar_dir, f"{tar_basename}_1.jpg"))
+    candidates.append(os.path.join(tar_dir, f"{tar_basename}_0.jpg"))
+
+    # glob patterns that include the basename
+    candidates.extend(glob.glob(os.path.join(tar_dir, f"{tar_basename}*.jpg")))
+
+    # if still nothing, pick any jpg in the same directory
+    if not any(os.path.exists(p) for p in candidates):
+        candidates.extend(sorted(glob.glob(os.path.join(tar_dir, "*.jpg"))))
+
+    # select the first existing candidate
+    for p in candidates:
+        if p and os.path.exists(p):
+            return p
+
+    # Fallback: search recursively within the patient's folder for matching previews
+    patient_dir = os.path.join(IMG_BASE_DIR, patient_id)
+    recursive_matches = glob.glob(os.path.join(patient_dir, "**", f"{tar_basename}*.jpg"), recursive=True)
+    return sorted(recursive_matches)[0] if recursive_matches else None
+
 def _get_mock_result(image_id):
     # Legacy/Simulated fallback for unit tests
     results = {
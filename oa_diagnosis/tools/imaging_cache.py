@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# In-memory entries kept per process
+MEMORY_MAX_ENTRIES = 1024
+
+# Disk budget for cached results; oldest entries are evicted past this
+DISK_MAX_BYTES = 256 * 1024 * 1024
+
+# After an eviction pass the disk cache is trimmed to this fraction of the budget
+DISK_EVICT_TARGET = 0.9
+
+
+def cache_key(file_path: str, size: int, mtime_ns: int, version: str) -> str:
+    """Content address of an analysis result: file identity plus analyzer version."""
+    raw = f"{os.path.abspath(file_path)}|{size}|{mtime_ns}|{version}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ImagingResultCache:
+    """
+    Two-level cache of analyze_imaging results: an in-memory LRU in front of a
+    directory of JSON files shared by every process on the host.
+    Entries are stored as JSON text, so each get() returns a fresh copy that
+    callers can modify freely.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = MEMORY_MAX_ENTRIES, max_bytes: int = DISK_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return json.loads(text)
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            # Touch the file so disk eviction sees it as recently used
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._remember(key, text)
+        return json.loads(text)
+
+    def put(self, key: str, result: Dict[str, Any]):
+        text = json.dumps(result, default=str)
+        with self._lock:
+            self._remember(key, text)
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            # Overwriting an entry replaces its bytes rather than adding to them
+            try:
+                old_size = os.stat(path).st_size
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+        except OSError:
+            # Disk tier is best effort; the in-memory entry still serves this process
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += len(text.encode("utf-8")) - old_size
+            over_budget = self._disk_bytes > self.max_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _remember(self, key: str, text: str):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _scan_disk_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict_disk(self):
+        """Delete least recently used files until the cache is under its target size."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * DISK_EVICT_TARGET
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def clear(self):
+        """Drop every cached result, in memory and on disk."""
+        with self._lock:
+            self._memory.clear()
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = 0
+
+
+_caches: Dict[str, ImagingResultCache] = {}
+_caches_lock = threading.Lock()
+
+def get_imaging_cache(cache_dir: str) -> ImagingResultCache:
+    """Return the process-wide cache for a cache directory."""
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = ImagingResultCache(cache_dir)
+            _caches[cache_dir] = cache
+        return cache
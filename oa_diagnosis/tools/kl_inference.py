@@ -0,0 +1,227 @@
+import os
+import time
+import queue
+import threading
+import argparse
+import numpy as np
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+from oa_diagnosis.tools.image_preprocessing import INPUT_SIZE, batch_inputs
+
+# KL classifier files looked up in the model folder, in order of preference:
+# ONNX (onnxruntime) or TorchScript (torch.jit.save). Either one maps a
+# (n, 3, 224, 224) float32 batch to (n, 5) logits for KL grades 0-4.
+KL_MODEL_NAMES = ("resnet18_kl.onnx", "resnet18_kl.pt")
+
+# Requests arriving within this window of the first one share a model call,
+# up to MAX_BATCH_IMAGES images (MRI studies contribute several slices)
+BATCH_WINDOW_SECONDS = 0.005
+MAX_BATCH_IMAGES = 32
+
+# Intra-op threads of the classifier. Imaging pool workers only preprocess;
+# their inputs are batched on the parent's engine (imaging_analysis.py)
+INFERENCE_THREADS = 2
+
+KL_DESCRIPTIONS = {
+    0: "KL=0 (None)",
+    1: "KL=1 (Doubtful)",
+    2: "KL=2 (Mild)",
+    3: "KL=3 (Moderate)",
+    4: "KL=4 (Severe)",
+}
+
+
+class OnnxClassifier:
+    """CPU ONNX Runtime session for an exported classifier."""
+
+    def __init__(self, model_path: str, threads: int = INFERENCE_THREADS):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def logits(self, batch: np.ndarray) -> np.ndarray:
+        return np.asarray(self.session.run(None, {self.input_name: batch})[0], dtype=np.float32)
+
+
+class TorchScriptClassifier:
+    """CPU TorchScript module for a classifier saved with torch.jit.save."""
+
+    def __init__(self, model_path: str, threads: int = INFERENCE_THREADS):
+        import torch
+        torch.set_num_threads(threads)
+        self._torch = torch
+        self.model = torch.jit.load(model_path, map_location="cpu").eval()
+
+    def logits(self, batch: np.ndarray) -> np.ndarray:
+        with self._torch.inference_mode():
+            return self.model(self._torch.from_numpy(batch)).numpy().astype(np.float32)
+
+
+def load_classifier(model_path: str, threads: int = INFERENCE_THREADS):
+    """Classifier for a model file, by extension. Raises ImportError if its runtime is missing."""
+    if model_path.lower().endswith(".onnx"):
+        return OnnxClassifier(model_path, threads)
+    return TorchScriptClassifier(model_path, threads)
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class KLInferenceEngine:
+    """
+    Micro-batching front end of a loaded classifier. Callers (any thread)
+    submit preprocessed study inputs; one worker thread takes the first
+    waiting request, collects whatever else arrives within the batching
+    window, and runs them as one model call. Per-slice probabilities are
+    averaged per study (MRI series).
+    """
+
+    def __init__(self, classifier, name: str = "",
+                 window: float = BATCH_WINDOW_SECONDS, max_batch: int = MAX_BATCH_IMAGES):
+        self.classifier = classifier
+        self.name = name
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.images = 0
+        self._queue: "queue.Queue[Optional[Tuple[np.ndarray, Future]]]" = queue.Queue()
+        # Warm-up call, so the first real request does not pay for lazy initialization
+        classifier.logits(np.zeros((1, 3, INPUT_SIZE, INPUT_SIZE), dtype=np.float32))
+        self._thread = threading.Thread(target=self._run, name="kl-inference", daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs: np.ndarray) -> Future:
+        """Queue one study's inputs, shape (n, 3, H, W); the future resolves to a prediction dict."""
+        future: Future = Future()
+        self._queue.put((np.asarray(inputs, dtype=np.float32), future))
+        return future
+
+    def predict(self, inputs: np.ndarray, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self.submit(inputs).result(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self) -> Tuple[List[Tuple[np.ndarray, Future]], bool]:
+        # Blocks for the first request, then gathers more until the window
+        # closes or the batch is full. Returns (requests, stop requested).
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        pending, size = [first], len(first[0])
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return pending, True
+            pending.append(item)
+            size += len(item[0])
+        return pending, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            pending, stop = self._collect()
+            if not pending:
+                continue
+            try:
+                batch, counts = batch_inputs([inputs for inputs, _ in pending])
+                probabilities = softmax(self.classifier.logits(batch))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.images += len(batch)
+            start = 0
+            for (_, future), count in zip(pending, counts):
+                future.set_result(_prediction(probabilities[start:start + count].mean(axis=0)))
+                start += count
+
+
+def _prediction(probabilities: np.ndarray) -> Dict[str, Any]:
+    grade = int(np.argmax(probabilities))
+    return {
+        "kl_grade": grade,
+        "confidence": round(float(probabilities[grade]), 4),
+        "probabilities": {str(g): round(float(p), 4) for g, p in enumerate(probabilities)},
+    }
+
+
+def find_kl_model(model_dir: str) -> Optional[str]:
+    for name in KL_MODEL_NAMES:
+        path = os.path.join(model_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+_engines: Dict[Tuple[str, int], Tuple[float, Optional[KLInferenceEngine]]] = {}
+_engines_lock = threading.Lock()
+
+def get_kl_engine(model_dir: str) -> Optional[KLInferenceEngine]:
+    """
+    Shared inference engine for the KL classifier in model_dir, loaded once
+    per process and reloaded when the model file changes. None when there is
+    no model file, its runtime (onnxruntime / torch) is not installed, or it
+    fails to load; a failed load is cached until the file changes.
+    """
+    path = find_kl_model(model_dir)
+    if path is None:
+        return None
+    mtime = os.path.getmtime(path)
+    with _engines_lock:
+        # Keyed by PID too: a forked pool worker does not inherit the batching thread
+        key = (path, os.getpid())
+        cached = _engines.get(key)
+        if cached is None or cached[0] != mtime:
+            if cached is not None and cached[1] is not None:
+                cached[1].close()
+            try:
+                engine = KLInferenceEngine(load_classifier(path), name=os.path.basename(path))
+            except ImportError:
+                engine = None
+            except Exception as e:
+                # Corrupt or incompatible model file: fall back, without retrying per image
+                print(f"DEBUG: Could not load KL model {path}: {e}")
+                engine = None
+            cached = (mtime, engine)
+            _engines[key] = cached
+        return cached[1]
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+    from oa_diagnosis.tools.similarity_search import MODEL_DIR
+
+    parser = argparse.ArgumentParser(description="Measure KL classifier throughput with concurrent single-image requests.")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent callers")
+    args = parser.parse_args()
+
+    engine = get_kl_engine(args.model_dir)
+    if engine is None:
+        raise SystemExit(f"No usable KL model ({' or '.join(KL_MODEL_NAMES)}) in {args.model_dir}")
+    inputs = np.random.default_rng(0).standard_normal((1, 3, INPUT_SIZE, INPUT_SIZE)).astype(np.float32)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        list(pool.map(lambda _: engine.predict(inputs), range(args.requests)))
+    elapsed = time.time() - start
+    print(f"{engine.name}: {args.requests / elapsed:.1f} images/s, "
+          f"{engine.images / max(engine.batches, 1):.1f} images per batch ({args.clients} clients)")
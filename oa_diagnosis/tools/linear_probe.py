@@ -0,0 +1,330 @@
+import os
+import time
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools.patient_store import get_patient_store
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex, embeddings_mtime, get_embedding_index, has_embeddings
+from oa_diagnosis.tools.hybrid_retrieval import kl_grade_of
+
+# Probe tasks: baseline KL grade, and the FNIH progression group derived from
+# the JSPRG / PAINPRG flags (NONPRG marks non-progressors)
+PROBE_TASKS = ("kl", "progression")
+PROGRESSION_CLASSES = ("Non Progressor", "JSL Only Progressor", "Pain Only Progressor", "JSL and Pain Progressor")
+LABEL_COLUMNS = ['ID', 'V00XRKL', 'JSPRG', 'PAINPRG', 'NONPRG']
+
+# L2 penalty on the weights and full-batch gradient iterations
+PROBE_L2 = 1e-1
+PROBE_ITERATIONS = 500
+
+# Cross-validation folds run by train_probe; a probe is only used if its
+# k-fold accuracy beats always predicting the majority class by at least
+# PROBE_MIN_GAIN, and by PROBE_GAIN_STDERRS standard errors of the per-fold gains
+PROBE_CV_FOLDS = 5
+PROBE_MIN_GAIN = 0.02
+PROBE_GAIN_STDERRS = 2.0
+
+PROBE_VERSION = 3
+
+
+def _flag(value) -> Optional[int]:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def progression_class(jsprg, painprg, nonprg=None) -> Optional[str]:
+    """Progression group of a knee from its JSPRG / PAINPRG / NONPRG flags, or None."""
+    if _flag(nonprg) == 1:
+        return PROGRESSION_CLASSES[0]
+    js, pain = _flag(jsprg), _flag(painprg)
+    if js is None or pain is None:
+        return None
+    return PROGRESSION_CLASSES[js + 2 * pain]
+
+
+def task_labels(frame: pd.DataFrame, task: str) -> Dict[str, Any]:
+    """Patient ID -> label for a task (first row per patient; unlabelled patients left out)."""
+    labels: Dict[str, Any] = {}
+    for row in frame.itertuples(index=False):
+        pid = str(int(row.ID))
+        if pid in labels:
+            continue
+        if task == "kl":
+            label = kl_grade_of(row.V00XRKL)
+        elif task == "progression":
+            label = progression_class(row.JSPRG, row.PAINPRG, row.NONPRG)
+        else:
+            raise ValueError(f"Unknown probe task '{task}', expected one of {PROBE_TASKS}")
+        if label is not None:
+            labels[pid] = label
+    return labels
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class LinearProbe:
+    """
+    Multinomial logistic regression on standardized embeddings. Prediction
+    is one (dim x classes) product, so a patient with an embedding is scored
+    without decoding any image. 'cv_accuracy' / 'majority_baseline' /
+    'cv_gain_stderr' are the cross-validation scores recorded by train_probe
+    (None if not validated).
+    """
+
+    def __init__(self, classes: Sequence, weights: np.ndarray, bias: np.ndarray,
+                 mean: np.ndarray, std: np.ndarray, task: str = "",
+                 cv_accuracy: Optional[float] = None, majority_baseline: Optional[float] = None,
+                 cv_gain_stderr: Optional[float] = None):
+        self.classes = list(classes)
+        self.task = task
+        self.cv_accuracy = cv_accuracy
+        self.majority_baseline = majority_baseline
+        self.cv_gain_stderr = cv_gain_stderr
+        self._fit = tuple(np.asarray(a, dtype=np.float32) for a in (weights, bias, mean, std))
+        weights, bias, mean, std = self._fit
+        # Standardization folded into the weights: ((x - mean) / std) @ W + b
+        self.weights = weights / std[:, None]
+        self.bias = bias - (mean / std) @ weights
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, labels: Sequence, l2: float = PROBE_L2,
+            iterations: int = PROBE_ITERATIONS, task: str = "") -> "LinearProbe":
+        """
+        Minimize mean cross-entropy + l2/2 * |W|^2 with Nesterov-accelerated
+        gradient descent. The step is 1/L for the bound L = |X|^2 / (2n) + l2
+        on the curvature, so no learning rate needs tuning.
+        """
+        x = np.asarray(vectors, dtype=np.float64)
+        classes = sorted(set(labels), key=lambda c: (str(type(c)), c))
+        index = {c: i for i, c in enumerate(classes)}
+        y = np.zeros((len(x), len(classes)))
+        y[np.arange(len(x)), [index[c] for c in labels]] = 1.0
+
+        mean = x.mean(axis=0)
+        std = x.std(axis=0)
+        std = np.where(std > 0, std, 1.0)
+        z = np.hstack([(x - mean) / std, np.ones((len(x), 1))])
+
+        n = len(z)
+        step = 1.0 / (np.linalg.norm(z, 2) ** 2 / (2 * n) + l2)
+        penalty = np.ones((z.shape[1], 1))
+        penalty[-1] = 0.0  # bias is not regularized
+        theta = np.zeros((z.shape[1], len(classes)))
+        momentum, t = theta.copy(), 1.0
+        for _ in range(iterations):
+            grad = z.T @ (softmax(z @ momentum) - y) / n + l2 * penalty * momentum
+            new_theta = momentum - step * grad
+            t_next = (1 + np.sqrt(1 + 4 * t * t)) / 2
+            momentum = new_theta + ((t - 1) / t_next) * (new_theta - theta)
+            theta, t = new_theta, t_next
+        return cls(classes, theta[:-1], theta[-1], mean, std, task=task)
+
+    @property
+    def beats_baseline(self) -> bool:
+        """
+        True if cross-validation showed the probe beats the majority class by
+        a margin: at least PROBE_MIN_GAIN, and PROBE_GAIN_STDERRS standard
+        errors of the per-fold gains (a gain of about one sample is noise).
+        """
+        if None in (self.cv_accuracy, self.majority_baseline, self.cv_gain_stderr):
+            return False
+        gain = self.cv_accuracy - self.majority_baseline
+        return gain >= PROBE_MIN_GAIN and gain > PROBE_GAIN_STDERRS * self.cv_gain_stderr
+
+    def predict_proba(self, vectors: np.ndarray) -> np.ndarray:
+        return softmax(np.atleast_2d(np.asarray(vectors, dtype=np.float32)) @ self.weights + self.bias)
+
+    def predict(self, vectors: np.ndarray) -> List:
+        return [self.classes[i] for i in np.argmax(self.predict_proba(vectors), axis=1)]
+
+    def save(self, path: str, source_mtime: Optional[float] = None):
+        weights, bias, mean, std = self._fit
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp,
+            version=PROBE_VERSION,
+            task=self.task,
+            classes=np.asarray([str(c) for c in self.classes]),
+            weights=weights,
+            bias=bias,
+            mean=mean,
+            std=std,
+            source_mtime=np.nan if source_mtime is None else source_mtime,
+            cv_accuracy=np.nan if self.cv_accuracy is None else self.cv_accuracy,
+            majority_baseline=np.nan if self.majority_baseline is None else self.majority_baseline,
+            cv_gain_stderr=np.nan if self.cv_gain_stderr is None else self.cv_gain_stderr,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LinearProbe":
+        with np.load(path, allow_pickle=False) as data:
+            version = int(data["version"])
+            if version not in (1, 2, PROBE_VERSION):
+                raise ValueError(f"Unsupported probe version in {path}")
+            task = str(data["task"])
+            classes = data["classes"].tolist()
+            if task == "kl":
+                classes = [int(c) for c in classes]
+            # Version 1 files carry no cross-validation scores and version 2 no
+            # per-fold spread: loaded, but never used
+            keys = ("cv_accuracy", "majority_baseline", "cv_gain_stderr")
+            scores = [float(data[k]) if k in data.files else np.nan for k in keys]
+            cv_accuracy, majority_baseline, cv_gain_stderr = [None if np.isnan(v) else v for v in scores]
+            return cls(classes, data["weights"], data["bias"], data["mean"], data["std"], task=task,
+                       cv_accuracy=cv_accuracy, majority_baseline=majority_baseline, cv_gain_stderr=cv_gain_stderr)
+
+
+def probe_path_for(embeddings_path: str, task: str) -> str:
+    """'xray_..._train_only.pkl' -> 'xray_..._train_only.probe_kl.npz'"""
+    return f"{os.path.splitext(embeddings_path)[0]}.probe_{task}.npz"
+
+
+def training_set(index: EmbeddingIndex, labels: Dict[str, Any]) -> Tuple[List[str], np.ndarray, List]:
+    """Patients with both an embedding and a label: (ids, vectors, labels)."""
+    ids = [pid for pid in sorted(labels) if pid in index]
+    vectors = np.stack([index.vector(pid) for pid in ids]) if ids else np.zeros((0, 0), dtype=np.float32)
+    return ids, vectors, [labels[pid] for pid in ids]
+
+
+def cross_validate(vectors: np.ndarray, labels: Sequence, folds: int = 5, l2: float = PROBE_L2,
+                   iterations: int = PROBE_ITERATIONS, seed: int = 0) -> Dict[str, float]:
+    """
+    k-fold accuracy of the probe against always predicting the majority
+    class, and the standard error of the per-fold accuracy gain.
+    """
+    labels = np.asarray(labels, dtype=object)
+    order = np.random.default_rng(seed).permutation(len(labels))
+    correct = majority = 0
+    gains = []
+    for fold in range(folds):
+        test = order[fold::folds]
+        train = np.setdiff1d(order, test)
+        probe = LinearProbe.fit(vectors[train], labels[train].tolist(), l2=l2, iterations=iterations)
+        fold_correct = sum(p == t for p, t in zip(probe.predict(vectors[test]), labels[test]))
+        values, counts = np.unique(labels[train].astype(str), return_counts=True)
+        fold_majority = int(np.sum(labels[test].astype(str) == values[np.argmax(counts)]))
+        correct += fold_correct
+        majority += fold_majority
+        gains.append((fold_correct - fold_majority) / len(test))
+    return {
+        "accuracy": correct / len(labels),
+        "majority_baseline": majority / len(labels),
+        "gain_stderr": float(np.std(gains, ddof=1) / np.sqrt(len(gains))),
+    }
+
+
+def train_probe(embeddings_path: str, data_path: str, task: str, l2: float = PROBE_L2,
+                iterations: int = PROBE_ITERATIONS, folds: int = PROBE_CV_FOLDS) -> LinearProbe:
+    """
+    Cross-validate, then fit a probe on every labelled patient with an
+    embedding and save it next to the embeddings with its scores. A probe
+    that does not beat the majority baseline is saved too (replacing an
+    older one) but probe_predictions never uses it.
+    """
+    frame = get_patient_store(data_path, LABEL_COLUMNS).frame()
+    _, vectors, labels = training_set(get_embedding_index(embeddings_path), task_labels(frame, task))
+    if not labels:
+        raise ValueError(f"No patients with both an embedding and a '{task}' label")
+    scores = cross_validate(vectors, labels, folds=max(2, min(folds, len(labels))), l2=l2, iterations=iterations)
+    probe = LinearProbe.fit(vectors, labels, l2=l2, iterations=iterations, task=task)
+    probe.cv_accuracy, probe.majority_baseline = scores["accuracy"], scores["majority_baseline"]
+    probe.cv_gain_stderr = scores["gain_stderr"]
+    probe.save(probe_path_for(embeddings_path, task), source_mtime=embeddings_mtime(embeddings_path))
+    return probe
+
+
+_probes: Dict[str, Tuple[float, Optional[LinearProbe]]] = {}
+_probes_lock = threading.Lock()
+
+def get_linear_probe(embeddings_path: str, task: str) -> Optional[LinearProbe]:
+    """Shared trained probe for an embedding file, reloaded when its file changes; None if not trained."""
+    path = probe_path_for(embeddings_path, task)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _probes_lock:
+        cached = _probes.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, LinearProbe.load(path))
+            _probes[path] = cached
+        return cached[1]
+
+
+def probe_predictions(patient_id: str, embeddings_path: str) -> Optional[Dict[str, Any]]:
+    """
+    KL grade and progression group predicted from a patient's embedding with
+    the trained probes. None if the patient has no embedding or no probe is
+    trained and beats its majority baseline.
+    """
+    probes = [p for p in (get_linear_probe(embeddings_path, task) for task in PROBE_TASKS)
+              if p is not None and p.beats_baseline]
+    if not probes or not has_embeddings(embeddings_path):
+        return None
+    vector = get_embedding_index(embeddings_path).vector(str(patient_id))
+    if vector is None:
+        return None
+    out: Dict[str, Any] = {}
+    for probe in probes:
+        probabilities = probe.predict_proba(vector)[0]
+        best = int(np.argmax(probabilities))
+        key = "kl_grade" if probe.task == "kl" else probe.task
+        out[key] = probe.classes[best]
+        out[f"{key}_confidence"] = round(float(probabilities[best]), 4)
+        out[f"{key}_probabilities"] = {str(c): round(float(p), 4) for c, p in zip(probe.classes, probabilities)}
+    return out
+
+
+def predict_from_embedding(patient_id: str) -> Dict[str, Any]:
+    """
+    Fast KL grade and progression-group estimate from the patient's X-ray
+    embedding (linear probe, no image decoding). Screening aid; does not
+    replace analyze_imaging.
+    """
+    from oa_diagnosis.tools.similarity_search import XRAY_EMBEDDINGS_PATH
+
+    predictions = probe_predictions(patient_id, XRAY_EMBEDDINGS_PATH)
+    if predictions is None:
+        return {"error": f"No embedding or trained probe for patient {patient_id}. Value is missing."}
+    return dict(predictions, patient_id=str(patient_id), source="X-ray embedding linear probe")
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.oai_data_loader import DATA_FILE_PATH
+    from oa_diagnosis.tools.similarity_search import XRAY_EMBEDDINGS_PATH
+
+    parser = argparse.ArgumentParser(description="Train linear probes (KL grade, progression group) on embeddings.")
+    parser.add_argument("embeddings", nargs="?", default=XRAY_EMBEDDINGS_PATH)
+    parser.add_argument("--data", default=DATA_FILE_PATH, help="Clinical CSV with the label columns")
+    parser.add_argument("--task", choices=PROBE_TASKS + ("all",), default="all")
+    parser.add_argument("--l2", type=float, default=PROBE_L2)
+    parser.add_argument("--iterations", type=int, default=PROBE_ITERATIONS)
+    parser.add_argument("--folds", type=int, default=PROBE_CV_FOLDS, help="Cross-validation folds run before the final fit")
+    args = parser.parse_args()
+
+    frame = get_patient_store(args.data, LABEL_COLUMNS).frame()
+    index = get_embedding_index(args.embeddings)
+    for task in (PROBE_TASKS if args.task == "all" else (args.task,)):
+        ids, _, _ = training_set(index, task_labels(frame, task))
+        start = time.time()
+        probe = train_probe(args.embeddings, args.data, task, l2=args.l2, iterations=args.iterations, folds=args.folds)
+        elapsed = time.time() - start
+        start = time.perf_counter()
+        for pid in ids[:100]:
+            probe_predictions(pid, args.embeddings)
+        per_call = (time.perf_counter() - start) * 1e6 / max(1, min(100, len(ids)))
+        print(f"{task}: {len(ids)} patients, classes {probe.classes}, "
+              f"{args.folds}-fold accuracy {probe.cv_accuracy:.3f} (majority {probe.majority_baseline:.3f}, "
+              f"gain standard error {probe.cv_gain_stderr:.3f}), "
+              f"trained in {elapsed:.1f}s, {per_call:.0f}us per prediction -> {probe_path_for(args.embeddings, task)}")
+        if not probe.beats_baseline:
+            print(f"{task}: not used, it does not beat the majority baseline by the required margin")
@@ -0,0 +1,144 @@
+import io
+import pydicom
+import numpy as np
+from typing import Any, Dict, Iterator, Optional, Tuple
+from oa_diagnosis.tools.seekable_archive import iter_members
+
+# Histogram resolution over the stored pixel value range
+HISTOGRAM_BINS = 64
+
+# In-plane stride used when keeping a downsampled copy of the volume
+DOWNSAMPLE_FACTOR = 4
+
+# Ceiling for the kept volume; past it every other kept slice is dropped and
+# the slice stride along z doubles, so memory stays bounded for any series length
+MAX_VOLUME_BYTES = 64 * 1024 * 1024
+
+
+def iter_stack_slices(tar_gz_path: str) -> Iterator[Tuple[str, pydicom.Dataset, np.ndarray]]:
+    """
+    Yield (member name, dataset, 2-D pixel array) for every slice of a study,
+    in archive order. Only one member is decoded at a time; multi-frame
+    members yield one entry per frame.
+    """
+    for name, raw in iter_members(tar_gz_path):
+        ds = pydicom.dcmread(io.BytesIO(raw))
+        if "PixelData" not in ds:
+            continue
+        pixels = ds.pixel_array
+        if pixels.ndim == 2:
+            yield name, ds, pixels
+        else:
+            for frame in pixels:
+                yield name, ds, frame
+
+
+class RunningStats:
+    """
+    Streaming mean/variance (Chan et al. pairwise merge of per-slice moments),
+    min/max and a fixed-range histogram.
+    """
+
+    def __init__(self, value_range: Tuple[float, float], bins: int = HISTOGRAM_BINS):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.value_range = value_range
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def update(self, pixels: np.ndarray) -> Dict[str, float]:
+        """Fold one slice in; returns that slice's own statistics."""
+        n = pixels.size
+        mean = float(np.mean(pixels, dtype=np.float64))
+        var = float(np.var(pixels, dtype=np.float64))
+        lo, hi = float(pixels.min()), float(pixels.max())
+
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += var * n + delta * delta * self.count * n / total
+        self.count = total
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self.histogram += np.histogram(pixels, bins=len(self.histogram), range=self.value_range)[0]
+        return {"mean": mean, "std": var ** 0.5, "min": lo, "max": hi}
+
+    @property
+    def std(self) -> float:
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+
+def _stored_range(ds: pydicom.Dataset) -> Tuple[float, float]:
+    bits = int(ds.get("BitsStored", ds.get("BitsAllocated", 16)))
+    if int(ds.get("PixelRepresentation", 0)) == 1:
+        return -float(2 ** (bits - 1)), float(2 ** (bits - 1))
+    return 0.0, float(2 ** bits)
+
+
+def analyze_stack(tar_gz_path: str,
+                  bins: int = HISTOGRAM_BINS,
+                  keep_volume: bool = False,
+                  downsample: int = DOWNSAMPLE_FACTOR,
+                  max_volume_bytes: int = MAX_VOLUME_BYTES) -> Dict[str, Any]:
+    """
+    Volume-level and per-slice statistics of a multi-slice study, computed in
+    one streaming pass. With keep_volume, also returns a float32 volume
+    downsampled by 'downsample' in-plane and decimated along z as needed to
+    stay under max_volume_bytes.
+    """
+    stats = None
+    per_slice = []
+    kept = []
+    kept_bytes = 0
+    z_step = 1
+
+    for index, (name, ds, pixels) in enumerate(iter_stack_slices(tar_gz_path)):
+        if stats is None:
+            stats = RunningStats(_stored_range(ds), bins)
+        slice_stats = stats.update(pixels)
+        slice_stats["name"] = name
+        per_slice.append(slice_stats)
+
+        if keep_volume and index % z_step == 0:
+            small = np.ascontiguousarray(pixels[::downsample, ::downsample], dtype=np.float32)
+            kept.append(small)
+            kept_bytes += small.nbytes
+            while kept_bytes > max_volume_bytes and len(kept) > 1:
+                kept = kept[::2]
+                kept_bytes = sum(s.nbytes for s in kept)
+                z_step *= 2
+
+    if stats is None:
+        raise ValueError("No image slices found in archive")
+
+    volume: Optional[np.ndarray] = np.stack(kept) if kept else None
+    return {
+        "slices": len(per_slice),
+        "mean": stats.mean,
+        "std": stats.std,
+        "min": stats.min,
+        "max": stats.max,
+        "histogram": {"range": list(stats.value_range), "counts": stats.histogram.tolist()},
+        "per_slice": per_slice,
+        "volume": volume,
+        "volume_z_step": z_step if keep_volume else None,
+        "downsample": downsample if keep_volume else None,
+    }
+
+
+def summarize_stack(stack: Dict[str, Any], bins: int = 16) -> Dict[str, Any]:
+    """Compact, JSON-friendly form of analyze_stack output for tool results."""
+    counts = np.asarray(stack["histogram"]["counts"])
+    coarse = counts.reshape(bins, -1).sum(axis=1) if len(counts) % bins == 0 else counts
+    slice_means = [s["mean"] for s in stack["per_slice"]]
+    return {
+        "slices": stack["slices"],
+        "volume_mean": round(stack["mean"], 1),
+        "volume_std": round(stack["std"], 1),
+        "min": stack["min"],
+        "max": stack["max"],
+        "slice_mean_range": [round(min(slice_means), 1), round(max(slice_means), 1)],
+        "histogram": {"range": stack["histogram"]["range"], "counts": coarse.tolist()},
+    }
@@ -1,103 +1,181 @@
 import pandas as pd
 import os
-from typing import Dict, Any
+import sqlite3
+from typing import Dict, Any, Iterable, Iterator, List
+from oa_diagnosis.tools.patient_store import get_patient_store
+from oa_diagnosis.tools.clinical_columnar import PATIENT_COLUMNS, as_python_scalar, columnar_path_for
+from oa_diagnosis.tools.image_manifest import get_image_manifest
+from oa_diagnosis.tools.dicom_catalog import filter_knee_images, get_dicom_catalog
 
 # Path to the data file
 DATA_FILE_PATH = r"c:\Users\pahad\Desktop\AutoGen\data\Clinical_FNIH_merged_all_tables.csv"
 
+# Number of IDs profiled per vectorized pass in load_patients
+BATCH_CHUNK_SIZE = 2000
+
+BIOMARKER_COLUMNS = {
+    "Serum_C2C": 'Labcorp_V00Serum_C2C_lc',
+    "Serum_CPII": 'Labcorp_V00Serum_CPII_lc',
+    "Serum_NTXI": 'Labcorp_V00Serum_NTXI_lc',
+    "Urine_CTXII": 'Labcorp_V00Urine_CTXII_lc'
+}
+
 def load_patient_data(patient_id: str) -> Dict[str, Any]:
     """
     Loads OAI data for a given patient ID from the local CSV file.
     Returns a dictionary with 'id', 'age', 'gender', 'bmi', 'history', 'symptoms', 'biomarkers'.
     """
-    if not os.path.exists(DATA_FILE_PATH):
-        return {"error": f"Data file not found at {DATA_FILE_PATH}"}
+    return next(load_patients([patient_id]))
+
+def load_patients(patient_ids: Iterable[str], include_images: bool = True) -> Iterator[Dict[str, Any]]:
+    """
+    Batch version of load_patient_data for cohort-scale runs.
+    Yields one profile (or {"error": ...} dict) per input ID, in input order.
+    IDs are processed in chunks of BATCH_CHUNK_SIZE; each chunk's profiles are
+    built in one vectorized pass over the selected rows.
+    """
+    if not os.path.exists(DATA_FILE_PATH) and not os.path.exists(columnar_path_for(DATA_FILE_PATH)):
+        for _ in patient_ids:
+            yield {"error": f"Data file not found at {DATA_FILE_PATH}"}
+        return
+
+    chunk = []
+    for patient_id in patient_ids:
+        chunk.append(patient_id)
+        if len(chunk) >= BATCH_CHUNK_SIZE:
+            yield from _load_chunk(chunk, include_images)
+            chunk = []
+    if chunk:
+        yield from _load_chunk(chunk, include_images)
 
+def _load_chunk(patient_ids: List[str], include_images: bool) -> Iterator[Dict[str, Any]]:
     try:
-        # We read the CSV. Since it's large, in a real app we might optimize this,
-        # but for now we'll read it on demand or cache it. Given the scope, reading on demand.
-        # To avoid reading the whole file every time, we could use a global variable or lru_cache, 
-        # but let's stick to a simple read for now.
-        df = pd.read_csv(DATA_FILE_PATH)
-        
-        # Filter for the patient
+        # The CSV is parsed once per process and indexed by ID; the store
+        # re-parses it only when the file's mtime changes. Only the columns
+        # used below are loaded (from the Parquet copy if it has been built).
+        store = get_patient_store(DATA_FILE_PATH, PATIENT_COLUMNS)
+
         # IDs in CSV seem to be integers, convert input to int if possible
-        try:
-            pid_int = int(patient_id)
-            patient_row = df[df['ID'] == pid_int]
-        except ValueError:
-            return {"error": "Invalid Patient ID format"}
-
-        if patient_row.empty:
-            return {"error": f"Patient ID {patient_id} not found"}
-
-        row = patient_row.iloc[0]
-
-        # Helper to safely get value
-        def get_val(col):
-            val = row.get(col)
-            return val if pd.notna(val) else "N/A"
-
-        # Map Gender
-        gender_raw = get_val('P02SEX')
-        gender = "Unknown"
-        if isinstance(gender_raw, str):
-            if "Female" in gender_raw: gender = "Female"
-            elif "Male" in gender_raw: gender = "Male"
-        elif gender_raw == 1: gender = "Male"
-        elif gender_raw == 2: gender = "Female"
-
-        # Construct History from KL grades (Baseline)
-        hist_parts = []
-        if get_val('V00XRKL') != "N/A":
-            hist_parts.append(f"Baseline KL Grade (Right): {get_val('V00XRKL')}")
-        # Note: Left side KL column needed if available, relying on V00XRKL for now which implies side or is summary
-        # Actually columns.txt shows V00XRKL, often specific to a side if split, but let's use what's there.
-        
-        history = "OAI Cohort Participant. " + "; ".join(hist_parts)
-
-        # Construct Symptoms from WOMAC
-        sym_parts = []
-        womkp = get_val('V00WOMKP')
-        if womkp != "N/A":
-            sym_parts.append(f"Baseline WOMAC Pain Score: {womkp}")
-        womadl = get_val('V00WOMADL')
-        if womadl != "N/A":
-            sym_parts.append(f"Baseline WOMAC ADL Score: {womadl}")
-        
-        symptoms = "; ".join(sym_parts) if sym_parts else "No specific symptom data recorded."
-
-        # Biomarkers
-        biomarkers = {
-            "Serum_C2C": get_val('Labcorp_V00Serum_C2C_lc'),
-            "Serum_CPII": get_val('Labcorp_V00Serum_CPII_lc'),
-            "Serum_NTXI": get_val('Labcorp_V00Serum_NTXI_lc'),
-            "Urine_CTXII": get_val('Labcorp_V00Urine_CTXII_lc')
-        }
-
-        data = {
-            "id": str(get_val('ID')),
-            "age": float(get_val('V00AGE')) if get_val('V00AGE') != "N/A" else "N/A",
-            "gender": gender,
-            "bmi": float(get_val('P01BMI')) if get_val('P01BMI') != "N/A" else "N/A",
-            "history": history,
-            "symptoms": symptoms,
-            "medications": [], # Medication data not explicitly identified in quick scan
-
-            "imaging_ids": _find_patient_images(str(get_val('ID'))),
-            "biomarkers": biomarkers
-        }
-        
-        return data
+        pid_ints = {}
+        for patient_id in patient_ids:
+            try:
+                pid_ints[patient_id] = int(patient_id)
+            except (TypeError, ValueError):
+                pass
 
+        rows = store.first_rows(list(dict.fromkeys(pid_ints.values())))
+        profiles = dict(zip(rows['ID'].astype(int).tolist(), _build_profiles(rows)))
     except Exception as e:
-        return {"error": f"Failed to load data: {str(e)}"}
+        for _ in patient_ids:
+            yield {"error": f"Failed to load data: {str(e)}"}
+        return
+
+    for patient_id in patient_ids:
+        if patient_id not in pid_ints:
+            yield {"error": "Invalid Patient ID format"}
+            continue
+        profile = profiles.get(pid_ints[patient_id])
+        if profile is None:
+            yield {"error": f"Patient ID {patient_id} not found"}
+            continue
+
+        data = {key: profile[key] for key in ("id", "age", "gender", "bmi", "history", "symptoms")}
+        data["medications"] = [] # Medication data not explicitly identified in quick scan
+        if include_images:
+            data["imaging_ids"] = _find_patient_images(data["id"])
+        data["biomarkers"] = dict(profile["biomarkers"])
+        yield data
+
+def _as_text(series: pd.Series) -> pd.Series:
+    """String form of each value, matching f-string formatting of the Python scalar."""
+    if pd.api.types.is_float_dtype(series):
+        # float32 prints its shortest repr, float64 its repr, e.g. '28.6', '0.0'
+        return series.astype(str)
+    return series.astype(object).astype(str)
+
+def _column(rows: pd.DataFrame, col: str) -> pd.Series:
+    if col in rows.columns:
+        return rows[col]
+    return pd.Series([None] * len(rows), index=rows.index, dtype=object)
+
+def _build_profiles(rows: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Build the patient profile dicts for all rows at once."""
+    if rows.empty:
+        return []
+
+    # Map Gender
+    sex = _column(rows, 'P02SEX')
+    gender = pd.Series("Unknown", index=rows.index, dtype=object)
+    if pd.api.types.is_numeric_dtype(sex):
+        gender[sex == 1] = "Male"
+        gender[sex == 2] = "Female"
+    else:
+        sex_text = sex.astype(object).where(sex.notna(), "").astype(str)
+        is_female = sex_text.str.contains("Female", regex=False)
+        gender[sex_text.str.contains("Male", regex=False) & ~is_female] = "Male"
+        gender[is_female] = "Female"
+
+    # Construct History from KL grades (Baseline)
+    kl = _column(rows, 'V00XRKL')
+    history = pd.Series("OAI Cohort Participant. ", index=rows.index, dtype=object)
+    history[kl.notna()] = "OAI Cohort Participant. Baseline KL Grade (Right): " + _as_text(kl[kl.notna()])
+
+    # Construct Symptoms from WOMAC
+    womkp = _column(rows, 'V00WOMKP')
+    womadl = _column(rows, 'V00WOMADL')
+    pain = ("Baseline WOMAC Pain Score: " + _as_text(womkp)).where(womkp.notna(), "")
+    adl = ("Baseline WOMAC ADL Score: " + _as_text(womadl)).where(womadl.notna(), "")
+    both = womkp.notna() & womadl.notna()
+    symptoms = (pain + adl).where(~both, pain + "; " + adl)
+    symptoms = symptoms.where(womkp.notna() | womadl.notna(), "No specific symptom data recorded.")
+
+    def values_or_na(series):
+        # Iterate the numpy array so float32 scalars reach as_python_scalar un-widened
+        return [as_python_scalar(v) if pd.notna(v) else "N/A" for v in series.to_numpy()]
+
+    biomarker_values = {
+        name: values_or_na(_column(rows, col))
+        for name, col in BIOMARKER_COLUMNS.items()
+    }
+    ages = values_or_na(_column(rows, 'V00AGE'))
+    bmis = values_or_na(_column(rows, 'P01BMI'))
+
+    profiles = []
+    for i, (pid, g, h, sym) in enumerate(zip(rows['ID'].tolist(), gender.tolist(), history.tolist(), symptoms.tolist())):
+        profiles.append({
+            "id": str(as_python_scalar(pid)),
+            "age": float(ages[i]) if ages[i] != "N/A" else "N/A",
+            "gender": g,
+            "bmi": float(bmis[i]) if bmis[i] != "N/A" else "N/A",
+            "history": h,
+            "symptoms": sym,
+            "biomarkers": {name: values[i] for name, values in biomarker_values.items()}
+        })
+    return profiles
 
 def _find_patient_images(patient_id: str):
     """
     Search for .tar.gz image files in the patient's directory.
     Returns a list of formatted IDs: 'PatientID|SubFolder/Filename'
+    Served from the persistent image manifest; falls back to walking the
+    directory if the manifest database cannot be opened or lists nothing
+    for an existing folder. Studies the DICOM
+    header catalog marks as non-knee are left out, with their previews.
     """
+    img_root = os.path.join(os.path.dirname(DATA_FILE_PATH), "img")
+    if not os.path.isdir(os.path.join(img_root, patient_id)):
+        return []
+    try:
+        found_images = get_image_manifest(img_root).images_for(patient_id) or _walk_patient_images(patient_id)
+    except (sqlite3.Error, OSError):
+        found_images = _walk_patient_images(patient_id)
+
+    try:
+        return filter_knee_images(found_images, get_dicom_catalog(img_root))
+    except (sqlite3.Error, OSError):
+        return found_images
+
+def _walk_patient_images(patient_id: str):
     img_dir = os.path.join(os.path.dirname(DATA_FILE_PATH), "img", patient_id)
     if not os.path.exists(img_dir):
         return []
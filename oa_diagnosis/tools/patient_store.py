@@ -0,0 +1,96 @@
+import threading
+import pandas as pd
+from typing import Dict, List, Optional, Sequence, Tuple
+from oa_diagnosis.tools.clinical_columnar import dataset_mtime, read_clinical_columns
+
+
+class PatientStore:
+    """
+    Process-wide, read-only view of the clinical CSV.
+    The file is parsed once and re-parsed only when its mtime changes.
+    Lookups go through hash indexes on 'ID' and ('ID', 'SIDE') instead of
+    scanning the dataframe with a boolean mask.
+    When 'columns' is given only those columns are loaded, from the Parquet
+    copy if one has been built (see clinical_columnar.py).
+    """
+
+    def __init__(self, path: str, columns: Optional[Sequence[str]] = None):
+        self.path = path
+        self.columns = list(columns) if columns is not None else None
+        self._lock = threading.RLock()
+        # (mtime, dataframe, ID -> row positions, (ID, SIDE) -> row position), swapped as one unit
+        self._snapshot = None
+
+    def _load(self):
+        df = read_clinical_columns(self.path, self.columns)
+
+        by_id: Dict[int, List[int]] = {}
+        by_id_side: Dict[Tuple[int, str], int] = {}
+        sides = df['SIDE'].tolist() if 'SIDE' in df.columns else [None] * len(df)
+        for pos, (pid, side) in enumerate(zip(df['ID'].tolist(), sides)):
+            by_id.setdefault(int(pid), []).append(pos)
+            if side is not None and pd.notna(side):
+                by_id_side.setdefault((int(pid), str(side)), pos)
+
+        return df, by_id, by_id_side
+
+    def _current(self):
+        mtime = dataset_mtime(self.path)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == mtime:
+            return snapshot[1:]
+
+        with self._lock:
+            # Another session may have reloaded while we waited for the lock
+            if self._snapshot is None or self._snapshot[0] != mtime:
+                self._snapshot = (mtime,) + self._load()
+            return self._snapshot[1:]
+
+    def frame(self) -> pd.DataFrame:
+        """Return the current dataframe, reloading it if the file changed on disk."""
+        return self._current()[0]
+
+    def rows_for(self, patient_id: int) -> pd.DataFrame:
+        """All rows (one per knee side) recorded for a patient, in file order."""
+        df, by_id, _ = self._current()
+        return df.iloc[by_id.get(int(patient_id), [])]
+
+    def row_for(self, patient_id: int, side: Optional[str] = None) -> Optional[pd.Series]:
+        """
+        First row for a patient, or the row for a specific side
+        (matched against the raw 'SIDE' value, e.g. '1: Right').
+        Returns None if there is no match.
+        """
+        df, by_id, by_id_side = self._current()
+        if side is None:
+            positions = by_id.get(int(patient_id))
+            return df.iloc[positions[0]] if positions else None
+
+        pos = by_id_side.get((int(patient_id), side))
+        return df.iloc[pos] if pos is not None else None
+
+    def first_rows(self, patient_ids: Sequence[int]) -> pd.DataFrame:
+        """
+        First row of each patient, in the order given; IDs that are not
+        present are left out.
+        """
+        df, by_id, _ = self._current()
+        positions = [by_id[pid][0] for pid in map(int, patient_ids) if pid in by_id]
+        return df.iloc[positions]
+
+    def __contains__(self, patient_id) -> bool:
+        return int(patient_id) in self._current()[1]
+
+
+_stores: Dict[Tuple, PatientStore] = {}
+_stores_lock = threading.Lock()
+
+def get_patient_store(path: str, columns: Optional[Sequence[str]] = None) -> PatientStore:
+    """Return the shared store for a data file and column projection, creating it on first use."""
+    key = (path, tuple(columns) if columns is not None else None)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = PatientStore(path, columns)
+            _stores[key] = store
+        return store
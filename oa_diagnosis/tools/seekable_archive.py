@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import tarfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+INDEX_VERSION = 1
+
+
+def seekable_paths(tar_gz_path: str) -> Tuple[str, str]:
+    """
+    Uncompressed tar and member index stored next to a study archive:
+    '00456208.tar.gz' -> ('00456208.tar', '00456208.tar.idx.json').
+    """
+    base = tar_gz_path[:-len(".tar.gz")] if tar_gz_path.lower().endswith(".tar.gz") else tar_gz_path
+    return base + ".tar", base + ".tar.idx.json"
+
+
+def convert_study(tar_gz_path: str) -> str:
+    """
+    Write an uncompressed copy of a .tar.gz study plus a sidecar index of
+    (member name, data offset, size), so single members can be read with one
+    seek. Returns the index path.
+    """
+    tar_path, index_path = seekable_paths(tar_gz_path)
+    st = os.stat(tar_gz_path)
+    tmp_tar = f"{tar_path}.{os.getpid()}.tmp"
+
+    with tarfile.open(tar_gz_path, "r|gz") as src, tarfile.open(tmp_tar, "w") as dst:
+        for member in src:
+            dst.addfile(member, src.extractfile(member) if member.isfile() else None)
+
+    members = []
+    with tarfile.open(tmp_tar, "r:") as tar:
+        for member in tar.getmembers():
+            if member.isfile() and member.name != ".":
+                members.append({"name": member.name, "offset": member.offset_data, "size": member.size})
+
+    index = {
+        "version": INDEX_VERSION,
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+        "members": members,
+    }
+    tmp_index = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_index, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_tar, tar_path)
+    os.replace(tmp_index, index_path)
+    return index_path
+
+
+def load_index(tar_gz_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Member index of the seekable copy of a study, or None if there is no copy
+    or the .tar.gz changed after it was converted.
+    """
+    tar_path, index_path = seekable_paths(tar_gz_path)
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        st = os.stat(tar_gz_path)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != INDEX_VERSION:
+        return None
+    if (index["source_size"], index["source_mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+        return None
+    if not os.path.exists(tar_path):
+        return None
+    return index
+
+
+def read_member(tar_gz_path: str, member: Dict[str, Any]) -> bytes:
+    """Read one indexed member from the seekable copy by offset."""
+    tar_path, _ = seekable_paths(tar_gz_path)
+    with open(tar_path, "rb") as f:
+        f.seek(member["offset"])
+        return f.read(member["size"])
+
+
+def read_first_member(tar_gz_path: str) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    Name and bytes of the first file member of a study (often named '001' or
+    similar without extension). Uses the seekable copy when one is current;
+    otherwise streams the .tar.gz and stops at the first file instead of
+    scanning every member header. Returns (None, None) for an empty archive.
+    """
+    index = load_index(tar_gz_path)
+    if index is not None:
+        if not index["members"]:
+            return None, None
+        first = index["members"][0]
+        return first["name"], read_member(tar_gz_path, first)
+
+    with tarfile.open(tar_gz_path, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name != ".":
+                return member.name, tar.extractfile(member).read()
+    return None, None
+
+
+def iter_members(tar_gz_path: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yield (name, bytes) for every file member in archive order, one member in
+    memory at a time.
+    """
+    index = load_index(tar_gz_path)
+    if index is not None:
+        tar_path, _ = seekable_paths(tar_gz_path)
+        with open(tar_path, "rb") as f:
+            for member in index["members"]:
+                f.seek(member["offset"])
+                yield member["name"], f.read(member["size"])
+        return
+
+    with tarfile.open(tar_gz_path, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name != ".":
+                yield member.name, tar.extractfile(member).read()
+
+
+def _convert_if_stale(tar_gz_path: str) -> Tuple[str, Optional[str]]:
+    # Top-level so it can be pickled into pool workers
+    try:
+        if load_index(tar_gz_path) is None:
+            convert_study(tar_gz_path)
+            return tar_gz_path, None
+        return tar_gz_path, "up to date"
+    except Exception as e:
+        return tar_gz_path, f"error: {e}"
+
+
+def convert_tree(root: str, workers: Optional[int] = None) -> Dict[str, Optional[str]]:
+    """
+    Convert every .tar.gz under root that has no current seekable copy.
+    Returns {path: None (converted) | 'up to date' | 'error: ...'}.
+    """
+    paths = []
+    for dirpath, _, files in os.walk(root):
+        paths.extend(os.path.join(dirpath, name) for name in files if name.lower().endswith(".tar.gz"))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(_convert_if_stale, sorted(paths), chunksize=8))
+
+
+if __name__ == "__main__":
+    from oa_diagnosis.tools.imaging_analysis import IMG_BASE_DIR
+
+    parser = argparse.ArgumentParser(description="Convert study .tar.gz archives into seekable tar + member index.")
+    parser.add_argument("root", nargs="?", default=IMG_BASE_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="Converter processes (default: CPU count)")
+    args = parser.parse_args()
+
+    start = time.time()
+    results = convert_tree(args.root, workers=args.workers)
+    converted = sum(1 for status in results.values() if status is None)
+    errors = {path: status for path, status in results.items() if status and status.startswith("error")}
+    print(f"Converted {converted} of {len(results)} archives in {time.time() - start:.1f}s")
+    for path, status in errors.items():
+        print(f"  {path}: {status}")
@@ -1,27 +1,174 @@
-from typing import List, Dict, Any
+import os
+import pandas as pd
+from typing import List, Dict, Any, Optional, Sequence
+from oa_diagnosis.tools.oai_data_loader import DATA_FILE_PATH
+from oa_diagnosis.tools.patient_store import get_patient_store
+from oa_diagnosis.tools.clinical_columnar import as_python_scalar
+from oa_diagnosis.tools.embedding_index import EmbeddingIndex, get_embedding_index, has_embeddings
+from oa_diagnosis.tools.ann_index import get_ann_index
+from oa_diagnosis.tools.embedding_quantization import QUANTIZATION_MODES, get_quantized_index
+from oa_diagnosis.tools.hybrid_retrieval import get_hybrid_retriever, kl_grade_of
+from oa_diagnosis.tools.fusion_index import get_fusion_index
 
-def find_similar_cases(age: int, bmi: float, gender: str, kl_grade: int) -> List[Dict[str, Any]]:
+# Trained embedding files live next to the clinical data
+MODEL_DIR = os.path.join(os.path.dirname(DATA_FILE_PATH), "model")
+XRAY_EMBEDDINGS_PATH = os.path.join(MODEL_DIR, "xray_task_embeddings_resnet18_train_only.pkl")
+MRI_EMBEDDINGS_PATH = os.path.join(MODEL_DIR, "mri_stack_embeddings_resnet18_train_only.pkl")
+
+# Baseline and follow-up KL columns, in visit order; values look like '2:02:00'
+# (the grade is the leading number)
+BASELINE_KL_COLUMN = 'V00XRKL'
+FOLLOWUP_KL_COLUMNS = ['V01XRKL', 'V03XRKL', 'V05XRKL', 'V06XRKL']
+
+# Search backend: "exact" (brute-force cosine), "ivf" (approximate, see
+# ann_index.py), "sq8" / "pq" (compressed codes with float32 re-ranking, see
+# embedding_quantization.py) or "auto" (IVF once the embedding set reaches
+# ANN_MIN_VECTORS)
+RETRIEVAL_BACKEND = "auto"
+ANN_MIN_VECTORS = 50000
+
+OUTCOME_COLUMNS = ['ID', 'V00AGE', 'P01BMI', 'P02SEX', BASELINE_KL_COLUMN] + FOLLOWUP_KL_COLUMNS + ['JSPRG', 'PAINPRG', 'GROUPTYPE']
+
+def find_similar_cases(age: int, bmi: float, gender: str, kl_grade: int,
+                       patient_id: str = "", top_k: int = 3,
+                       same_sex: bool = True, kl_window: int = 1) -> List[Dict[str, Any]]:
     """
-    Simulates retrieval of similar historical OAI cases.
+    Retrieves the historical OAI knees most similar to the patient: a weighted
+    distance over standardized clinical features (age, BMI, sex, KL grade,
+    WOMAC, biomarkers) blended with imaging embedding similarity when the
+    patient has an embedding (X-ray and MRI fused when both are available,
+    searched with RETRIEVAL_BACKEND). Candidates are restricted to the same
+    sex and KL grade within +/- kl_window. Each case carries its observed
+    outcomes: KL grade change to the last follow-up and JSPRG/PAINPRG
+    progression.
     """
-    # Simply return a static list of "similar" cases for now
-    return [
-        {
-            "case_id": "OAI_HIST_104",
-            "similarity_score": 0.92,
-            "treatment": "Physical Therapy + NSAIDs",
-            "outcome_2yr": "Pain reduced by 40%, stable KL grade"
-        },
-        {
-            "case_id": "OAI_HIST_299",
-            "similarity_score": 0.88,
-            "treatment": "Intra-articular steroid injection",
-            "outcome_2yr": "Temporary relief, progression to KL 4"
-        },
-        {
-            "case_id": "OAI_HIST_055",
-            "similarity_score": 0.85,
-            "treatment": "Weight loss (10%) + Exercise",
-            "outcome_2yr": "Significant improvement in WOMAC score"
+    xray_path = XRAY_EMBEDDINGS_PATH if has_embeddings(XRAY_EMBEDDINGS_PATH) else None
+    mri_path = MRI_EMBEDDINGS_PATH if has_embeddings(MRI_EMBEDDINGS_PATH) else None
+    try:
+        retriever = get_hybrid_retriever(DATA_FILE_PATH, xray_path, mri_path, embedding_index=_retrieval_index)
+        values = {"age": age, "bmi": bmi, "sex": gender, "kl_grade": kl_grade}
+        hits = retriever.search(values, patient_id=patient_id, k=top_k, same_sex=same_sex, kl_window=kl_window)
+        outcomes = _load_outcomes(sorted({hit["case_id"] for hit in hits}, key=int))
+    except Exception as e:
+        return [{"error": f"Failed to retrieve similar cases: {str(e)}"}]
+
+    cases = []
+    for hit in hits:
+        case = {
+            "case_id": hit["case_id"],
+            "side": hit["side"],
+            "similarity_score": round(hit["similarity_score"], 4),
+            "clinical_similarity": round(hit["clinical_similarity"], 4),
+            "embedding_similarity": round(hit["embedding_similarity"], 4) if hit["embedding_similarity"] is not None else None,
         }
-    ]
+        case.update(outcomes.get(hit["case_id"], {}))
+        cases.append(case)
+    return cases
+
+def find_similar_cases_batch(patient_ids: Sequence[str], top_k: int = 3,
+                             embeddings_path: Optional[str] = None,
+                             modality: str = "xray") -> List[List[Dict[str, Any]]]:
+    """
+    Embedding-only retrieval for many patients at once: one list of similar
+    cases (or a single {"error": ...} entry) per input patient ID, in input
+    order. All queries are scored in one matrix product. 'modality' is
+    "xray", "mri" or "fused" (both stores, see fusion_index.py).
+    """
+    paths = {"xray": [embeddings_path or XRAY_EMBEDDINGS_PATH], "mri": [embeddings_path or MRI_EMBEDDINGS_PATH],
+             "fused": [XRAY_EMBEDDINGS_PATH, MRI_EMBEDDINGS_PATH]}.get(modality)
+    if paths is None:
+        return [[{"error": f"Unknown modality '{modality}'"}] for _ in patient_ids]
+    for path in paths:
+        if not has_embeddings(path):
+            return [[{"error": f"Embedding file not found at {path}"}] for _ in patient_ids]
+
+    try:
+        index = get_fusion_index(*paths) if modality == "fused" else _retrieval_index(paths[0])
+        neighbours = index.search_ids(patient_ids, k=top_k)
+        found = {pid for hits in neighbours for pid, _ in hits}
+        outcomes = _load_outcomes(sorted(found, key=int))
+    except Exception as e:
+        return [[{"error": f"Failed to retrieve similar cases: {str(e)}"}] for _ in patient_ids]
+
+    results = []
+    for patient_id, hits in zip(patient_ids, neighbours):
+        if str(patient_id) not in index:
+            label = {"xray": "X-ray", "mri": "MRI", "fused": "X-ray or MRI"}[modality]
+            results.append([{"error": f"No {label} embedding for patient {patient_id}"}])
+            continue
+        cases = []
+        for case_id, score in hits:
+            case = {"case_id": case_id, "similarity_score": round(score, 4)}
+            case.update(outcomes.get(case_id, {}))
+            cases.append(case)
+        results.append(cases)
+    return results
+
+def _retrieval_index(path: str) -> EmbeddingIndex:
+    if RETRIEVAL_BACKEND == "ivf":
+        return get_ann_index(path)
+    if RETRIEVAL_BACKEND in QUANTIZATION_MODES:
+        return get_quantized_index(path, RETRIEVAL_BACKEND)
+    index = get_embedding_index(path)
+    if RETRIEVAL_BACKEND == "auto" and len(index) >= ANN_MIN_VECTORS:
+        return get_ann_index(path)
+    return index
+
+def _load_outcomes(case_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    if not case_ids:
+        return {}
+    rows = get_patient_store(DATA_FILE_PATH, OUTCOME_COLUMNS).first_rows([int(c) for c in case_ids])
+
+    # Rows as dicts of numpy scalars (iterrows would widen float32 columns)
+    columns = {col: rows[col].to_numpy() for col in rows.columns}
+    outcomes = {}
+    for i in range(len(rows)):
+        row = {col: values[i] for col, values in columns.items()}
+        baseline = kl_grade_of(row.get(BASELINE_KL_COLUMN))
+        latest = None
+        for col in reversed(FOLLOWUP_KL_COLUMNS):
+            latest = kl_grade_of(row.get(col))
+            if latest is not None:
+                break
+        kl_change = latest - baseline if latest is not None and baseline is not None else None
+        jsprg = _flag(row.get('JSPRG'))
+        painprg = _flag(row.get('PAINPRG'))
+        group = row.get('GROUPTYPE')
+
+        outcomes[str(as_python_scalar(row['ID']))] = {
+            "age": _value_or_na(row.get('V00AGE')),
+            "bmi": _value_or_na(row.get('P01BMI')),
+            "gender": _gender(row.get('P02SEX')),
+            "baseline_kl": baseline,
+            "latest_kl": latest,
+            "kl_change": kl_change,
+            "JSPRG": jsprg,
+            "PAINPRG": painprg,
+            "group": str(group) if group is not None and pd.notna(group) else "Unknown",
+            "outcome": _describe_outcome(baseline, latest, kl_change, jsprg, painprg),
+        }
+    return outcomes
+
+def _flag(value) -> Optional[int]:
+    return int(value) if value is not None and pd.notna(value) else None
+
+def _value_or_na(value):
+    return as_python_scalar(value) if value is not None and pd.notna(value) else "N/A"
+
+def _gender(value) -> str:
+    text = str(value) if value is not None and pd.notna(value) else ""
+    if "Female" in text or text.startswith("2"):
+        return "Female"
+    if "Male" in text or text.startswith("1"):
+        return "Male"
+    return "Unknown"
+
+def _describe_outcome(baseline, latest, kl_change, jsprg, painprg) -> str:
+    parts = []
+    if kl_change is not None:
+        parts.append(f"KL {baseline} -> {latest} ({kl_change:+d})")
+    if jsprg is not None:
+        parts.append("joint space loss progression" if jsprg else "no joint space loss progression")
+    if painprg is not None:
+        parts.append("pain progression" if painprg else "no pain progression")
+    return ", ".join(parts) if parts else "Outcome not recorded"
@@ -6,7 +6,7 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from oa_diagnosis.tools.oai_data_loader import load_patient_data
-from oa_diagnosis.tools.imaging_analysis import analyze_imaging
+from oa_diagnosis.tools.imaging_analysis import analyze_imaging_batch
 
 def verify_pipeline(patient_id):
     print(f"--- Verifying Data Pipeline for Patient {patient_id} ---")
@@ -32,9 +32,9 @@ def verify_pipeline(patient_id):
     # 2. Analyze Images
     print("\n2. Calling analyze_imaging on found images...", flush=True)
     
-    for img_id in imaging_ids[:3]: # Test first 3 images
+    # Test first 3 images, decoded in parallel
+    for img_id, result in zip(imaging_ids[:3], analyze_imaging_batch(imaging_ids[:3])):
         print(f"\n   Processing ID: {img_id}", flush=True)
-        result = analyze_imaging(img_id)
         
         if "error" in result:
             print(f"   ERROR: {result['error']}", flush=True)